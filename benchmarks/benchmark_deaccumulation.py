@@ -0,0 +1,90 @@
+'''-------------------------------------------------------------------------------
+ Source Name: benchmark_deaccumulation.py
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Description: Compares de-accumulating the cumulative runoff once per weight-table
+              row (the original order of the Create Inflow File tools) against once
+              per distinct grid cell followed by the gather and weighting of
+              SparseWeightTable, on a synthetic network in which every grid cell is
+              shared by several reaches. Requires only numpy:
+
+                  python benchmarks/benchmark_deaccumulation.py
+ History:     Initial coding - 10/16/2026, version 1.0
+-------------------------------------------------------------------------------'''
+import os
+import sys
+import time
+import numpy as NUM
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'toolbox', 'scripts'))
+from InflowEngine import SparseWeightTable, deaccumulate
+
+
+def synthetic_weight_table(size_stream, size_y, size_x, npoints, random_state):
+    """Weight table columns of size_stream reaches with npoints cells each in a size_y by size_x grid"""
+    stream_id = NUM.repeat(NUM.arange(size_stream), npoints)
+    area_sqm = random_state.rand(size_stream * npoints) * 1.0e6
+    x_index = random_state.randint(0, size_x, size_stream * npoints)
+    y_index = random_state.randint(0, size_y, size_stream * npoints)
+    return stream_id, area_sqm, x_index, y_index, NUM.repeat(npoints, size_stream * npoints)
+
+
+def per_row(weight_matrix, cumulative):
+    """De-accumulate one column per weight-table row, then weight and sum by reach"""
+    data_rows = cumulative[:, weight_matrix.indices]
+    increments = NUM.concatenate([data_rows[0:1,], NUM.subtract(data_rows[1:,], data_rows[:-1,])])
+    return NUM.add.reduceat(increments * weight_matrix.data, weight_matrix.indptr[:-1], axis=1)
+
+
+def per_cell(weight_matrix, cumulative):
+    """De-accumulate one column per distinct grid cell, then gather and weight"""
+    return weight_matrix.apply(deaccumulate(cumulative))
+
+
+def best_time(function, repeat, *args):
+    """Best wall-clock time of repeat calls of function"""
+    times = []
+    for i in range(repeat):
+        time_start = time.time()
+        result = function(*args)
+        times.append(time.time() - time_start)
+    return min(times), result
+
+
+def main():
+    random_state = NUM.random.RandomState(0)
+    size_time = 125
+    size_y, size_x = 100, 100
+    size_stream, npoints = 20000, 4
+
+    weight_matrix = SparseWeightTable.from_columns(*synthetic_weight_table(size_stream, size_y,
+                                                                           size_x, npoints,
+                                                                           random_state))
+    cumulative = NUM.cumsum(random_state.rand(size_time, weight_matrix.size_cell), axis=0)
+    cumulative = cumulative.astype(NUM.float32)
+
+    print("Reaches: {0}, weight-table rows: {1}, distinct cells: {2}, sharing ratio: {3:.1f}".format(
+          weight_matrix.size_stream, len(weight_matrix.data), weight_matrix.size_cell,
+          len(weight_matrix.data) / float(weight_matrix.size_cell)))
+
+    # The de-accumulation step alone
+    data_rows = cumulative[:, weight_matrix.indices]
+    time_row, increments_row = best_time(deaccumulate, 5, data_rows)
+    time_cell, increments_cell = best_time(deaccumulate, 5, cumulative)
+    print("De-accumulation per weight-table row: {0:.3f} s".format(time_row))
+    print("De-accumulation per grid cell:        {0:.3f} s ({1:.2f}x faster)".format(
+          time_cell, time_row / time_cell))
+
+    # The whole inflow computation
+    time_row, inflow_row = best_time(per_row, 5, weight_matrix, cumulative)
+    time_cell, inflow_cell = best_time(per_cell, 5, weight_matrix, cumulative)
+    print("Inflows, de-accumulated per weight-table row: {0:.3f} s".format(time_row))
+    print("Inflows, de-accumulated per grid cell:        {0:.3f} s ({1:.2f}x faster)".format(
+          time_cell, time_row / time_cell))
+    print("Maximum relative difference of the inflows: {0:.2e}".format(
+          NUM.abs(inflow_row - inflow_cell).max() / NUM.abs(inflow_row).max()))
+
+
+if __name__ == '__main__':
+    main()
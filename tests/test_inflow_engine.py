@@ -0,0 +1,52 @@
+'''-------------------------------------------------------------------------------
+ Source Name: test_inflow_engine.py
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Description: Tests of the shared computation engine of the Create Inflow File tools.
+              Requires numpy and netCDF4:
+
+                  python -m pytest tests
+ History:     Initial coding - 10/16/2026, version 1.0
+-------------------------------------------------------------------------------'''
+import os
+import sys
+import numpy as NUM
+import netCDF4 as NET
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'toolbox', 'scripts'))
+from InflowEngine import SparseWeightTable
+
+
+def test_read_cells_unpacks_scaled_variable(tmpdir):
+    """Both the slab and the runs reads return the unpacked values of a packed variable"""
+    random_state = NUM.random.RandomState(0)
+    runoff = random_state.rand(3, 40, 200) * 10.0
+
+    in_nc = str(tmpdir.join("packed.nc"))
+    data_nc = NET.Dataset(in_nc, "w")
+    data_nc.createDimension("time", 3)
+    data_nc.createDimension("lat", 40)
+    data_nc.createDimension("lon", 200)
+    variable = data_nc.createVariable("RO", "i2", ("time", "lat", "lon"))
+    variable.scale_factor = 0.001
+    variable.add_offset = 0.0
+    variable[:] = runoff
+    data_nc.close()
+
+    # Cells in two far corners of the grid, so that reading runs beats the slab
+    weight_matrix = SparseWeightTable.from_columns([1, 2], [1.0, 1.0], [2, 190], [1, 35], [1, 1])
+    data_nc = NET.Dataset(in_nc)
+    try:
+        variable = data_nc.variables["RO"]
+        starts, ends = weight_matrix.cell_runs()
+        data_runs = weight_matrix.read_cell_runs(variable, slice(None), starts, ends)
+        data_slab = weight_matrix.read_cell_slab(variable)
+        data_cells = weight_matrix.read_cells(variable)
+    finally:
+        data_nc.close()
+
+    expected = runoff[:, [1, 35], [2, 190]]
+    NUM.testing.assert_allclose(data_runs, expected, atol=1e-3)
+    NUM.testing.assert_allclose(data_slab, expected, atol=1e-3)
+    NUM.testing.assert_allclose(data_cells, expected, atol=1e-3)
@@ -0,0 +1,23 @@
+'''-------------------------------------------------------------------------------
+ Source Name: CacheKey.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: Keys of the binary files cached beside the input files of the tools
+              (the compiled weight tables and the river networks), which are rebuilt
+              whenever the content of their input file changes.
+ History:     Initial coding - 10/16/2026, version 1.0
+-------------------------------------------------------------------------------'''
+import hashlib
+
+
+def file_key(in_file, block_size=1<<20):
+    """Content hash of a file, the key of the binary files cached from it"""
+    sha1 = hashlib.sha1()
+    with open(in_file, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            sha1.update(block)
+            block = f.read(block_size)
+    return sha1.hexdigest()
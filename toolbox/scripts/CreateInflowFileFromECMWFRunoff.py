@@ -35,6 +35,17 @@
                 in the drainage line feature class and the catchment feature class.
               Version 2.0, 06/10/2015, use streamID in the weight table as the dimension name of
                 m3_riv in the output RAPID inflow file
+              Version 2.1, 10/16/2026, compile the weight table into a sparse stream-by-cell
+                area matrix and compute the inflows of all streams in one matrix product
+              Version 2.1, 10/16/2026, moved the reading of the weight table and the computation
+                of one inflow file into methods shared with the ensemble batch tool
+              Version 2.1, 10/16/2026, reuse the compiled weight table cached by previous runs
+              Version 2.1, 10/16/2026, compute and write the inflows in chunks of time steps
+                within an optional memory budget
+              Version 2.1, 10/16/2026, derive the output time steps from the time variable
+                for any time interval instead of hard-coded time indices of the data
+              Version 2.1, 10/16/2026, added the output formats of 64-bit offset, CDF5 and
+                chunked netCDF-4 with optional compression
 
 -------------------------------------------------------------------------------'''
 import os
@@ -42,6 +53,10 @@ import arcpy
 import netCDF4 as NET
 import numpy as NUM
 import csv
+from InflowEngine import SparseWeightTable, INFLOW_FORMATS, create_inflow_variable, \
+                         resample_time_indices, load_compiled_weight_table, \
+                         save_compiled_weight_table
+from CacheKey import file_key
 
 class CreateInflowFileFromECMWFRunoff(object):
     def __init__(self):
@@ -53,50 +68,154 @@ class CreateInflowFileFromECMWFRunoff(object):
         self.header_wt = ['StreamID', 'area_sqm', 'lon_index', 'lat_index', 'npoints', 'weight', 'Lon', 'Lat']
         self.dims_oi = ['lon', 'lat', 'time']
         self.vars_oi = ["lon", "lat", "time", "RO"]
-        self.length_time = {"LowRes": 61, "HighRes": 125}
-        self.length_time_opt = {"LowRes": 61, "HighRes-1hr": 91, "HighRes-3hr": 49, "HighRes-6hr": 41}
         self.errorMessages = ["Missing Variable 'time'",
                               "Incorrect dimensions in the input ECMWF runoff file.",
                               "Incorrect variables in the input ECMWF runoff file.",
                               "Incorrect time variable in the input ECMWF runoff file",
                               "Incorrect number of columns in the weight table",
                               "No or incorrect header in the weight table",
-                              "Incorrect sequence of rows in the weight table"]
+                              "Incorrect sequence of rows in the weight table",
+                              "Incorrect time interval: {0}"]
         self.category = "Preprocessing"
 
 
-    def dataValidation(self, in_nc, messages):
-        """Check the necessary dimensions and variables in the input netcdf data"""
-        data_nc = NET.Dataset(in_nc)
-
+    def dataValidation(self, data_nc):
+        """Check the necessary dimensions and variables in the opened input netcdf data"""
         dims = data_nc.dimensions.keys()
         if dims != self.dims_oi:
-            messages.addErrorMessage(self.errorMessages[1])
-            raise arcpy.ExecuteError
+            raise ValueError(self.errorMessages[1])
 
         vars = data_nc.variables.keys()
         if vars != self.vars_oi:
-            messages.addErrorMessage(self.errorMessages[2])
-            raise arcpy.ExecuteError
+            raise ValueError(self.errorMessages[2])
 
         return
 
 
-    def dataIdentify(self, in_nc):
-        """Check if the data is Ensemble 1-51 (low resolution) or 52 (high resolution)"""
-        data_nc = NET.Dataset(in_nc)
-        name_time = self.vars_oi[2]
-        time = data_nc.variables[name_time][:]
-        diff = NUM.unique(NUM.diff(time))
-        data_nc.close()
-        time_interval_highres = NUM.array([1.0,3.0,6.0],dtype=float)
-        time_interval_lowres = NUM.array([6.0],dtype=float)
-        if (diff == time_interval_highres).all():
-            return "HighRes"
-        elif (diff == time_interval_lowres).all():
-            return "LowRes"
+    def readWeightTable(self, in_weight_table, messages):
+        """Read the .csv weight table and compile it into a sparse stream-by-cell area matrix
+
+           Returns the name of the stream ID field and the compiled weight table.
+           The compiled weight table is cached beside the .csv file for later runs.
+        """
+        key = file_key(in_weight_table)
+        compiled = load_compiled_weight_table(in_weight_table, key)
+        if compiled is not None:
+            return compiled
+
+        dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
+                     self.header_wt[3]:[], self.header_wt[4]:[], self.header_wt[5]:[],
+                     self.header_wt[6]:[], self.header_wt[7]:[]}
+        streamID = ""
+        with open(in_weight_table, "rb") as csvfile:
+            reader = csv.reader(csvfile)
+            count = 0
+            for row in reader:
+                if count == 0:
+                    #check number of columns in the weight table
+                    if len(row) != len(self.header_wt):
+                        messages.addErrorMessage(self.errorMessages[4])
+                        raise arcpy.ExecuteError
+                    #check header
+                    if row[1:len(self.header_wt)] != self.header_wt[1:len(self.header_wt)]:
+                        messages.addErrorMessage(self.errorMessages[5])
+                        raise arcpy.ExecuteError
+                    streamID = row[0]
+                    count += 1
+                else:
+                    for i in range(0,8):
+                       dict_list[self.header_wt[i]].append(row[i])
+                    count += 1
+
+        try:
+            weight_matrix = SparseWeightTable.from_columns(dict_list[self.header_wt[0]],
+                                                           dict_list[self.header_wt[1]],
+                                                           dict_list[self.header_wt[2]],
+                                                           dict_list[self.header_wt[3]],
+                                                           dict_list[self.header_wt[4]])
+        except ValueError:
+            messages.addErrorMessage(self.errorMessages[6])
+            raise arcpy.ExecuteError
+
+        try:
+            save_compiled_weight_table(in_weight_table, key, streamID, weight_matrix)
+        except (IOError, OSError):
+            arcpy.AddWarning("Unable to save the compiled weight table beside the weight table")
+
+        return streamID, weight_matrix
+
+
+    def timeIndices(self, data_nc, in_time_interval):
+        """Indices of the time steps of the cumulative runoff that end each output time step
+
+           The output time steps follow in_time_interval (e.g. "3hr"; by default the
+           largest time interval in the data) from the first time in the data, for as
+           long as the time steps in the data resolve them. For example, the High
+           Resolution data (Ensemble 52) is of 1 hr time interval from Hour 0 to 90,
+           3 hr from Hour 90 to 144, and 6 hr from Hour 144 to 240, so its 1 hr output
+           ends at Hour 90 and its 3 hr output ends at Hour 144.
+        """
+        ''''IMPORTANT NOTE: runoff variable in ECMWF dataset is cumulative instead of incremental through time'''
+        time = data_nc.variables[self.vars_oi[2]][:]
+        diff = NUM.diff(time)
+        if len(time) == 0 or (diff <= 0).any():
+            raise ValueError(self.errorMessages[3])
+
+        if in_time_interval:
+            try:
+                interval = float(in_time_interval.lower().rstrip("hr"))
+            except ValueError:
+                raise ValueError(self.errorMessages[7].format(in_time_interval))
+            if interval <= 0:
+                raise ValueError(self.errorMessages[7].format(in_time_interval))
+        elif len(diff) > 0:
+            interval = diff.max()
         else:
-            return None
+            interval = 1.0
+
+        return resample_time_indices(time, interval)
+
+
+    def createInflowFile(self, in_nc, weight_matrix, streamID, out_nc, in_time_interval,
+                         in_memory_budget=None, out_format="NETCDF3_CLASSIC", in_complevel=None,
+                         add_message=None):
+        """Create the RAPID inflow file of one ECMWF runoff file with the compiled weight table
+
+           The inflows are computed in chunks of time steps within in_memory_budget (in MB)
+           and written to an inflow file of out_format, compressed at in_complevel if NETCDF4.
+           The progress messages are passed to add_message (e.g. arcpy.AddMessage) if given.
+           Raises ValueError with the error message if the runoff file is not valid.
+        """
+        # Validate the netcdf dataset and obtain the time steps of the output
+        data_in_nc = NET.Dataset(in_nc)
+        data_out_nc = None
+        try:
+            self.dataValidation(data_in_nc)
+            time_indices = self.timeIndices(data_in_nc, in_time_interval)
+            size_time = len(time_indices)
+
+            # Create output inflow netcdf data
+            data_out_nc = NET.Dataset(out_nc, "w", format = out_format)
+            var_m3_riv = create_inflow_variable(data_out_nc, streamID, size_time,
+                                                weight_matrix.size_stream, in_complevel)
+
+            # Read the runoff of the distinct computational grid cells in the weight table,
+            # compute their incremental runoff, then the inflows of all streams at once
+            var_runoff = data_in_nc.variables[self.vars_oi[3]]
+            size_chunk = weight_matrix.time_chunk_size(in_memory_budget, size_time)
+            for start, data_temp in weight_matrix.iter_inflows(
+                    lambda indices: weight_matrix.read_cells(var_runoff, indices),
+                    time_indices, size_chunk):
+                if start == 0 and add_message is not None:
+                    add_message("Writing inflow data...")
+                var_m3_riv[start:start+len(data_temp)] = data_temp
+        finally:
+            # close the input and output netcdf datasets
+            data_in_nc.close()
+            if data_out_nc is not None:
+                data_out_nc.close()
+
+        return
 
 
     def getParameterInfo(self):
@@ -129,7 +248,30 @@ class CreateInflowFileFromECMWFRunoff(object):
         list_intervals = []
         param3.filter.list = list_intervals
 
-        params = [param0, param1, param2, param3]
+        param4 = arcpy.Parameter(name = "memory_budget",
+                                 displayName = "Memory Budget (MB)",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPLong")
+
+        param5 = arcpy.Parameter(name = "out_format",
+                                 displayName = "Output Format",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPString")
+        param5.filter.type = "ValueList"
+        param5.filter.list = INFLOW_FORMATS
+        param5.value = INFLOW_FORMATS[0]
+
+        param6 = arcpy.Parameter(name = "compression_level",
+                                 displayName = "Compression Level",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPLong")
+        param6.filter.type = "Range"
+        param6.filter.list = [1, 9]
+
+        params = [param0, param1, param2, param3, param4, param5, param6]
 
         return params
 
@@ -149,7 +291,9 @@ class CreateInflowFileFromECMWFRunoff(object):
                 time = data_nc.variables[name_time][:]
                 diff = NUM.unique(NUM.diff(time))
                 max_interval = diff.max()
-                parameters[3].filter.list = [(str(int(each)) + "hr") for each in diff]
+                # Native time intervals of the data, and daily aggregations of them
+                intervals = list(diff) + [each for each in [12.0, 24.0] if each > max_interval]
+                parameters[3].filter.list = [(str(int(each)) + "hr") for each in intervals]
                 if parameters[3].valueAsText is None:
                     parameters[3].value = str(int(max_interval)) + "hr"
                 data_nc.close()
@@ -186,6 +330,13 @@ class CreateInflowFileFromECMWFRunoff(object):
         except Exception as e:
             parameters[1].setErrorMessage(e.message)
 
+        if parameters[4].altered and parameters[4].value is not None:
+            if parameters[4].value <= 0:
+                parameters[4].setErrorMessage("Memory Budget must be a positive number of megabytes")
+
+        if parameters[6].value is not None and parameters[5].valueAsText != "NETCDF4":
+            parameters[6].setErrorMessage("Only the NETCDF4 output format can be compressed")
+
         return
 
     def execute(self, parameters, messages):
@@ -197,163 +348,21 @@ class CreateInflowFileFromECMWFRunoff(object):
         in_weight_table = parameters[1].valueAsText
         out_nc = parameters[2].valueAsText
         in_time_interval = parameters[3].valueAsText
-
-        # Validate the netcdf dataset
-        self.dataValidation(in_nc, messages)
-
-        # identify if the input netcdf data is the High Resolution data with three different time intervals
-        id_data = self.dataIdentify(in_nc)
-        if id_data is None:
-            messages.addErrorMessage(self.errorMessages[3])
-            raise arcpy.ExecuteError
-
-        ''' Read the netcdf dataset'''
-        data_in_nc = NET.Dataset(in_nc)
-        time = data_in_nc.variables[self.vars_oi[2]][:]
-
-        # Check the size of time variable in the netcdf data
-        if len(time) != self.length_time[id_data]:
-            messages.addErrorMessage(self.errorMessages[3])
-            raise arcpy.ExecuteError
+        in_memory_budget = parameters[4].value
+        out_format = parameters[5].valueAsText or INFLOW_FORMATS[0]
+        in_complevel = parameters[6].value
 
         ''' Read .csv weight table '''
         arcpy.AddMessage("Reading the weight table...")
-        dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
-                     self.header_wt[3]:[], self.header_wt[4]:[], self.header_wt[5]:[],
-                     self.header_wt[6]:[], self.header_wt[7]:[]}
-        streamID = ""
-        with open(in_weight_table, "rb") as csvfile:
-            reader = csv.reader(csvfile)
-            count = 0
-            for row in reader:
-                if count == 0:
-                    #check number of columns in the weight table
-                    if len(row) != len(self.header_wt):
-                        messages.addErrorMessage(self.errorMessages[4])
-                        raise arcpy.ExecuteError
-                    #check header
-                    if row[1:len(self.header_wt)] != self.header_wt[1:len(self.header_wt)]:
-                        messages.addErrorMessage(self.errorMessages[5])
-                        arcpy.ExecuteError
-                    streamID = row[0]
-                    count += 1
-                else:
-                    for i in range(0,8):
-                       dict_list[self.header_wt[i]].append(row[i])
-                    count += 1
+        streamID, weight_matrix = self.readWeightTable(in_weight_table, messages)
 
         '''Calculate water inflows'''
         arcpy.AddMessage("Calculating water inflows...")
-
-        # Obtain size information
-        if id_data == "LowRes":
-            size_time = self.length_time_opt["LowRes"]
-        else:
-            if in_time_interval == "1hr":
-                size_time = self.length_time_opt["HighRes-1hr"]
-            elif in_time_interval == "3hr":
-                size_time = self.length_time_opt["HighRes-3hr"]
-            else:
-                size_time = self.length_time_opt["HighRes-6hr"]
-
-        size_streamID = len(set(dict_list[self.header_wt[0]]))
-
-        # Create output inflow netcdf data
-        data_out_nc = NET.Dataset(out_nc, "w", format = "NETCDF3_CLASSIC")
-        dim_Time = data_out_nc.createDimension('Time', size_time)
-        dim_RiverID = data_out_nc.createDimension(streamID, size_streamID)
-        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', ('Time', streamID))
-        data_temp = NUM.empty(shape = [size_time, size_streamID])
-
-
-        lon_ind_all = [long(i) for i in dict_list[self.header_wt[2]]]
-        lat_ind_all = [long(j) for j in dict_list[self.header_wt[3]]]
-
-        # Obtain a subset of  runoff data based on the indices in the weight table
-        min_lon_ind_all = min(lon_ind_all)
-        max_lon_ind_all = max(lon_ind_all)
-        min_lat_ind_all = min(lat_ind_all)
-        max_lat_ind_all = max(lat_ind_all)
-
-
-        data_subset_all = data_in_nc.variables[self.vars_oi[3]][:, min_lat_ind_all:max_lat_ind_all+1, min_lon_ind_all:max_lon_ind_all+1]
-        len_time_subset_all = data_subset_all.shape[0]
-        len_lat_subset_all = data_subset_all.shape[1]
-        len_lon_subset_all = data_subset_all.shape[2]
-        data_subset_all = data_subset_all.reshape(len_time_subset_all, (len_lat_subset_all * len_lon_subset_all))
-
-
-        # compute new indices based on the data_subset_all
-        index_new = []
-        for r in range(0,count-1):
-            ind_lat_orig = lat_ind_all[r]
-            ind_lon_orig = lon_ind_all[r]
-            index_new.append((ind_lat_orig - min_lat_ind_all)*len_lon_subset_all + (ind_lon_orig - min_lon_ind_all))
-
-        # obtain a new subset of data
-        data_subset_new = data_subset_all[:,index_new]
-        pointer = 0
-        # start compute inflow
-        len_wt = len(dict_list[self.header_wt[0]])
-        for s in range(0, size_streamID):
-                    npoints = int(dict_list[self.header_wt[4]][pointer])
-                    # Check if all npoints points correspond to the same streamID
-                    if len(set(dict_list[self.header_wt[0]][pointer : (pointer + npoints)])) != 1:
-                          messages.addErrorMessage(self.errorMessages[2])
-                          arcpy.ExecuteError
-
-                    area_sqm_npoints = [float(k) for k in dict_list[self.header_wt[1]][pointer : (pointer + npoints)]]
-                    area_sqm_npoints = NUM.array(area_sqm_npoints)
-                    area_sqm_npoints = area_sqm_npoints.reshape(1, npoints)
-                    data_goal = data_subset_new[:, pointer:(pointer + npoints)]
-
-                    ''''IMPORTANT NOTE: runoff variable in ECMWF dataset is cumulative instead of incremental through time'''
-                    # For data with Low Resolution, there's only one time interval 6 hrs
-                    if id_data == "LowRes":
-                        #ro_stream = data_goal * area_sqm_npoints
-                        ro_stream = NUM.concatenate([data_goal[0:1,],
-                                        NUM.subtract(data_goal[1:,],data_goal[:-1,])]) * area_sqm_npoints
-
-                    #For data with High Resolution, from Hour 0 to 90 (the first 91 time points) are of 1 hr time interval,
-                    # then from Hour 90 to 144 (19 time points) are of 3 hour time interval, and from Hour 144 to 240 (15 time points)
-                    # are of 6 hour time interval
-                    else:
-                        if in_time_interval == "1hr":
-                            ro_stream = NUM.concatenate([data_goal[0:1,],
-                                        NUM.subtract(data_goal[1:91,],data_goal[:90,])]) * area_sqm_npoints
-                        elif in_time_interval == "3hr":
-                            # Hour = 0 is a single data point
-                            ro_3hr_a = data_goal[0:1,]
-                            # calculate time series of 3 hr data from 1 hr data
-                            ro_3hr_b = NUM.subtract(data_goal[3:91:3,],data_goal[:88:3,])
-                            # get the time series of 3 hr data
-                            ro_3hr_c = NUM.subtract(data_goal[91:109,], data_goal[90:108,])
-                            # concatenate all time series
-                            ro_stream = NUM.concatenate([ro_3hr_a, ro_3hr_b, ro_3hr_c]) * area_sqm_npoints
-                        else: 
-                            # in_time_interval is "6hr"
-                            # Hour = 0 is a single data point
-                            ro_6hr_a = data_goal[0:1,]
-                            # calculate time series of 6 hr data from 1 hr data
-                            ro_6hr_b = NUM.subtract(data_goal[6:91:6,], data_goal[:85:6,])
-                            # calculate time series of 6 hr data from 3 hr data
-                            ro_6hr_c = NUM.subtract(data_goal[92:109:2,], data_goal[90:107:2,])
-                            # get the time series of 6 hr data
-                            ro_6hr_d = NUM.subtract(data_goal[109:,], data_goal[108:124,])
-                            # concatenate all time series
-                            ro_stream = NUM.concatenate([ro_6hr_a, ro_6hr_b, ro_6hr_c, ro_6hr_d]) * area_sqm_npoints
-
-
-                    data_temp[:,s] = ro_stream.sum(axis = 1)
-                    pointer += npoints
-
-
-        '''Write inflow data'''
-        arcpy.AddMessage("Writing inflow data...")
-        var_m3_riv[:] = data_temp
-        # close the input and output netcdf datasets
-        data_in_nc.close()
-        data_out_nc.close()
-
+        try:
+            self.createInflowFile(in_nc, weight_matrix, streamID, out_nc, in_time_interval,
+                                  in_memory_budget, out_format, in_complevel, arcpy.AddMessage)
+        except ValueError as e:
+            messages.addErrorMessage(str(e))
+            raise arcpy.ExecuteError
 
         return
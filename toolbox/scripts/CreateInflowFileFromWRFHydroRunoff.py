@@ -32,12 +32,30 @@
                 in the drainage line feature class and the catchment feature class.
               Version 2.0, 06/10/2015, use streamID in the weight table as the dimension name of
                 m3_riv in the output RAPID inflow file
+              Version 2.1, 10/16/2026, compile the weight table into a sparse stream-by-cell
+                area matrix and compute the inflows of all streams in one matrix product
+              Version 2.1, 10/16/2026, reuse the compiled weight table cached by previous runs
+              Version 2.1, 10/16/2026, compute and write the inflows in chunks of time steps
+                within an optional memory budget
+              Version 2.1, 10/16/2026, added the output formats of 64-bit offset, CDF5 and
+                chunked netCDF-4 with optional compression
+              Version 2.1, 10/16/2026, accept an ordered list or a wildcard pattern of runoff
+                files (e.g. one LDASOUT file per output time) that are read ahead on a
+                thread and streamed into the inflow file chunk by chunk
+              Version 2.1, 10/16/2026, sum the runoff variables into one float32 buffer and
+                convert the runoff from millimeters to meters in the weight table
 -------------------------------------------------------------------------------'''
 import os
+import glob
+import threading
 import arcpy
 import netCDF4 as NET
 import numpy as NUM
 import csv
+from InflowEngine import SparseWeightTable, SingleTimeVariable, LockedVariable, INFLOW_FORMATS, \
+                         create_inflow_variable, iter_read_ahead, \
+                         load_compiled_weight_table, save_compiled_weight_table
+from CacheKey import file_key
 
 
 class CreateInflowFileFromWRFHydroRunoff(object):
@@ -45,7 +63,8 @@ class CreateInflowFileFromWRFHydroRunoff(object):
         """Define the tool (tool name is the name of the class)."""
         self.label = "Create Inflow File From WRF-Hydro Runoff"
         self.description = ("Creates RAPID NetCDF input of water inflow based on the WRF-Hydro land" +
-                            " model output and the weight table previously created")
+                            " model output, in one file or one file per output time, and the" +
+                            " weight table previously created")
         self.canRunInBackground = False
         self.header_wt = ['StreamID', 'area_sqm', 'west_east', 'south_north',
                                   'npoints', 'weight', 'Lon', 'Lat', 'x', 'y']
@@ -56,11 +75,36 @@ class CreateInflowFileFromWRFHydroRunoff(object):
                               "No or incorrect header in the weight table",
                               "Incorrect sequence of rows in the weight table",
                               "Missing variable: {0} in the input WRF-Hydro runoff file",
-                              "Incorrect dimensions of variable {0} in the input WRF-Hydro runoff file"]
+                              "Incorrect dimensions of variable {0} in the input WRF-Hydro runoff file",
+                              "No WRF-Hydro runoff files match {0}"]
+        # Number of threads that read the runoff files ahead of the computation
+        self.size_read_pool = 1
         self.category = "Preprocessing"
 
+    def listRunoffFiles(self, in_nc):
+        """List the runoff files in time order from a ;-delimited list of files or wildcard patterns
+
+           The files are kept in the order given; the files matching a pattern are
+           sorted by name, which is the time order of the WRF-Hydro LDASOUT files.
+        """
+        list_in_nc = []
+        for each in in_nc.split(";"):
+            each = each.strip().strip("'\"")
+            if not each:
+                continue
+            if glob.has_magic(each):
+                list_in_nc.extend(sorted(glob.glob(each)))
+            else:
+                list_in_nc.append(each)
+        return list_in_nc
+
     def dataValidation(self, in_nc, messages):
-        """Check the necessary dimensions and variables in the input netcdf data"""
+        """Check the necessary dimensions and variables in the input netcdf data
+
+           Returns the number of time steps in the file. The runoff variables are
+           either (Time, south_north, west_east) or (south_north, west_east) for a
+           file of a single output time.
+        """
         data_nc = NET.Dataset(in_nc)
         vars = data_nc.variables.keys()
         for each in self.vars_oi:
@@ -69,21 +113,75 @@ class CreateInflowFileFromWRFHydroRunoff(object):
                 raise arcpy.ExecuteError
             else:
                 dims = data_nc.variables[each].dimensions
-                if self.dims_var != dims:
+                if self.dims_var != dims and self.dims_var[1:] != dims:
                     messages.addErrorMessage(self.errorMessages[4].format(each))
                     raise arcpy.ExecuteError
 
+        var_runoff = data_nc.variables[self.vars_oi[0]]
+        size_time = var_runoff.shape[0] if len(var_runoff.dimensions) == 3 else 1
         data_nc.close()
 
-        return
+        return size_time
+
+    def readWeightTable(self, in_weight_table, messages):
+        """Read the .csv weight table and compile it into a sparse stream-by-cell area matrix
+
+           Returns the name of the stream ID field and the compiled weight table.
+           The compiled weight table is cached beside the .csv file for later runs.
+        """
+        key = file_key(in_weight_table)
+        compiled = load_compiled_weight_table(in_weight_table, key)
+        if compiled is not None:
+            return compiled
+
+        dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
+                     self.header_wt[3]:[], self.header_wt[4]:[]}
+        streamID = ""
+        with open(in_weight_table, "rb") as csvfile:
+            reader = csv.reader(csvfile)
+            count = 0
+            for row in reader:
+                if count == 0:
+                    #check number of columns in the weight table
+                    if len(row) != len(self.header_wt):
+                        messages.addErrorMessage(self.errorMessages[0])
+                        raise arcpy.ExecuteError
+                    #check header
+                    if row[1:len(self.header_wt)] != self.header_wt[1:len(self.header_wt)]:
+                        messages.addErrorMessage(self.errorMessages[1])
+                        raise arcpy.ExecuteError
+                    streamID = row[0]
+                    count += 1
+                else:
+                    for i in range(0,5):
+                       dict_list[self.header_wt[i]].append(row[i])
+                    count += 1
+
+        try:
+            weight_matrix = SparseWeightTable.from_columns(dict_list[self.header_wt[0]],
+                                                           dict_list[self.header_wt[1]],
+                                                           dict_list[self.header_wt[2]],
+                                                           dict_list[self.header_wt[3]],
+                                                           dict_list[self.header_wt[4]])
+        except ValueError:
+            messages.addErrorMessage(self.errorMessages[2])
+            raise arcpy.ExecuteError
+
+        try:
+            save_compiled_weight_table(in_weight_table, key, streamID, weight_matrix)
+        except (IOError, OSError):
+            arcpy.AddWarning("Unable to save the compiled weight table beside the weight table")
+
+        return streamID, weight_matrix
 
     def getParameterInfo(self):
         """Define parameter definitions"""
         param0 = arcpy.Parameter(name = "in_WRF_Hydro_runoff_file",
-                                 displayName = "Input WRF-Hydro Runoff File",
+                                 displayName = "Input WRF-Hydro Runoff Files",
                                  direction = "Input",
                                  parameterType = "Required",
-                                 datatype = "DEFile")
+                                 datatype = ["DEFile", "GPString"],
+                                 multiValue = True)
 
         param1 = arcpy.Parameter(name = "in_weight_table",
                                  displayName = "Input Weight Table",
@@ -97,7 +195,30 @@ class CreateInflowFileFromWRFHydroRunoff(object):
                                  parameterType = "Required",
                                  datatype = "DEFile")
 
-        params = [param0, param1, param2]
+        param3 = arcpy.Parameter(name = "memory_budget",
+                                 displayName = "Memory Budget (MB)",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPLong")
+
+        param4 = arcpy.Parameter(name = "out_format",
+                                 displayName = "Output Format",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPString")
+        param4.filter.type = "ValueList"
+        param4.filter.list = INFLOW_FORMATS
+        param4.value = INFLOW_FORMATS[0]
+
+        param5 = arcpy.Parameter(name = "compression_level",
+                                 displayName = "Compression Level",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPLong")
+        param5.filter.type = "Range"
+        param5.filter.list = [1, 9]
+
+        params = [param0, param1, param2, param3, param4, param5]
 
         return params
 
@@ -120,18 +241,28 @@ class CreateInflowFileFromWRFHydroRunoff(object):
         """Modify the messages created by internal validation for each tool
         parameter.  This method is called after internal validation."""
         if parameters[0].altered:
-            in_nc = parameters[0].valueAsText
-            try:
-                data_nc = NET.Dataset(in_nc)
-                data_nc.close()
-            except Exception as e:
-                parameters[0].setErrorMessage(e.message)
+            list_in_nc = self.listRunoffFiles(parameters[0].valueAsText)
+            if not list_in_nc:
+                parameters[0].setErrorMessage(self.errorMessages[5].format(parameters[0].valueAsText))
+            else:
+                try:
+                    data_nc = NET.Dataset(list_in_nc[0])
+                    data_nc.close()
+                except Exception as e:
+                    parameters[0].setErrorMessage(e.message)
 
         if parameters[1].altered:
             (dirnm, basenm) = os.path.split(parameters[1].valueAsText)
             if not basenm.endswith(".csv"):
                 parameters[1].setErrorMessage("The weight table must be in CSV format")
 
+        if parameters[3].altered and parameters[3].value is not None:
+            if parameters[3].value <= 0:
+                parameters[3].setErrorMessage("Memory Budget must be a positive number of megabytes")
+
+        if parameters[5].value is not None and parameters[4].valueAsText != "NETCDF4":
+            parameters[5].setErrorMessage("Only the NETCDF4 output format can be compressed")
+
         return
 
     def execute(self, parameters, messages):
@@ -143,110 +274,83 @@ class CreateInflowFileFromWRFHydroRunoff(object):
         in_weight_table = parameters[1].valueAsText
 
         out_nc = parameters[2].valueAsText
+        in_memory_budget = parameters[3].value
+        out_format = parameters[4].valueAsText or INFLOW_FORMATS[0]
+        in_complevel = parameters[5].value
+
+        list_in_nc = self.listRunoffFiles(in_nc)
+        if not list_in_nc:
+            messages.addErrorMessage(self.errorMessages[5].format(in_nc))
+            raise arcpy.ExecuteError
 
-        # Validate the netcdf dataset
-        self.dataValidation(in_nc, messages)
+        # Validate the netcdf datasets
+        list_size_time = [self.dataValidation(each, messages) for each in list_in_nc]
 
         '''Read .csv weight table'''
         arcpy.AddMessage("Reading the weight table...")
-        dict_list = {self.header_wt[0]:[], self.header_wt[1]:[], self.header_wt[2]:[],
-                     self.header_wt[3]:[], self.header_wt[4]:[]}
-        streamID = ""
-        with open(in_weight_table, "rb") as csvfile:
-            reader = csv.reader(csvfile)
-            count = 0
-            for row in reader:
-                if count == 0:
-                    #check number of columns in the weight table
-                    if len(row) != len(self.header_wt):
-                        messages.addErrorMessage(self.errorMessages[0])
-                        raise arcpy.ExecuteError
-                    #check header
-                    if row[1:len(self.header_wt)] != self.header_wt[1:len(self.header_wt)]:
-                        messages.addErrorMessage(self.errorMessages[1])
-                        arcpy.ExecuteError
-                    streamID = row[0]
-                    count += 1
-                else:
-                    for i in range(0,5):
-                       dict_list[self.header_wt[i]].append(row[i])
-                    count += 1
+        streamID, weight_matrix = self.readWeightTable(in_weight_table, messages)
 
         '''Calculate water inflows'''
         arcpy.AddMessage("Calculating water inflows...")
-        data_in_nc = NET.Dataset(in_nc)
-
         # Obtain size information
-        size_time = data_in_nc.variables[self.vars_oi[0]].shape[0]
-        size_streamID = len(set(dict_list[self.header_wt[0]]))
+        size_time = sum(list_size_time)
+
+        size_streamID = weight_matrix.size_stream
 
         # Create output inflow netcdf data
-        data_out_nc = NET.Dataset(out_nc, "w", format = "NETCDF3_CLASSIC")
-        dim_Time = data_out_nc.createDimension('Time', size_time)
-        dim_RiverID = data_out_nc.createDimension(streamID, size_streamID)
-        var_m3_riv = data_out_nc.createVariable('m3_riv', 'f4', ('Time', streamID))
-        data_temp = NUM.empty(shape = [size_time, size_streamID])
-
-
-        we_ind_all = [long(i) for i in dict_list[self.header_wt[2]]]
-        sn_ind_all = [long(j) for j in dict_list[self.header_wt[3]]]
-
-        # Obtain a subset of  runoff data based on the indices in the weight table
-        min_we_ind_all = min(we_ind_all)
-        max_we_ind_all = max(we_ind_all)
-        min_sn_ind_all = min(sn_ind_all)
-        max_sn_ind_all = max(sn_ind_all)
-
-
-        data_subset_all = data_in_nc.variables[self.vars_oi[0]][:,min_sn_ind_all:max_sn_ind_all+1, min_we_ind_all:max_we_ind_all+1]/1000 \
-                        + data_in_nc.variables[self.vars_oi[1]][:,min_sn_ind_all:max_sn_ind_all+1, min_we_ind_all:max_we_ind_all+1]/1000 \
-                        + data_in_nc.variables[self.vars_oi[2]][:,min_sn_ind_all:max_sn_ind_all+1, min_we_ind_all:max_we_ind_all+1]/1000
-        len_time_subset_all = data_subset_all.shape[0]
-        len_sn_subset_all = data_subset_all.shape[1]
-        len_we_subset_all = data_subset_all.shape[2]
-        data_subset_all = data_subset_all.reshape(len_time_subset_all, (len_sn_subset_all * len_we_subset_all))
-
-
-        # compute new indices based on the data_subset_all
-        index_new = []
-        for r in range(0,count-1):
-            ind_sn_orig = sn_ind_all[r]
-            ind_we_orig = we_ind_all[r]
-            index_new.append((ind_sn_orig - min_sn_ind_all)*len_we_subset_all + (ind_we_orig - min_we_ind_all))
-
-        # obtain a new subset of data
-        data_subset_new = data_subset_all[:,index_new]
-
-
-        # start compute inflow
-        len_wt = len(dict_list[self.header_wt[0]])
-        pointer = 0
-        for s in range(0, size_streamID):
-                    npoints = int(dict_list[self.header_wt[4]][pointer])
-                    # Check if all npoints points correspond to the same streamID
-                    if len(set(dict_list[self.header_wt[0]][pointer : (pointer + npoints)])) != 1:
-                          messages.addErrorMessage(self.errorMessages[2])
-                          arcpy.ExecuteError
-
-                    area_sqm_npoints = [float(k) for k in dict_list[self.header_wt[1]][pointer : (pointer + npoints)]]
-                    area_sqm_npoints = NUM.array(area_sqm_npoints)
-                    area_sqm_npoints = area_sqm_npoints.reshape(1, npoints)
-                    data_goal = data_subset_new[:, pointer:(pointer + npoints)]
-
-                    ''''IMPORTANT NOTE: runoff variables in WRF-Hydro dataset is cumulative through time'''
-                    rnoff_stream = NUM.concatenate([data_goal[0:1,],
-                                    NUM.subtract(data_goal[1:,],data_goal[:-1,])]) * area_sqm_npoints
-                    data_temp[:,s] = rnoff_stream.sum(axis = 1)
-
-                    pointer += npoints
-
-
-        '''Write inflow data'''
-        arcpy.AddMessage("Writing inflow data...")
-        var_m3_riv[:] = data_temp
-        # close the input and output netcdf datasets
-        data_in_nc.close()
-        data_out_nc.close()
+        data_out_nc = NET.Dataset(out_nc, "w", format = out_format)
+        var_m3_riv = create_inflow_variable(data_out_nc, streamID, size_time, size_streamID,
+                                            in_complevel)
+
+        # The netCDF library is not thread safe, so the reading thread and the
+        # writing of the inflows take turns to call it, while the summing of the
+        # runoff read and the computing of the inflows run alongside
+        lock_nc = threading.Lock()
+
+        # The runoff in millimeters is converted to meters by the contributing areas
+        weight_matrix_m = weight_matrix.scaled(0.001)
+
+        # Obtain the total runoff in millimeters of the distinct computational grid cells in the weight table
+        def read_runoff(args):
+            in_nc, time_index = args
+            with lock_nc:
+                data_in_nc = NET.Dataset(in_nc)
+            try:
+                with lock_nc:
+                    var_runoff = [data_in_nc.variables[each] for each in self.vars_oi]
+                    single_time = len(var_runoff[0].dimensions) == 2
+                var_runoff = [LockedVariable(each, lock_nc) for each in var_runoff]
+                if single_time:
+                    var_runoff = [SingleTimeVariable(each) for each in var_runoff]
+                return weight_matrix.read_cells_total(var_runoff, time_index)
+            finally:
+                with lock_nc:
+                    data_in_nc.close()
+
+        # The time steps of each file are read in chunks, so that the chunks read ahead
+        # and the chunk being computed all fit within the memory budget
+        if in_memory_budget:
+            in_memory_budget = float(in_memory_budget) / (self.size_read_pool + 1)
+        size_chunk = weight_matrix.time_chunk_size(in_memory_budget, max(list_size_time))
+        list_chunks = [(each, slice(start, start + size_chunk))
+                       for each, size_time_file in zip(list_in_nc, list_size_time)
+                       for start in range(0, size_time_file, size_chunk)]
+
+        ''''IMPORTANT NOTE: runoff variables in WRF-Hydro dataset is cumulative through time'''
+        # Compute the incremental runoff of each cell, then the inflows of all streams at once,
+        # and write the inflow data chunk by chunk as the runoff files are read
+        chunks = iter_read_ahead(read_runoff, list_chunks, self.size_read_pool)
+        try:
+            for start, data_temp in weight_matrix_m.iter_chunk_inflows(chunks):
+                if start == 0:
+                    arcpy.AddMessage("Writing inflow data...")
+                with lock_nc:
+                    var_m3_riv[start:start+len(data_temp)] = data_temp
+        finally:
+            # stop the reading thread before closing the files
+            chunks.close()
+            # close the output netcdf dataset
+            data_out_nc.close()
 
 
         return
\ No newline at end of file
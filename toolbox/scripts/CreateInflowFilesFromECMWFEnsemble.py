@@ -0,0 +1,225 @@
+'''-------------------------------------------------------------------------------
+ Tool Name:   CreateInflowFilesFromECMWFEnsemble
+ Source Name: CreateInflowFilesFromECMWFEnsemble.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: Creates RAPID inflow files for all members of an ECMWF ensemble
+              forecast. The weight table is read and compiled only once, and the
+              inflow files of the members are created on a pool of processes.
+ History:     Initial coding - 10/16/2026, version 1.0
+ Updated:     Version 1.1, 10/16/2026, added the output format and compression level
+-------------------------------------------------------------------------------'''
+import os
+import glob
+import time
+import multiprocessing
+import arcpy
+from CreateInflowFileFromECMWFRunoff import CreateInflowFileFromECMWFRunoff
+from InflowEngine import INFLOW_FORMATS
+from WorkerProcesses import set_worker_executable
+
+# Compiled weight table shared by all the members processed in a worker process
+_member_weight_table = {}
+
+
+def initializeWorker(weight_matrix, streamID):
+    """Keep the compiled weight table in the worker process for all its members"""
+    _member_weight_table['weight_matrix'] = weight_matrix
+    _member_weight_table['streamID'] = streamID
+
+
+def createMemberInflowFile(args):
+    """Create the inflow file of one ensemble member in a worker process
+
+       Returns the input file, the run time in seconds, and the error message if any.
+    """
+    in_nc, out_nc, in_time_interval, in_memory_budget, out_format, in_complevel = args
+    time_start = time.time()
+    try:
+        CreateInflowFileFromECMWFRunoff().createInflowFile(in_nc,
+                                                           _member_weight_table['weight_matrix'],
+                                                           _member_weight_table['streamID'],
+                                                           out_nc, in_time_interval,
+                                                           in_memory_budget, out_format,
+                                                           in_complevel)
+        error = None
+    except Exception as e:
+        error = str(e)
+    return in_nc, time.time() - time_start, error
+
+
+class CreateInflowFilesFromECMWFEnsemble(object):
+    def __init__(self):
+        """Define the tool (tool name is the name of the class)."""
+        self.label = "Create Inflow Files From ECMWF Ensemble"
+        self.description = ("Creates RAPID NetCDF inputs of water inflow for all members of " +
+                            "an ECMWF ensemble forecast based on a previously created weight table.")
+        self.canRunInBackground = False
+        self.errorMessages = ["No ECMWF runoff files match {0} in the input folder",
+                              "Failed to create the inflow file of {0}: {1}"]
+        self.category = "Preprocessing"
+
+    def listMemberFiles(self, in_folder, in_pattern):
+        """List the ECMWF runoff files of the ensemble members in the order of their names"""
+        if not in_pattern:
+            in_pattern = "*.nc"
+        return sorted(glob.glob(os.path.join(in_folder, in_pattern)))
+
+    def getParameterInfo(self):
+        """Define parameter definitions"""
+        param0 = arcpy.Parameter(name = "in_ECMWF_runoff_folder",
+                                 displayName = "Input ECMWF Runoff Folder",
+                                 direction = "Input",
+                                 parameterType = "Required",
+                                 datatype = "DEFolder")
+
+        param1 = arcpy.Parameter(name = "runoff_file_pattern",
+                                 displayName = "Runoff File Pattern",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPString")
+        param1.value = "*.nc"
+
+        param2 = arcpy.Parameter(name = "in_weight_table",
+                                 displayName = "Input Weight Table",
+                                 direction = "Input",
+                                 parameterType = "Required",
+                                 datatype = "DEFile")
+
+        param3 = arcpy.Parameter(name = "out_inflow_folder",
+                                 displayName = "Output Inflow Folder",
+                                 direction = "Input",
+                                 parameterType = "Required",
+                                 datatype = "DEFolder")
+
+        param4 = arcpy.Parameter(name = "time_interval",
+                                 displayName = "Time Interval",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPString")
+        param4.filter.type = "ValueList"
+        param4.filter.list = ["1hr", "3hr", "6hr", "12hr", "24hr"]
+        param4.value = "6hr"
+
+        param5 = arcpy.Parameter(name = "memory_budget",
+                                 displayName = "Memory Budget per Member (MB)",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPLong")
+
+        param6 = arcpy.Parameter(name = "out_format",
+                                 displayName = "Output Format",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPString")
+        param6.filter.type = "ValueList"
+        param6.filter.list = INFLOW_FORMATS
+        param6.value = INFLOW_FORMATS[0]
+
+        param7 = arcpy.Parameter(name = "compression_level",
+                                 displayName = "Compression Level",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPLong")
+        param7.filter.type = "Range"
+        param7.filter.list = [1, 9]
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7]
+
+        return params
+
+    def isLicensed(self):
+        """Set whether tool is licensed to execute."""
+        return True
+
+    def updateParameters(self, parameters):
+        """Modify the values and properties of parameters before internal
+        validation is performed.  This method is called whenever a parameter
+        has been changed."""
+        return
+
+    def updateMessages(self, parameters):
+        """Modify the messages created by internal validation for each tool
+        parameter.  This method is called after internal validation."""
+        if parameters[0].altered and parameters[0].valueAsText is not None:
+            if not self.listMemberFiles(parameters[0].valueAsText, parameters[1].valueAsText):
+                parameters[0].setErrorMessage(self.errorMessages[0].format(parameters[1].valueAsText))
+
+        try:
+            if parameters[2].altered:
+                (dirnm, basenm) = os.path.split(parameters[2].valueAsText)
+                if not basenm.endswith(".csv"):
+                    parameters[2].setErrorMessage("The weight table must be in CSV format")
+        except Exception as e:
+            parameters[2].setErrorMessage(e.message)
+
+        if parameters[5].altered and parameters[5].value is not None:
+            if parameters[5].value <= 0:
+                parameters[5].setErrorMessage("Memory Budget must be a positive number of megabytes")
+
+        if parameters[7].value is not None and parameters[6].valueAsText != "NETCDF4":
+            parameters[7].setErrorMessage("Only the NETCDF4 output format can be compressed")
+
+        return
+
+    def execute(self, parameters, messages):
+        """The source code of the tool."""
+        arcpy.env.overwriteOutput = True
+
+        in_folder = parameters[0].valueAsText
+        in_pattern = parameters[1].valueAsText
+        in_weight_table = parameters[2].valueAsText
+        out_folder = parameters[3].valueAsText
+        in_time_interval = parameters[4].valueAsText
+        in_memory_budget = parameters[5].value
+        out_format = parameters[6].valueAsText or INFLOW_FORMATS[0]
+        in_complevel = parameters[7].value
+
+        list_in_nc = self.listMemberFiles(in_folder, in_pattern)
+        if not list_in_nc:
+            messages.addErrorMessage(self.errorMessages[0].format(in_pattern))
+            raise arcpy.ExecuteError
+
+        ''' Read .csv weight table once for all members '''
+        arcpy.AddMessage("Reading the weight table...")
+        streamID, weight_matrix = CreateInflowFileFromECMWFRunoff().readWeightTable(in_weight_table,
+                                                                                  messages)
+
+        # The inflow file of each member is named after its runoff file
+        list_args = []
+        for in_nc in list_in_nc:
+            (basenm, extension) = os.path.splitext(os.path.basename(in_nc))
+            out_nc = os.path.join(out_folder, "m3_riv_{0}.nc".format(basenm))
+            list_args.append((in_nc, out_nc, in_time_interval, in_memory_budget,
+                              out_format, in_complevel))
+
+        '''Calculate water inflows'''
+        set_worker_executable()
+
+        size_pool = min(multiprocessing.cpu_count(), len(list_args))
+        arcpy.AddMessage("Calculating water inflows of {0} members on {1} processes...".format(
+                         len(list_args), size_pool))
+        time_start = time.time()
+        list_errors = []
+        pool = multiprocessing.Pool(size_pool, initializeWorker, (weight_matrix, streamID))
+        try:
+            for in_nc, time_member, error in pool.imap_unordered(createMemberInflowFile, list_args):
+                if error is None:
+                    arcpy.AddMessage("    {0}: {1:.2f} seconds".format(os.path.basename(in_nc),
+                                                                       time_member))
+                else:
+                    list_errors.append(self.errorMessages[1].format(os.path.basename(in_nc), error))
+        finally:
+            pool.close()
+            pool.join()
+
+        arcpy.AddMessage("Total time: {0:.2f} seconds".format(time.time() - time_start))
+
+        if list_errors:
+            for error in list_errors:
+                messages.addErrorMessage(error)
+            raise arcpy.ExecuteError
+
+        return
@@ -19,11 +19,16 @@
                 the required field names in the input drainage line feature class
               Version 2.0, 02/29/2015 - Used numpy array instead to make program faster
                 (adpated from Alan D. Snow, US Army ERDC)
+              Version 2.1, 10/16/2026, find the upstreams of all the HydroIDs at once by sorting
+                the NextDownIDs instead of scanning the table for each HydroID, write the file in
+                blocks of rows, and added the output compact connectivity file
+              Version 2.1, 10/16/2026, find the upstreams with the river network module
 -------------------------------------------------------------------------------'''
 import os
 import arcpy
 import csv
 import numpy as NUM
+from RiverNetwork import upstream_csr
 
 class CreateNetworkConnectivityFile(object):
     def __init__(self):
@@ -34,6 +39,52 @@ class CreateNetworkConnectivityFile(object):
         self.canRunInBackground = False
         self.category = "Preprocessing"
 
+    def buildConnectivity(self, hydroid, next_down_id):
+        """Find the NextDownID and the upstream HydroIDs of each HydroID in ascending order
+
+           The upstreams of all the HydroIDs are found with one stable sort of the
+           NextDownIDs, in O(N log N) instead of one scan of the table per HydroID.
+           Returns the sorted HydroIDs, their NextDownIDs (of the first reach of each
+           HydroID), and their upstream HydroIDs in CSR form: the upstreams of the
+           k-th HydroID are upstream_id[upstream_offsets[k]:upstream_offsets[k + 1]],
+           in the order of the reaches in the table.
+        """
+        hydroid = NUM.asarray(hydroid)
+        next_down_id = NUM.asarray(next_down_id)
+        order = NUM.argsort(hydroid, kind='mergesort')
+        sorted_id = hydroid[order]
+        sorted_next_down_id = next_down_id[order[NUM.searchsorted(sorted_id, sorted_id, 'left')]]
+        upstream_offsets, upstream = upstream_csr(sorted_id, hydroid, next_down_id)
+        return sorted_id, sorted_next_down_id, upstream_offsets, hydroid[upstream]
+
+    def connectivityRows(self, hydroid, next_down_id, upstream_offsets, upstream_id,
+                         max_nbr_upstreams, size_block=65536):
+        """Rows of the connectivity file in blocks of at most size_block rows
+
+           Each row has the HydroID, the NextDownID, the count of upstream HydroIDs and
+           the upstream HydroIDs, padded with zeros to max_nbr_upstreams; a row with more
+           upstreams keeps all of them. Only one block of rows is held as Python lists.
+        """
+        count_upstream = NUM.diff(upstream_offsets)
+        dtype = NUM.result_type(hydroid, next_down_id)
+        for start in range(0, len(hydroid), size_block):
+            end = min(start + size_block, len(hydroid))
+            count = count_upstream[start:end]
+            size_column = 3 + max(max_nbr_upstreams, int(count.max()))
+            block = NUM.zeros((end - start, size_column), dtype=dtype)
+            block[:, 0] = hydroid[start:end]
+            block[:, 1] = next_down_id[start:end]
+            block[:, 2] = count
+            row = NUM.repeat(NUM.arange(end - start), count)
+            first = upstream_offsets[start]
+            block[row, 3 + NUM.arange(len(row)) - (upstream_offsets[start:end][row] - first)] = \
+                upstream_id[first:upstream_offsets[end]]
+            list_block = block.astype(int).tolist()
+            if size_column > 3 + max_nbr_upstreams:
+                # Rows with more upstreams than the maximum keep all of them
+                list_block = [row_list[:3 + max(row_list[2], max_nbr_upstreams)] for row_list in list_block]
+            yield list_block
+
     def getParameterInfo(self):
         """Define parameter definitions"""
         in_drainage_line = arcpy.Parameter(
@@ -58,9 +109,17 @@ class CreateNetworkConnectivityFile(object):
                     parameterType = 'Optional',
                     direction = 'Input')
 
+        out_compact_csv_file = arcpy.Parameter(
+                    displayName = 'Output Compact Network Connectivity File',
+                    name = 'out_compact_network_connectivity_file',
+                    datatype = 'DEFile',
+                    parameterType = 'Optional',
+                    direction = 'Output')
+
         return [in_drainage_line,
                 out_csv_file,
-                in_max_nbr_upstream]
+                in_max_nbr_upstream,
+                out_compact_csv_file]
 
     def isLicensed(self):
         """Set whether tool is licensed to execute."""
@@ -81,6 +140,12 @@ class CreateNetworkConnectivityFile(object):
                 scratchWorkspace = arcpy.env.scratchGDB
             parameters[1].value = os.path.join(
                 scratchWorkspace, "rapid_connect.csv")
+
+        if parameters[3].altered and parameters[3].valueAsText:
+            (dirnm, basenm) = os.path.split(parameters[3].valueAsText)
+            if not basenm.endswith(".csv"):
+                parameters[3].value = os.path.join(
+                    dirnm, "{}.csv".format(basenm))
         return
 
     def updateMessages(self, parameters):
@@ -109,41 +174,46 @@ class CreateNetworkConnectivityFile(object):
         out_csv_file = parameters[1].valueAsText
         in_max_nbr_upstreams = parameters[2].value
 
+        out_compact_csv_file = parameters[3].valueAsText
+
         fields = ['HydroID', 'NextDownID']
         stream_id = fields[0]
         next_down_id = fields[1]
 
-        list_all = []
-        max_count_Upstream = 0
         '''The script line below makes sure that rows in the output connectivity
            file are arranged in ascending order of HydroIDs of stream segements'''
         np_table = arcpy.da.TableToNumPyArray(in_drainage_line, fields)
-        for hydroid in NUM.sort(np_table[stream_id]):
-            # find the HydroID of the upstreams
-            list_upstreamID = np_table[np_table[next_down_id]==hydroid][stream_id]
-            # count the total number of the upstreams
-            count_upstream = len(list_upstreamID)
-            if count_upstream > max_count_Upstream:
-                max_count_Upstream = count_upstream
-            nextDownID = np_table[np_table[stream_id]==hydroid][next_down_id][0]
+        hydroid, nextDownID, upstream_offsets, upstreamID = self.buildConnectivity(np_table[stream_id],
+                                                                                   np_table[next_down_id])
 #THIS IS REMOVED DUE TO THE FACT THAT THERE CAN BE STREAMS WITH ID OF ZERO
 #        # replace the nextDownID with 0 if it equals to -1 (no next downstream)
 #        if nextDownID == -1:
 #            nextDownID = 0
-             # append the list of Stream HydroID, NextDownID, Count of Upstream ID, and  HydroID of each Upstream into a larger list
-            list_all.append(NUM.concatenate([NUM.array([hydroid,nextDownID,count_upstream]),list_upstreamID]))
+        # count the total number of the upstreams
+        count_upstream = NUM.diff(upstream_offsets)
+        max_count_Upstream = int(count_upstream.max()) if len(count_upstream) else 0
 
         # If the input maximum number of upstreams is none, the actual max number of upstreams is used
         if in_max_nbr_upstreams == None:
             in_max_nbr_upstreams = max_count_Upstream
 
-        with open(out_csv_file,'wb') as csvfile:
+        # The HydroID, NextDownID, count of upstream ID, and HydroID of each upstream of every row,
+        # padded with zeros to the maximum number of upstreams, written block by block
+        csvfile = open(out_csv_file,'wb')
+        compact_csvfile = open(out_compact_csv_file,'wb') if out_compact_csv_file else None
+        try:
             connectwriter = csv.writer(csvfile, dialect='excel')
-
-            for row_list in list_all:
-                out = NUM.concatenate([row_list, NUM.array([0 for i in xrange(in_max_nbr_upstreams - row_list[2])])])
-                connectwriter.writerow(out.astype(int))
-
+            compactwriter = csv.writer(compact_csvfile, dialect='excel') if compact_csvfile else None
+            for list_block in self.connectivityRows(hydroid, nextDownID, upstream_offsets, upstreamID,
+                                                    in_max_nbr_upstreams):
+                connectwriter.writerows(list_block)
+                if compactwriter:
+                    # Each row has only the HydroIDs of its upstreams, whose count is in the third column
+                    compactwriter.writerows(row_list[:3 + row_list[2]] for row_list in list_block)
+        finally:
+            csvfile.close()
+            if compact_csvfile:
+                compact_csvfile.close()
 
         return
 
@@ -12,10 +12,13 @@
               Version 1.1, 10/24/2014 Modified file and tool names
               Version 1.1, 02/19/2015 Enhancement - Added error handling for message updating of
                 input drainage line features
+              Version 1.2, 10/16/2026, added the outlet HydroIDs, whose upstream reaches are
+                written in topological order from the river network
 -------------------------------------------------------------------------------'''
 import os
 import arcpy
 import csv
+from RiverNetwork import RiverNetwork
 
 class CreateSubsetFile(object):
     def __init__(self):
@@ -24,6 +27,8 @@ class CreateSubsetFile(object):
         self.description = "Creates CSV file of HydroID river network subset for RAPID\
         based on the selected features of the input Drainage Line feature class"
         self.canRunInBackground = False
+        self.errorMessages = ["The outlets are not in the input Drainage Line. {0}",
+                              "The input Drainage Line cannot be ordered from upstream to downstream. {0}"]
         self.category = "Preprocessing"
 
     def getParameterInfo(self):
@@ -43,8 +48,17 @@ class CreateSubsetFile(object):
                     parameterType = 'Required',
                     direction = 'Output')
 
+        in_outlets = arcpy.Parameter(
+                    displayName = 'Outlet HydroIDs',
+                    name = 'outlet_hydroids',
+                    datatype = 'GPLong',
+                    parameterType = 'Optional',
+                    direction = 'Input',
+                    multiValue = True)
+
         return [in_drainage_line,
-				out_csv_file]
+				out_csv_file,
+                in_outlets]
 
     def isLicensed(self):
         """Set whether tool is licensed to execute."""
@@ -89,20 +103,39 @@ class CreateSubsetFile(object):
         in_drainage_line = parameters[0].valueAsText
         out_csv_file = parameters[1].valueAsText
 
+        in_outlets = parameters[2].valueAsText
+
         fields = ['NextDownID', 'HydroID']
 
         list_all = []
 
-        '''The script line below makes sure that rows in the subset file are
-           arranged in descending order of NextDownID of stream segements'''
-        for row in sorted(arcpy.da.SearchCursor(in_drainage_line, fields), reverse=True):
-            list_all.append([row[1]])
+        if in_outlets:
+            '''The outlets and all the reaches upstream of them in the whole Drainage Line
+               feature class, arranged in topological order: every stream segment is
+               before its next down stream segment'''
+            np_table = arcpy.da.TableToNumPyArray(arcpy.Describe(in_drainage_line).catalogPath, fields)
+            network = RiverNetwork.from_arrays(np_table['HydroID'], np_table['NextDownID'])
+            try:
+                outlets = network.index([int(each) for each in in_outlets.split(';')])
+            except KeyError as e:
+                messages.addErrorMessage(self.errorMessages[0].format(e.args[0]))
+                raise arcpy.ExecuteError
+            selected = network.upstream_closure(outlets)
+            try:
+                order = network.topological_order(selected)
+            except ValueError as e:
+                messages.addErrorMessage(self.errorMessages[1].format(e))
+                raise arcpy.ExecuteError
+            list_all = [[hydroid] for hydroid in network.ids[order].tolist()]
+        else:
+            '''The script line below makes sure that rows in the subset file are
+               arranged in descending order of NextDownID of stream segements'''
+            for row in sorted(arcpy.da.SearchCursor(in_drainage_line, fields), reverse=True):
+                list_all.append([row[1]])
 
         with open(out_csv_file,'wb') as csvfile:
             connectwriter = csv.writer(csvfile, dialect='excel')
-            for row_list in list_all:
-                out = row_list
-                connectwriter.writerow(out)
+            connectwriter.writerows(list_all)
 
         return
 
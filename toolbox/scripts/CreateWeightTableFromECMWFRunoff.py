@@ -14,12 +14,32 @@
               Version 1.1, 11/07/2014, bug fixing - enables input catchment feature class
                 with spatial reference that is not PCS_WGS_1984.
               Version 2.0, 06/04/2015, integrated Update Weight Table (according to Alan Snow, US Army ERDC)
+              Version 2.1, 10/16/2026, clip the catchments against the grid cells with NumPy
+                instead of creating Thiessen polygons and intersecting them with the catchments
+              Version 2.1, 10/16/2026, look up the grid indices of all intersected polygons at
+                once with a binary search and write the weight table in one bulk write
+              Version 2.2, 10/16/2026, added the grid cache folder, from which the computational
+                grid polygons are read instead of creating Thiessen polygons
+              Version 2.2, 10/16/2026, clip the catchments against the grid cells in tiles of
+                catchments on a pool of processes
+              Version 2.2, 10/16/2026, calculate the geodesic areas of all the intersected polygons
+                at once with NumPy instead of adding the geometry attributes feature by feature
+              Version 2.3, 10/16/2026, added the previous weight table, which is updated by
+                intersecting only the catchment features that changed since it was created
+              Version 2.4, 10/16/2026, added the finer ECMWF runoff file and weight table, from
+                which the weight table is aggregated if the cells of the finer grid nest in the grid
 -------------------------------------------------------------------------------'''
 import os
+import multiprocessing
 import arcpy
 import netCDF4 as NET
 import numpy as NUM
 import csv
+from WeightTableEngine import LatLonGrid, parse_wkb, weight_table_pieces, write_weight_table, \
+                              intersect_catchments_tiled, feature_areas, intersect_catchment_features, \
+                              write_catchment_hashes, catchment_hashes_path, read_weight_table_pieces
+from GridCellCache import GridCellCache
+from WorkerProcesses import set_worker_executable
 
 class CreateWeightTableFromECMWFRunoff(object):
     def __init__(self):
@@ -37,7 +57,14 @@ class CreateWeightTableFromECMWFRunoff(object):
                         ["lon", "lat"],
                         ["longitude", "latitude"]]
         self.errorMessages = ["Incorrect dimensions in the input ECMWF runoff file.",
-                              "Incorrect variables in the input ECMWF runoff file."]
+                              "Incorrect variables in the input ECMWF runoff file.",
+                              "The catchment features do not intersect the computational grid.",
+                              "The computational grid points do not match the grid of the ECMWF runoff file: {0}",
+                              "Only the Grid Cells intersection method can update a previous weight table",
+                              "The previous weight table has no geometry hashes, all the catchment features are intersected",
+                              "The grid of the finer ECMWF runoff file does not nest in the grid of the ECMWF runoff file, the catchment features are intersected",
+                              "Both the finer ECMWF runoff file and its weight table are needed to aggregate the weight table"]
+        self.intersectionMethods = ["Grid Cells", "Thiessen Polygons"]
         self.category = "Preprocessing"
 
     def dataValidation(self, in_nc, messages):
@@ -56,6 +83,25 @@ class CreateWeightTableFromECMWFRunoff(object):
 
         return
 
+    def readLonLat(self, in_nc):
+        """Read the longitudes in [-180, 180] and the latitudes of the ECMWF runoff file"""
+        data_nc = NET.Dataset(in_nc)
+
+        # Obtain geographic coordinates
+        variables_list = data_nc.variables.keys()
+        lat_var = 'lat'
+        if 'latitude' in variables_list:
+            lat_var = 'latitude'
+        lon_var = 'lon'
+        if 'longitude' in variables_list:
+            lon_var = 'longitude'
+        lon = (data_nc.variables[lon_var][:] + 180) % 360 - 180 # convert [0, 360] to [-180, 180]
+        lat = data_nc.variables[lat_var][:]
+
+        data_nc.close()
+
+        return lon, lat
+
     def createPolygon(self, lat, lon, extent, out_polygons, scratchWorkspace):
         """Create a Thiessen polygon feature class from numpy.ndarray lat and lon
            Each polygon represents the area described by the center point
@@ -89,6 +135,35 @@ class CreateWeightTableFromECMWFRunoff(object):
 
         return out_points, out_polygons
 
+    def createCellPolygons(self, cells, out_polygons, out_points=None):
+        """Create the polygon feature class of the grid cells read from the grid cell cache
+           The longitude and latitude of the grid point of each cell are in POINT_X and
+           POINT_Y, as in the Thiessen polygons. The grid points are created in out_points
+           if it is specified.
+        """
+        center_x, center_y, corners = cells[2:]
+        # Spatial reference: GCS_WGS_1984
+        sr = arcpy.SpatialReference(4326)
+        outputs = [(out_polygons, "POLYGON")]
+        if out_points:
+            outputs.append((out_points, "POINT"))
+        for out_fc, geometry_type in outputs:
+            (dirnm, basenm) = os.path.split(out_fc)
+            arcpy.CreateFeatureclass_management(dirnm, basenm, geometry_type, spatial_reference = sr)
+            arcpy.AddField_management(out_fc, 'POINT_X', 'DOUBLE')
+            arcpy.AddField_management(out_fc, 'POINT_Y', 'DOUBLE')
+
+        with arcpy.da.InsertCursor(out_polygons, ['SHAPE@', 'POINT_X', 'POINT_Y']) as cursor:
+            for corners_each, x, y in zip(corners.tolist(), center_x.tolist(), center_y.tolist()):
+                polygon = arcpy.Polygon(arcpy.Array([arcpy.Point(*each) for each in corners_each]), sr)
+                cursor.insertRow([polygon, x, y])
+        if out_points:
+            with arcpy.da.InsertCursor(out_points, ['SHAPE@XY', 'POINT_X', 'POINT_Y']) as cursor:
+                for x, y in zip(center_x.tolist(), center_y.tolist()):
+                    cursor.insertRow([(x, y), x, y])
+
+        return out_points, out_polygons
+
     def csvToList(self, csv_file, delimiter=','):
         """
         Reads in a CSV file and returns the contents as list,
@@ -152,7 +227,41 @@ class CreateWeightTableFromECMWFRunoff(object):
                                  datatype = "DEFeatureClass")
 
 
-        params = [param0, param1, param2, param3, param4, param5, param6]
+        param7 = arcpy.Parameter(name = "intersection_method",
+                                 displayName = "Intersection Method",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "GPString")
+        param7.filter.type = "ValueList"
+        param7.filter.list = self.intersectionMethods
+        param7.value = self.intersectionMethods[0]
+
+        param8 = arcpy.Parameter(name = "grid_cache_folder",
+                                 displayName = "Grid Cache Folder",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "DEFolder")
+
+        param9 = arcpy.Parameter(name = "in_previous_weight_table",
+                                 displayName = "Previous Weight Table",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "DEFile")
+
+        param10 = arcpy.Parameter(name = "in_fine_ECMWF_runoff_file",
+                                  displayName = "Input Finer ECMWF Runoff File",
+                                  direction = "Input",
+                                  parameterType = "Optional",
+                                  datatype = "DEFile")
+
+        param11 = arcpy.Parameter(name = "in_fine_weight_table",
+                                  displayName = "Input Finer Weight Table",
+                                  direction = "Input",
+                                  parameterType = "Optional",
+                                  datatype = "DEFile")
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9,
+                  param10, param11]
 
         return params
 
@@ -188,11 +297,16 @@ class CreateWeightTableFromECMWFRunoff(object):
                 data_nc.close()
             except Exception as e:
                 parameters[0].setErrorMessage(e.message)
-        return
 
-    def find_nearest(self, array, value):
-        """Gets value in array closest to the value searching for"""
-        return (NUM.abs(array-value)).argmin()
+        if parameters[9].valueAsText is not None and parameters[7].valueAsText == self.intersectionMethods[1]:
+            parameters[9].setErrorMessage(self.errorMessages[4])
+
+        if (parameters[10].valueAsText is None) != (parameters[11].valueAsText is None):
+            if parameters[10].valueAsText is None:
+                parameters[10].setErrorMessage(self.errorMessages[7])
+            else:
+                parameters[11].setErrorMessage(self.errorMessages[7])
+        return
 
     def execute(self, parameters, messages):
         """The source code of the tool."""
@@ -209,25 +323,16 @@ class CreateWeightTableFromECMWFRunoff(object):
         out_WeightTable = parameters[4].valueAsText
         out_CGPolygon = parameters[5].valueAsText
         out_CGPoint = parameters[6].valueAsText
+        intersection_method = parameters[7].valueAsText or self.intersectionMethods[0]
+        use_thiessen = intersection_method == self.intersectionMethods[1]
+        in_cache_folder = parameters[8].valueAsText
+        in_previous_table = parameters[9].valueAsText
+        in_fine_nc = parameters[10].valueAsText
+        in_fine_table = parameters[11].valueAsText
 
         # validate the netcdf dataset
         self.dataValidation(in_nc, messages)
 
-        # Obtain catchment extent in lat and lon in GCS_WGS_1984
-        sr_cat = arcpy.Describe(in_catchment).SpatialReference
-        extent = arcpy.Describe(in_catchment).extent
-        if (sr_cat.name == 'GCS_WGS_1984'):
-            extent = extent
-        else:
-            envelope = os.path.join(scratchWorkspace, 'envelope')
-            result0 = arcpy.MinimumBoundingGeometry_management(in_catchment, envelope, 'ENVELOPE', 'ALL')
-            envelope = result0.getOutput(0)
-            sr_out = arcpy.SpatialReference(4326)  # 'GCS_WGS_1984'
-            envelope_proj = os.path.join(scratchWorkspace,'envelope_proj')
-            result1 = arcpy.Project_management(envelope, envelope_proj, sr_out)
-            envelope_proj = result1.getOutput(0)
-            extent = arcpy.Describe(envelope_proj).extent
-
 
         #Open nc file
         """ Variables in the netcdf file 1-51
@@ -242,34 +347,104 @@ class CreateWeightTableFromECMWFRunoff(object):
             RO (Geo2D): runoff (3 dimensions)
             time (1D): 0 to 240 (0 to 90 by 1, 90 to 144 by 3, 144 to 240 by 6) (Size: 125)
         """
+        lon, lat = self.readLonLat(in_nc)
 
-        data_nc = NET.Dataset(in_nc)
-
-        # Obtain geographic coordinates
-        variables_list = data_nc.variables.keys()
-        lat_var = 'lat'
-        if 'latitude' in variables_list:
-            lat_var = 'latitude'
-        lon_var = 'lon'
-        if 'longitude' in variables_list:
-            lon_var = 'longitude'
-        lon = (data_nc.variables[lon_var][:] + 180) % 360 - 180 # convert [0, 360] to [-180, 180]
-        lat = data_nc.variables[lat_var][:]
-
-        data_nc.close()
-
-        # Create Thiessen polygons based on the points within the extent
-        arcpy.AddMessage("Generating Thiessen polygons...")
-        polygon_thiessen = os.path.join(scratchWorkspace,'polygon_thiessen')
-        result4 = self.createPolygon(lat, lon, extent, polygon_thiessen, scratchWorkspace)
-        polygon_thiessen = result4[1]
-
+        # Get list of COMIDs in rapid_connect file so only those area included in computations
+        connectivity_table = self.csvToList(in_rapid_connect_file)
+        streamID_unique_list = [int(row[0]) for row in connectivity_table]
 
-        # Output Thiessen polygons (computational grid polygons) and CG points if they are specified.
-        if out_CGPolygon and out_CGPolygon != polygon_thiessen:
-            arcpy.CopyFeatures_management(polygon_thiessen, out_CGPolygon)
-        if out_CGPoint and out_CGPoint != result4[0]:
-            arcpy.CopyFeatures_management(result4[0], out_CGPoint)
+        # The pieces of the catchments in the cells of a finer grid (e.g. HighRes in LowRes) are
+        # summed by the cells of the grid that contain them, if the cells of the finer grid nest
+        pieces_aggregated = None
+        if in_fine_nc and in_fine_table:
+            self.dataValidation(in_fine_nc, messages)
+            grid = LatLonGrid(lon, lat)
+            positions = grid.nested_positions(LatLonGrid(*self.readLonLat(in_fine_nc)))
+            if positions is None:
+                arcpy.AddWarning(self.errorMessages[6])
+            else:
+                arcpy.AddMessage("Aggregating the weight table of the finer grid...")
+                pieces_aggregated = grid.aggregate_pieces(read_weight_table_pieces(in_fine_table),
+                                                          *positions)
+
+        # The Thiessen polygons are only needed for the Thiessen method and to output the computational grid
+        if (use_thiessen and pieces_aggregated is None) or out_CGPolygon or out_CGPoint:
+            # Obtain catchment extent in lat and lon in GCS_WGS_1984
+            sr_cat = arcpy.Describe(in_catchment).SpatialReference
+            extent = arcpy.Describe(in_catchment).extent
+            if (sr_cat.name == 'GCS_WGS_1984'):
+                extent = extent
+            else:
+                envelope = os.path.join(scratchWorkspace, 'envelope')
+                result0 = arcpy.MinimumBoundingGeometry_management(in_catchment, envelope, 'ENVELOPE', 'ALL')
+                envelope = result0.getOutput(0)
+                sr_out = arcpy.SpatialReference(4326)  # 'GCS_WGS_1984'
+                envelope_proj = os.path.join(scratchWorkspace,'envelope_proj')
+                result1 = arcpy.Project_management(envelope, envelope_proj, sr_out)
+                envelope_proj = result1.getOutput(0)
+                extent = arcpy.Describe(envelope_proj).extent
+
+            polygon_thiessen = os.path.join(scratchWorkspace,'polygon_thiessen')
+            if in_cache_folder:
+                # The Thiessen polygons of the grid points are the cells of the grid, which are
+                # read from the tiles of the grid cell cache that overlap the buffered extent
+                arcpy.AddMessage("Reading the computational grid polygons from the grid cache...")
+                cells = GridCellCache(in_cache_folder, LatLonGrid(lon, lat)).cells_near(
+                            [extent.XMin, extent.XMax], [extent.YMin, extent.YMax], 2)
+                points_subset = os.path.join(scratchWorkspace, 'points_subset') if out_CGPoint else None
+                result4 = self.createCellPolygons(cells, polygon_thiessen, points_subset)
+            else:
+                # Create Thiessen polygons based on the points within the extent
+                arcpy.AddMessage("Generating Thiessen polygons...")
+                result4 = self.createPolygon(lat, lon, extent, polygon_thiessen, scratchWorkspace)
+            polygon_thiessen = result4[1]
+
+            # Output Thiessen polygons (computational grid polygons) and CG points if they are specified.
+            if out_CGPolygon and out_CGPolygon != polygon_thiessen:
+                arcpy.CopyFeatures_management(polygon_thiessen, out_CGPolygon)
+            if out_CGPoint and out_CGPoint != result4[0]:
+                arcpy.CopyFeatures_management(result4[0], out_CGPoint)
+
+        if pieces_aggregated is not None:
+            if len(pieces_aggregated) == 0:
+                messages.addErrorMessage(self.errorMessages[2])
+                raise arcpy.ExecuteError
+
+            arcpy.AddMessage("Writing the weight table...")
+            write_weight_table(out_WeightTable, streamID, streamID_unique_list, pieces_aggregated)
+            # The pieces of each catchment feature are not known, so that an update of this
+            # weight table intersects all the features
+            if os.path.exists(catchment_hashes_path(out_WeightTable)):
+                os.remove(catchment_hashes_path(out_WeightTable))
+            return
+
+        if not use_thiessen:
+            # Clip the catchments in GCS_WGS_1984 against the cells of the grid,
+            # which are the Thiessen polygons of the grid points
+            arcpy.AddMessage("Intersecting the computational grid with catchment...")
+            grid = LatLonGrid(lon, lat)
+            sr_wgs84 = arcpy.SpatialReference(4326)
+            with arcpy.da.SearchCursor(in_catchment, [streamID, 'SHAPE@WKB'],
+                                       spatial_reference = sr_wgs84) as cursor:
+                features = [(row[0], row[1]) for row in cursor if row[1] is not None]
+            if in_previous_table and not os.path.exists(catchment_hashes_path(in_previous_table)):
+                arcpy.AddWarning(self.errorMessages[5])
+            # Clip the catchments in tiles on a pool of processes, only those that changed
+            # since the previous weight table if it is specified
+            set_worker_executable()
+            pieces, hashes, npieces, size_intersected = intersect_catchment_features(
+                grid, features, in_previous_table, multiprocessing.cpu_count())
+            if in_previous_table:
+                arcpy.AddMessage("Intersected {0} of {1} catchment features".format(size_intersected,
+                                                                                  len(features)))
+            if len(pieces) == 0:
+                messages.addErrorMessage(self.errorMessages[2])
+                raise arcpy.ExecuteError
+
+            arcpy.AddMessage("Writing the weight table...")
+            write_weight_table(out_WeightTable, streamID, streamID_unique_list, pieces)
+            write_catchment_hashes(out_WeightTable, [each[0] for each in features], hashes, npieces)
+            return
 
 
         # Intersect the catchment polygons with the Thiessen polygons
@@ -278,86 +453,32 @@ class CreateWeightTableFromECMWFRunoff(object):
         result5 = arcpy.Intersect_analysis([in_catchment, polygon_thiessen], intersect, 'ALL', '#', 'INPUT')
         intersect = result5.getOutput(0)
 
-        # Calculate the geodesic area in square meters for each intersected polygon (no need to project if it's not projected yet)
+        # Calculate the geodesic area in square meters of all the intersected polygons at once,
+        # from their vertices in GCS_WGS_1984
         arcpy.AddMessage("Calculating geodesic areas...")
-        arcpy.AddGeometryAttributes_management(intersect, 'AREA_GEODESIC', '', 'SQUARE_METERS', '')
+        fields = [streamID, 'POINT_X', 'POINT_Y', 'SHAPE@WKB']
+        with arcpy.da.SearchCursor(intersect, fields, spatial_reference = arcpy.SpatialReference(4326)) as cursor:
+            rows = [row for row in cursor if row[3] is not None]
+        area_arr = {streamID: NUM.array([row[0] for row in rows], dtype=NUM.int64),
+                    'POINT_X': NUM.array([row[1] for row in rows], dtype=NUM.float64),
+                    'POINT_Y': NUM.array([row[2] for row in rows], dtype=NUM.float64),
+                    'AREA_GEO': feature_areas([parse_wkb(row[3]) for row in rows])}
+
+        if len(area_arr['AREA_GEO']) == 0:
+            messages.addErrorMessage(self.errorMessages[2])
+            raise arcpy.ExecuteError
 
-        # Calculate the total geodesic area of each catchment based on the contributing areas of points
-        fields = [streamID, 'POINT_X', 'POINT_Y', 'AREA_GEO']
-        area_arr = arcpy.da.FeatureClassToNumPyArray(intersect, fields)
+        # Look up the lon and lat indices of the grid points of all intersected polygons
+        grid = LatLonGrid(lon, lat)
+        try:
+            index_lon, index_lat = grid.point_indices(area_arr['POINT_X'], area_arr['POINT_Y'])
+        except ValueError as e:
+            messages.addErrorMessage(self.errorMessages[3].format(e))
+            raise arcpy.ExecuteError
 
         arcpy.AddMessage("Writing the weight table...")
-        # Get list of COMIDs in rapid_connect file so only those area included in computations
-        connectivity_table = self.csvToList(in_rapid_connect_file)
-        streamID_unique_list = [int(row[0]) for row in connectivity_table]
-
-        #if point not in array append dummy data for one point of data
-        lon_dummy = area_arr['POINT_X'][0]
-        lat_dummy = area_arr['POINT_Y'][0]
-        try:
-            index_lon_dummy = int(NUM.where(lon == lon_dummy)[0])
-        except TypeError as ex:
-            #This happens when near meridian - lon_dummy ~ 0
-            #arcpy.AddMessage("GRIDID: %s" % streamID_unique)
-            #arcpy.AddMessage("Old Lon: %s" % lon_dummy)
-            index_lon_dummy = int(self.find_nearest(lon, lon_dummy))
-            #arcpy.AddMessage("Lon Index: %s" % index_lon_dummy)
-            #arcpy.AddMessage("Lon Val: %s" % lon[index_lon_dummy])
-            pass
+        pieces = weight_table_pieces(area_arr[streamID], area_arr['AREA_GEO'], index_lon, index_lat,
+                                     area_arr['POINT_X'], area_arr['POINT_Y'])
+        write_weight_table(out_WeightTable, streamID, streamID_unique_list, pieces)
 
-        try:
-            index_lat_dummy= int(NUM.where(lat == lat_dummy)[0])
-        except TypeError as ex:
-            #This happens when near equator - lat_dummy ~ 0
-            #arcpy.AddMessage("GRIDID: %s" % streamID_unique)
-            #arcpy.AddMessage("Old Lat: %s" % lat_dummy)
-            index_lat_dummy = int(self.find_nearest(lat, lat_dummy))
-            #arcpy.AddMessage("Lat Index: %s" % index_lat_dummy)
-            #arcpy.AddMessage("Lat Val: %s" % lat[index_lat_dummy])
-            pass
-
-        # Output the weight table
-        with open(out_WeightTable, 'wb') as csvfile:
-            connectwriter = csv.writer(csvfile, dialect = 'excel')
-            #header
-            connectwriter.writerow([streamID, 'area_sqm', 'lon_index', 'lat_index',
-                                    'npoints', 'lon', 'lat'])
-
-            for streamID_unique in streamID_unique_list:
-                ind_points = NUM.where(area_arr[streamID]==streamID_unique)[0]
-                num_ind_points = len(ind_points)
-
-                if num_ind_points <= 0:
-                    # if point not in array, append dummy data for one point of data
-                    # streamID, area_sqm, lon_index, lat_index, npoints
-                    connectwriter.writerow([streamID_unique, 0, index_lon_dummy, index_lat_dummy,
-                                            1, lon_dummy, lat_dummy])
-                else:
-                    for ind_point in ind_points:
-                        area_geo_each = float(area_arr['AREA_GEO'][ind_point])
-                        lon_each = area_arr['POINT_X'][ind_point]
-                        lat_each = area_arr['POINT_Y'][ind_point]
-                        try:
-                            index_lon_each = int(NUM.where(lon == lon_each)[0])
-                        except TypeError as ex:
-                            #This happens when near meridian - lon_each ~ 0
-                            index_lon_each = int(self.find_nearest(lon, lon_each))
-                            #arcpy.AddMessage("GRIDID: %s" % streamID_unique)
-                            #arcpy.AddMessage("Old Lon: %s" % lon_each)
-                            #arcpy.AddMessage("Lon Index: %s" % index_lon_each)
-                            #arcpy.AddMessage("Lon Val: %s" % lon[index_lon_each])
-                            pass
-
-                        try:
-                            index_lat_each = int(NUM.where(lat == lat_each)[0])
-                        except TypeError as ex:
-                            #This happens when near equator - lat_each ~ 0
-                            index_lat_each = int(self.find_nearest(lat, lat_each))
-                            #arcpy.AddMessage("GRIDID: %s" % streamID_unique)
-                            #arcpy.AddMessage("Old Lat: %s" % lat_each)
-                            #arcpy.AddMessage("Lat Index: %s" % index_lat_each)
-                            #arcpy.AddMessage("Lat Val: %s" % lat[index_lat_each])
-                            pass
-                        connectwriter.writerow([streamID_unique, area_geo_each, index_lon_each, index_lat_each,
-                                                num_ind_points, lon_each, lat_each])
         return
@@ -6,7 +6,8 @@
  Author:      Environmental Systems Research Institute Inc.
  Updated by:  Environmental Systems Research Institute Inc.
  Description: Creates the computation grid polygon feature class within the buffered
-              extent of the input catchment based on the WRF_Hydro GeoGrid netcdf data
+              extent of the input catchment based on the WRF_Hydro GeoGrid netcdf data,
+              and the weight table of the catchments
  History:     Initial coding - 10/10/2014, version 1.0
  Updated:     Version 1.0, 10/23/2014, modified names of tool and parameters
               Version 1.0, 10/28/2014, added data validation
@@ -20,12 +21,34 @@
               Version 2.1, 02/26/2016, fixed the bug of writing total area instead of individual
                 area in the weight table, pulled the table writing out of the for loop for
                 calculation, these changes were adapted from Alan D Snow, US Army ERDC
+              Version 2.2, 10/16/2026, group the intersected polygons by stream ID with one
+                stable sort instead of searching them for every stream ID
+              Version 2.2, 10/16/2026, compute the WRF map projection with NumPy and create the
+                computation grid polygons of the buffered catchment extent in memory instead
+                of the ones raster, buffered envelope raster and fishnet in the scratch workspace;
+                polar stereographic grids use the polar stereographic projection of WRF
+              Version 2.3, 10/16/2026, added the grid cache folder, from which the computation
+                grid polygons are read instead of creating them for every run
+              Version 2.3, 10/16/2026, clip the catchments against the grid cells near them with
+                NumPy, in tiles of catchments on a pool of processes, instead of intersecting all
+                the catchments with the computation grid polygons
+              Version 2.3, 10/16/2026, added the previous weight table, which is updated by
+                intersecting only the catchment features that changed since it was created
+              Version 2.4, 10/16/2026, compute the rows of the weight table as arrays and write
+                them at once, reading only the latitudes and longitudes of the cells near the
+                catchments
 -------------------------------------------------------------------------------'''
-import os, math
+import os
+import multiprocessing
 import arcpy
 import netCDF4 as NET
 import numpy as NUM
 import csv
+from WeightTableEngine import weight_table_rows, parse_wkb, intersect_catchment_features, \
+                              write_catchment_hashes, catchment_hashes_path
+from WRFProjection import WRFProjection, PROJECTION_ATTRIBUTES
+from GridCellCache import GridCellCache
+from WorkerProcesses import set_worker_executable
 
 
 class CreateWeightTableFromWRFGeogrid(object):
@@ -36,13 +59,13 @@ class CreateWeightTableFromWRFGeogrid(object):
                             " and catchment features")
         self.canRunInBackground = False
         self.dimensions = ["west_east", "south_north"]
-        self.globalattributes = ["MAP_PROJ", "corner_lats", "corner_lons", "DX", "DY",
-                                 "TRUELAT1", "TRUELAT2", "STAND_LON", "POLE_LAT",
-                                 "POLE_LON", "CEN_LAT"]
+        self.globalattributes = PROJECTION_ATTRIBUTES
         self.errorMessages = [  "Map Projection is incorrect in the input WRF geogrid file.",
                                 "Missing dimension: {0} in the input WRF geogrid file.",
-                                "Missing global attribute: {0} in the input WRF geogrid file."
-                                "The input catchment features exceed the WRF Geogrid data extent."]
+                                "Missing global attribute: {0} in the input WRF geogrid file.",
+                                "The input catchment features exceed the WRF Geogrid data extent.",
+                                "The catchment features do not intersect the computational grid.",
+                                "The previous weight table has no geometry hashes, all the catchment features are intersected."]
         self.category = "Preprocessing"
 
     def dataValidation(self, in_nc, messages):
@@ -122,7 +145,19 @@ class CreateWeightTableFromWRFGeogrid(object):
                                  parameterType = "Optional",
                                  datatype = "DEFeatureClass")
 
-        params = [param0, param1, param2, param3, param4, param5, param6]
+        param7 = arcpy.Parameter(name = "grid_cache_folder",
+                                 displayName = "Grid Cache Folder",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "DEFolder")
+
+        param8 = arcpy.Parameter(name = "in_previous_weight_table",
+                                 displayName = "Previous Weight Table",
+                                 direction = "Input",
+                                 parameterType = "Optional",
+                                 datatype = "DEFile")
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8]
 
         return params
 
@@ -164,10 +199,6 @@ class CreateWeightTableFromWRFGeogrid(object):
 
         arcpy.env.overwriteOutput = True
 
-        scratchWorkspace = arcpy.env.scratchWorkspace
-        if not scratchWorkspace:
-            scratchWorkspace = arcpy.env.scratchGDB
-
         in_nc = parameters[0].valueAsText
         in_rapid_connect_file = parameters[1].valueAsText
         in_catchment = parameters[2].valueAsText
@@ -175,6 +206,8 @@ class CreateWeightTableFromWRFGeogrid(object):
         out_WeightTable = parameters[4].valueAsText
         out_CGPolygon = parameters[5].valueAsText
         out_CGPoint = parameters[6].valueAsText
+        in_cache_folder = parameters[7].valueAsText
+        in_previous_table = parameters[8].valueAsText
 
         # validate the netcdf dataset
         self.dataValidation(in_nc, messages)
@@ -182,293 +215,128 @@ class CreateWeightTableFromWRFGeogrid(object):
         # open netcdf dataset
         data_nc = NET.Dataset(in_nc)
 
-
-        '''Obtain west-east, south-north dimension information'''
-        name_xdim = 'west_east'
-        name_ydim = 'south_north'
-        size_xdim = len(data_nc.dimensions['west_east'])
-        size_ydim = len(data_nc.dimensions['south_north'])
-
-
-
-        #####################Start of script adaption###############################################################
         '''Obtain projection information'''
-        map_proj = data_nc.__dict__['MAP_PROJ']
-
-        # read projection information from global attributes
-        corner_lats = data_nc.__dict__['corner_lats']
-        corner_lons = data_nc.__dict__['corner_lons']
-        DX = data_nc.__dict__['DX']
-        DY = data_nc.__dict__['DY']
-        standard_parallel_1 = data_nc.__dict__['TRUELAT1']
-        standard_parallel_2 = data_nc.__dict__['TRUELAT2']
-        central_meridian = data_nc.__dict__['STAND_LON']
-        pole_latitude = data_nc.__dict__['POLE_LAT']
-        pole_longitude = data_nc.__dict__['POLE_LON']
-        latitude_of_origin = data_nc.__dict__['CEN_LAT']
-
-        # Create Projection file with information from NetCDF global attributes
+        try:
+            projection = WRFProjection.from_dataset(data_nc)
+        except ValueError:
+            messages.addErrorMessage(self.errorMessages[0])
+            raise arcpy.ExecuteError
+        if projection.rotated_pole:
+            arcpy.AddWarning("The rotated pole of the cylindrical equidistant projection is not applied.")
+
+        # Projected coordinate system of the WRF grid
         sr2 = arcpy.SpatialReference()
-        if map_proj == 1:
-            # Lambert Conformal Conic
-            if 'standard_parallel_2' in locals():
-                arcpy.AddMessage('    Using Standard Parallel 2 in Lambert Conformal Conic map projection.')
-            else:
-                # According to http://webhelp.esri.com/arcgisdesktop/9.2/index.cfm?TopicName=Lambert_Conformal_Conic
-                standard_parallel_2 = standard_parallel_1
-                latitude_of_origin = standard_parallel_1
-            Projection_String = ('PROJCS["North_America_Lambert_Conformal_Conic",'
-                                 'GEOGCS["GCS_Sphere",'
-                                 'DATUM["D_Sphere",SPHEROID["Sphere",6370000.0,0.0]],'
-                                 'PRIMEM["Greenwich",0.0],'
-                                 'UNIT["Degree",0.0174532925199433]],'
-                                 'PROJECTION["Lambert_Conformal_Conic"],'
-                                 'PARAMETER["false_easting",0.0],'
-                                 'PARAMETER["false_northing",0.0],'
-                                 'PARAMETER["central_meridian",' + str(central_meridian) + '],'
-                                 'PARAMETER["standard_parallel_1",' + str(standard_parallel_1) + '],'
-                                 'PARAMETER["standard_parallel_2",' + str(standard_parallel_2) + '],'
-                                 'PARAMETER["latitude_of_origin",' + str(latitude_of_origin) + '],'
-                                 'UNIT["Meter",1.0]]')
-
-        elif map_proj == 2:
-            # Polar Stereographic
-
-            # Set up pole latitude
-            phi1 = float(standard_parallel_1)
-
-            ### Back out the central_scale_factor (minimum scale factor?) using formula below using Snyder 1987 p.157 (USGS Paper 1395)
-            ##phi = math.copysign(float(pole_latitude), float(latitude_of_origin))    # Get the sign right for the pole using sign of CEN_LAT (latitude_of_origin)
-            ##central_scale_factor = (1 + (math.sin(math.radians(phi1))*math.sin(math.radians(phi))) + (math.cos(math.radians(float(phi1)))*math.cos(math.radians(phi))))/2
-
-            # Method where central scale factor is k0, Derivation from C. Rollins 2011, equation 1: http://earth-info.nga.mil/GandG/coordsys/polar_stereographic/Polar_Stereo_phi1_from_k0_memo.pdf
-            # Using Rollins 2011 to perform central scale factor calculations. For a sphere, the equation collapses to be much  more compact (e=0, k90=1)
-            central_scale_factor = (1 + math.sin(math.radians(abs(phi1))))/2                            # Equation for k0, assumes k90 = 1, e=0. This is a sphere, so no flattening
-
-            loglines.append('      Central Scale Factor: %s' %central_scale_factor)
-            arcpy.AddMessage(loglines[-1])
-            Projection_String = ('PROJCS["Sphere_Stereographic",'
-                                 'GEOGCS["GCS_Sphere",'
-                                 'DATUM["D_Sphere",'
-                                 'SPHEROID["Sphere",6370000.0,0.0]],'
-                                 'PRIMEM["Greenwich",0.0],'
-                                 'UNIT["Degree",0.0174532925199433]],'
-                                 'PROJECTION["Stereographic"],'
-                                 'PARAMETER["False_Easting",0.0],'
-                                 'PARAMETER["False_Northing",0.0],'
-                                 'PARAMETER["Central_Meridian",' + str(central_meridian) + '],'
-                                 'PARAMETER["Scale_Factor",' + str(central_scale_factor) + '],'
-                                 'PARAMETER["Latitude_Of_Origin",' + str(standard_parallel_1) + '],'
-                                 'UNIT["Meter",1.0]]')
-
-        elif map_proj == 3:
-            # Mercator Projection
-            Projection_String = ('PROJCS["Sphere_Mercator",'
-                                 'GEOGCS["GCS_Sphere",'
-                                 'DATUM["D_Sphere",'
-                                 'SPHEROID["Sphere",6370000.0,0.0]],'
-                                 'PRIMEM["Greenwich",0.0],'
-                                 'UNIT["Degree",0.0174532925199433]],'
-                                 'PROJECTION["Mercator"],'
-                                 'PARAMETER["False_Easting",0.0],'
-                                 'PARAMETER["False_Northing",0.0],'
-                                 'PARAMETER["Central_Meridian",' + str(central_meridian) + '],'
-                                 'PARAMETER["Standard_Parallel_1",' + str(standard_parallel_1) + '],'
-                                 'UNIT["Meter",1.0],AUTHORITY["ESRI",53004]]')
-
-        elif map_proj == 6:
-            # Cylindrical Equidistant (or Rotated Pole)
-            # Check units (linear unit not used in this projection).  GCS?
-            Projection_String = ('PROJCS["Sphere_Equidistant_Cylindrical",'
-                                 'GEOGCS["GCS_Sphere",'
-                                 'DATUM["D_Sphere",'
-                                 'SPHEROID["Sphere",6370000.0,0.0]],'
-                                 'PRIMEM["Greenwich",0.0],'
-                                 'UNIT["Degree",0.0174532925199433]],'
-                                 'PROJECTION["Equidistant_Cylindrical"],'
-                                 'PARAMETER["False_Easting",0.0],'
-                                 'PARAMETER["False_Northing",0.0],'
-                                 'PARAMETER["Central_Meridian",' + str(central_meridian) + '],'
-                                 'PARAMETER["Standard_Parallel_1",' + str(standard_parallel_1) + '],'
-                                 'UNIT["Meter",1.0],AUTHORITY["ESRI",53002]]')
-
-        sr2.loadFromString(Projection_String)
-
-
-        '''Create a projected ones raster'''
-        arr_ones = NUM.ones((size_ydim, size_xdim), dtype = NUM.uint16)
-
-        #####################Start of script adaption###############################################################
-        # Create a point geometry object from gathered corner point data
-        sr1 = arcpy.SpatialReference(104128)            # Using EMEP Sphere (6370000m)
-        point = arcpy.Point()
-        point.X = float(corner_lons[0])
-        point.Y = float(corner_lats[0])
-        pointGeometry = arcpy.PointGeometry(point, sr1)
-        projpoint = pointGeometry.projectAs(sr2)
-
-        # Get projected X and Y of the point geometry and adjust so lower left corner becomes lower left center
-        point2 = arcpy.Point((projpoint.firstPoint.X - (float(DX)/2)), (projpoint.firstPoint.Y - (float(DY)/2))) # Adjust by half a grid cell
-
-        # Process: Numpy Array to Raster
-        ras_ones = arcpy.NumPyArrayToRaster(arr_ones, point2, float(DX), float(DY))
-
-        # Process: Define Projection
-        arcpy.DefineProjection_management(ras_ones, sr2)
-
-        ras_ones.save(os.path.join(scratchWorkspace, "ras_ones"))
-        ################End of script adaption######################################################################
+        sr2.loadFromString(projection.wkt)
 
+        # Read the catchment polygons in the projected coordinates of the WRF grid
+        with arcpy.da.SearchCursor(in_catchment, [streamID, 'SHAPE@WKB'], spatial_reference = sr2) as cursor:
+            features = [(row[0], row[1]) for row in cursor if row[1] is not None]
+        list_xy = [ring for stream_id, wkb in features for polygon in parse_wkb(wkb) for ring in polygon]
+        xy = NUM.concatenate(list_xy) if list_xy else NUM.zeros((0, 2))
+        lon_vertices, lat_vertices = projection.to_lonlat(xy[:, 0], xy[:, 1])
 
-        '''Create CG Polygon for the buffered catchment'''
-        arcpy.AddMessage("Creating computation grid polygons...")
-        # Obtain a minimum bounding envelope of the catchment with the same spatial reference as the WRF-Hydro data
-        envelope = os.path.join(scratchWorkspace,"envelope")
-        arcpy.env.outputCoordinateSystem = sr2
-        result0 = arcpy.MinimumBoundingGeometry_management(in_catchment, envelope, "ENVELOPE", "ALL")
-        arcpy.ResetEnvironments()
-        envelope = result0.getOutput(0)
         # Determine whether the input catchment is within the WRF-Hydro data extent
-        ext_ras_ones = arcpy.Describe(ras_ones).extent
-        ext_envelope = arcpy.Describe(envelope).extent
-        if ext_envelope.XMin < ext_ras_ones.XMin \
-            or ext_envelope.XMax > ext_ras_ones.XMax \
-            or ext_envelope.YMin < ext_ras_ones.YMin \
-            or ext_envelope.YMax > ext_ras_ones.YMax:
-                # Input Catchments exceed the WRF data extent
-                messages.addErrorMessage(self.errorMessages[2])
-                raise arcpy.ExecuteError
+        if not projection.contains(lon_vertices, lat_vertices):
+            # Input Catchments exceed the WRF data extent
+            messages.addErrorMessage(self.errorMessages[3])
+            raise arcpy.ExecuteError
 
-
-        # Buffer the minimum bounding envelope
-        envelope_b = os.path.join(scratchWorkspace, "envelope_b")
-        dist_buffer = str(int(DX)*3) + " Meters"
-        result1 = arcpy.Buffer_analysis(envelope, envelope_b, dist_buffer, "FULL", "#", "ALL")
-        envelope_b = result1.getOutput(0)
-
-		
-        # Convert the buffered envelope into raster with cellsize, and snapraster the same as ras_ones
-        arcpy.env.snapRaster = ras_ones
-        arcpy.env.cellSize = ras_ones
-        name_OID = arcpy.Describe(envelope_b).OIDFieldName
-        ras_env_b = os.path.join(scratchWorkspace, "ras_env_b")
-        arcpy.PolygonToRaster_conversion(envelope_b, name_OID, ras_env_b, 'CELL_CENTER', 'NONE', ras_ones)
-        arcpy.ResetEnvironments()
-
-
-        # Create fishnet based on the clipped raster
-        # Get the extent of the raster
-        ext_ras = arcpy.Describe(ras_env_b).extent
-        xmin_ras = ext_ras.XMin
-        ymin_ras = ext_ras.YMin
-
-        # Set parameters of the output fishnet
-        originCoordinate = str(xmin_ras) + ' ' + str(ymin_ras)  # the origin
-        yAxiCoordinate = str(xmin_ras) + ' ' + str(ymin_ras + 10)  # the orientation
-        cellSizeWidth = str(DX)
-        cellSizeHeight = str(DY)
-        ras_temp = arcpy.sa.Raster(ras_env_b)
-        numRows = str(ras_temp.height)
-        numCols = str(ras_temp.width)
-        labels = "NO_LABELS"
-        if out_CGPoint is not None:
-            labels = "LABELS"
-        oppositeCorner = ""
-        templateExtent = ras_env_b
-        geometryType = "POLYGON"
-
-        if out_CGPolygon is None:
-            out_CGPolygon = os.path.join(scratchWorkspace, "out_CGPolygon")
-
-        # Create fishnet (computation grid polygon) (and point if specified)
-        result2 = arcpy.CreateFishnet_management(out_CGPolygon, originCoordinate, yAxiCoordinate,
-                                        cellSizeWidth, cellSizeHeight, numRows, numCols,
-                                        oppositeCorner, labels, templateExtent, geometryType)
-        out_CGPolygon = result2.getOutput(0)
-
-        # Add and calculate fields of CENTROID_X and CENTROD_Y for fishnet (computation grid polygon)
-        arcpy.AddGeometryAttributes_management(out_CGPolygon, "CENTROID", "#", "#", "#")
-        temp_CGPoint = None
-        (dirnm_out_CGPolygon, basenm_out_CGPolygon) = os.path.split(out_CGPolygon)
-        if not basenm_out_CGPolygon.endswith(".shp"):
-            temp_CGPoint = out_CGPolygon+"_label"
-        else:
-            temp_CGPoint = os.path.join(dirnm_out_CGPolygon, "{}_label.shp".format(basenm_out_CGPolygon[:-4]))
-
-        if arcpy.Exists(temp_CGPoint) and out_CGPoint is not None and (temp_CGPoint) != out_CGPoint:
-            if not arcpy.Exists(out_CGPoint):
-                arcpy.CopyFeatures_management(temp_CGPoint, out_CGPoint)
-                arcpy.Delete_management(temp_CGPoint)
-
-        # Get latitude and longitude
-        lat_arr = data_nc.variables["XLAT_M"][:]
-        lon_arr = data_nc.variables["XLONG_M"][:]
-        data_nc.close()
+        '''Create CG Polygon for the buffered catchment'''
+        if out_CGPolygon or out_CGPoint:
+            arcpy.AddMessage("Creating computation grid polygons...")
+            # The grid cells within 3 cells of the catchment, from the tiles of the grid
+            # cell cache if it is specified
+            subdomain = projection.subdomain(lon_vertices, lat_vertices, 3)
+            if in_cache_folder:
+                cells = GridCellCache(in_cache_folder, projection).cells(*subdomain)
+            else:
+                cells = projection.cell_polygons(*subdomain)
+            center_x, center_y, corners = cells[2:]
+
+        # Output the computation grid polygons and points if they are specified
+        if out_CGPolygon:
+            (dirnm_out_CGPolygon, basenm_out_CGPolygon) = os.path.split(out_CGPolygon)
+            arcpy.CreateFeatureclass_management(dirnm_out_CGPolygon, basenm_out_CGPolygon, "POLYGON",
+                                                spatial_reference = sr2)
+            arcpy.AddField_management(out_CGPolygon, "CENTROID_X", "DOUBLE")
+            arcpy.AddField_management(out_CGPolygon, "CENTROID_Y", "DOUBLE")
+            with arcpy.da.InsertCursor(out_CGPolygon, ['SHAPE@', 'CENTROID_X', 'CENTROID_Y']) as cursor:
+                for corners_each, x, y in zip(corners.tolist(), center_x.tolist(), center_y.tolist()):
+                    polygon = arcpy.Polygon(arcpy.Array([arcpy.Point(*each) for each in corners_each]), sr2)
+                    cursor.insertRow([polygon, x, y])
+        if out_CGPoint:
+            (dirnm_out_CGPoint, basenm_out_CGPoint) = os.path.split(out_CGPoint)
+            arcpy.CreateFeatureclass_management(dirnm_out_CGPoint, basenm_out_CGPoint, "POINT",
+                                                spatial_reference = sr2)
+            with arcpy.da.InsertCursor(out_CGPoint, ['SHAPE@XY']) as cursor:
+                for xy in zip(center_x.tolist(), center_y.tolist()):
+                    cursor.insertRow([xy])
 
         '''Create weight table'''
-        # Obtain the minimum X and minimum Y for the lower left pixel center of the ones raster
-        minX = projpoint.firstPoint.X
-        minY = projpoint.firstPoint.Y
-
-
-        # Intersect the catchment polygons with the computation grid polygons
+        # Clip the catchment polygons against the grid cells near them, in tiles of
+        # catchments on a pool of processes, and calculate the area of each piece;
+        # only the catchments that changed since the previous weight table if it is specified
         arcpy.AddMessage("Intersecting computation grid polygons with catchment...")
-        intersected = os.path.join(scratchWorkspace, "intersected")
-        result3 = arcpy.Intersect_analysis([out_CGPolygon, in_catchment], intersected, "ALL", "#", "INPUT")
-        intersected = result3.getOutput(0)
-
-        # Calculate the geodesic area in square meters for each intersected polygon
-        arcpy.AddMessage("Calculating geodesic areas...")
-        arcpy.AddGeometryAttributes_management(intersected, "AREA_GEODESIC", "", "SQUARE_METERS", "")
-
+        if in_previous_table and not os.path.exists(catchment_hashes_path(in_previous_table)):
+            arcpy.AddWarning(self.errorMessages[5])
+        set_worker_executable()
+        pieces, hashes, npieces, size_intersected = intersect_catchment_features(
+            projection, features, in_previous_table, multiprocessing.cpu_count())
+        if in_previous_table:
+            arcpy.AddMessage("Intersected {0} of {1} catchment features".format(size_intersected,
+                                                                              len(features)))
+        if len(pieces) == 0:
+            data_nc.close()
+            messages.addErrorMessage(self.errorMessages[4])
+            raise arcpy.ExecuteError
+
+        # Get latitude and longitude of the grid cells of the intersected polygons, reading
+        # only the cells in their range of indices
+        indexX = pieces['lon_index']
+        indexY = pieces['lat_index']
+        window = (0, slice(indexY.min(), indexY.max() + 1), slice(indexX.min(), indexX.max() + 1))
+        lat_arr = data_nc.variables["XLAT_M"][window][indexY - indexY.min(), indexX - indexX.min()]
+        lon_arr = data_nc.variables["XLONG_M"][window][indexY - indexY.min(), indexX - indexX.min()]
+        data_nc.close()
 
-        # Calculate the total geodesic area of each catchment based on the contributing areas of points
-        fields = [streamID, "CENTROID_X", "CENTROID_Y", "AREA_GEO"]
-        area_arr = arcpy.da.FeatureClassToNumPyArray(intersected, fields)
+        # The center of the grid cell of each intersected polygon
+        centroidX, centroidY = projection.index_to_xy(indexX, indexY)
 
         arcpy.AddMessage("Writing the weight table...")
         # Get list of COMIDs in rapid connect file so only those area included in computations
         connectivity_table = self.csvToList(in_rapid_connect_file)
         streamID_unique_list = [int(row[0]) for row in connectivity_table]
 
-        # Get some dummy data from the first row
-        centroidX_dummy = area_arr["CENTROID_X"][0]
-        centroidY_dummy = area_arr["CENTROID_Y"][0]
-        indexX_dummy = long(round((centroidX_dummy - minX)/float(DX)))
-        indexY_dummy = long(round((centroidY_dummy - minY)/float(DY)))
-        lon_dummy = lon_arr[0, indexY_dummy, indexX_dummy]
-        lat_dummy = lat_arr[0, indexY_dummy, indexX_dummy]
+        # Rows of each stream ID in the order of the intersected polygons; the streams without
+        # intersected polygons get one dummy row with the data of the first polygon
+        row_index, npoints, dummy = weight_table_rows(pieces['stream_id'], streamID_unique_list)
+        size_rows = NUM.maximum(npoints, 1)
+        area_geo = pieces['area_sqm'][row_index]
+        # The total area of each stream, summed in the order of its rows
+        area_geo_total = NUM.bincount(NUM.repeat(NUM.arange(len(size_rows)), size_rows), weights=area_geo)
+        weight = area_geo / NUM.repeat(area_geo_total, size_rows)
+
+        # streamID, "area_sqm", "west_east", "south_north", "npoints", "weight", "Lon", "Lat", "x", "y"
+        # The lon and lat keep the type of the geogrid variables, as they are written
+        rows = [[streamID, "area_sqm", "west_east", "south_north", "npoints", "weight", "Lon", "Lat", "x", "y"]]
+        rows.extend(list(row) for row in zip(NUM.repeat(streamID_unique_list, size_rows).tolist(),
+                                             area_geo.tolist(),
+                                             indexX[row_index].tolist(),
+                                             indexY[row_index].tolist(),
+                                             NUM.repeat(size_rows, size_rows).tolist(),
+                                             weight.tolist(),
+                                             list(lon_arr[row_index]),
+                                             list(lat_arr[row_index]),
+                                             centroidX[row_index].tolist(),
+                                             centroidY[row_index].tolist()))
+        for i in NUM.flatnonzero(dummy):
+            rows[i + 1][1] = 0
+            rows[i + 1][5] = 1.0
 
         with open(out_WeightTable, 'wb') as csvfile:
             connectwriter = csv.writer(csvfile, dialect = 'excel')
-            #header
-            connectwriter.writerow([streamID, "area_sqm", "west_east", "south_north", "npoints", "weight", "Lon", "Lat", "x", "y"])
-
-            for streamID_unique in streamID_unique_list:
-                ind_points = NUM.where(area_arr[streamID]==streamID_unique)[0]
-                num_ind_points = len(ind_points)
-                # Get the total area
-                area_geo_total = 0
-                for ind_point in ind_points:
-                    area_geo_total += float(area_arr["AREA_GEO"][ind_point])
-
-                if num_ind_points <= 0:
-                    # if point not in array, append dummy data for one point of data
-                    # streamID, "area_sqm", "west_east", "south_north", "npoints", "weight", "Lon", "Lat", "x", "y"
-                    row_dummy = [streamID_unique, 0, indexX_dummy, indexY_dummy, 1, 1.0, lon_dummy, lat_dummy, centroidX_dummy, centroidY_dummy]
-                    connectwriter.writerow(row_dummy)
-                else:
-                    for ind_point in ind_points:
-                        area_geo_each = float(area_arr['AREA_GEO'][ind_point])
-                        weight_each = area_geo_each/area_geo_total
-                        centroidX = area_arr["CENTROID_X"][ind_point]
-                        centroidY = area_arr["CENTROID_Y"][ind_point]
-                        indexX = long(round((centroidX - minX)/float(DX)))
-                        indexY = long(round((centroidY - minY)/float(DY)))
-                        lon = lon_arr[0, indexY, indexX]
-                        lat = lat_arr[0, indexY, indexX]
-                        row = [streamID_unique, area_geo_each, indexX, indexY, num_ind_points, weight_each, lon, lat, centroidX, centroidY]
-                        connectwriter.writerow(row)
+            connectwriter.writerows(rows)
 
+        write_catchment_hashes(out_WeightTable, [each[0] for each in features], hashes, npieces)
 
         return
\ No newline at end of file
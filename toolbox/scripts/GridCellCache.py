@@ -0,0 +1,117 @@
+'''-------------------------------------------------------------------------------
+ Source Name: GridCellCache.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: Persistent cache of the cell polygons of a computational grid, shared
+              by the weight tables of all the basins on the same grid. The cells are
+              stored in square tiles in a folder named after the identity of the grid,
+              i.e. its latitude/longitude arrays or its WRF projection attributes. A
+              tile is created the first time a basin needs it, and each basin reads
+              only the tiles that overlap its buffered extent.
+ History:     Initial coding - 10/16/2026, version 1.0
+-------------------------------------------------------------------------------'''
+import os
+import zipfile
+import tempfile
+import numpy as NUM
+
+# Arrays of the cells of a tile, as returned by the cell_polygons of the grid
+CELL_ARRAYS = ["index_x", "index_y", "center_x", "center_y", "corners"]
+
+
+class GridCellCache(object):
+    """Tiles of the cell polygons of a grid, stored in cache_folder
+
+       The tiles are indexed by the position of their cells in the grid: the
+       subdomain of the grid near a basin gives the cell ranges it covers, and
+       those give the tiles to read, without searching the other tiles.
+
+       grid -- LatLonGrid or WRFProjection, with identity, subdomain and cell_polygons
+    """
+    # Number of cells along each side of a tile
+    tile_size = 64
+    # Version of the layout of the tiles, part of the name of the cache folder
+    version = 1
+
+    def __init__(self, cache_folder, grid):
+        self.grid = grid
+        self.folder = os.path.join(cache_folder, "{0}_{1}_v{2}".format(type(grid).__name__,
+                                                                      grid.identity, self.version))
+
+    def tile_path(self, tile_row, tile_col):
+        """Path of the file of the tile in row tile_row and column tile_col of tiles"""
+        return os.path.join(self.folder, "tile{0}_{1}_{2}.npz".format(self.tile_size, tile_row,
+                                                                     tile_col))
+
+    def tile_ranges(self, tile_row, tile_col):
+        """First and last x and y positions of the cells of a tile"""
+        i_min = tile_col * self.tile_size
+        j_min = tile_row * self.tile_size
+        return (i_min, min(i_min + self.tile_size, self.grid.size_xdim) - 1,
+                j_min, min(j_min + self.tile_size, self.grid.size_ydim) - 1)
+
+    def read_tile(self, tile_row, tile_col):
+        """Cells of a tile, created and stored if they are not in the cache yet"""
+        path = self.tile_path(tile_row, tile_col)
+        if os.path.exists(path):
+            try:
+                with NUM.load(path) as tile:
+                    return [tile[each] for each in CELL_ARRAYS]
+            except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+                # A damaged tile is created again
+                pass
+        cells = self.grid.cell_polygons(*self.tile_ranges(tile_row, tile_col))
+        self.write_tile(path, cells)
+        return list(cells)
+
+    def write_tile(self, path, cells):
+        """Store the cells of a tile
+
+           The tile is written to a temporary file that is then renamed, so that
+           runs sharing the cache never read a partial tile.
+        """
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                if not os.path.isdir(self.folder):
+                    raise
+        fd, path_temp = tempfile.mkstemp(suffix=".npz", dir=self.folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                NUM.savez(f, **dict(zip(CELL_ARRAYS, cells)))
+            os.rename(path_temp, path)
+        except OSError:
+            # Another run stored the same tile first
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(path_temp):
+                os.remove(path_temp)
+
+    def cells(self, i_min, i_max, j_min, j_max):
+        """Cells of a subdomain of the grid, as returned by the cell_polygons of the grid"""
+        list_cells = []
+        for tile_row in range(j_min // self.tile_size, j_max // self.tile_size + 1):
+            for tile_col in range(i_min // self.tile_size, i_max // self.tile_size + 1):
+                tile_i_min, tile_i_max, tile_j_min, tile_j_max = self.tile_ranges(tile_row, tile_col)
+                j, i = NUM.mgrid[tile_j_min:tile_j_max + 1, tile_i_min:tile_i_max + 1]
+                keep = ((i >= i_min) & (i <= i_max) & (j >= j_min) & (j <= j_max)).ravel()
+                list_cells.append((j.ravel()[keep], i.ravel()[keep],
+                                   [each[keep] for each in self.read_tile(tile_row, tile_col)]))
+
+        # Cells row by row from the south, across the tiles
+        j = NUM.concatenate([each[0] for each in list_cells])
+        i = NUM.concatenate([each[1] for each in list_cells])
+        order = NUM.lexsort((i, j))
+        return tuple(NUM.concatenate([each[2][k] for each in list_cells])[order]
+                     for k in range(len(CELL_ARRAYS)))
+
+    def cells_near(self, lon, lat, size_buffer):
+        """Cells within size_buffer cells of the points (lon, lat), or None if no point is given"""
+        subdomain = self.grid.subdomain(lon, lat, size_buffer)
+        if subdomain is None:
+            return None
+        return self.cells(*subdomain)
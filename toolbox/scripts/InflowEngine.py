@@ -0,0 +1,417 @@
+'''-------------------------------------------------------------------------------
+ Source Name: InflowEngine.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: Shared computation engine of the Create Inflow File tools. The weight
+              table is compiled once into a sparse (CSR) matrix of contributing areas
+              with one row per stream and one column per distinct computational grid
+              cell, so that the inflows of all streams are obtained with a single
+              sparse matrix product against the incremental runoff of the grid cells.
+ History:     Initial coding - 10/16/2026, version 1.0
+              Version 1.1, 10/16/2026, cache the compiled weight table in a binary
+                .npz file keyed by the content hash of the .csv weight table
+              Version 1.1, 10/16/2026, read only runs of the distinct grid cells instead
+                of the whole bounding box when the cells fill little of the box
+              Version 1.1, 10/16/2026, compute the inflows in chunks of time steps
+                within a memory budget
+              Version 1.1, 10/16/2026, derive the output time steps of any interval from
+                the time variable of the runoff file
+              Version 1.1, 10/16/2026, de-accumulate in place without concatenating copies
+              Version 1.1, 10/16/2026, compute the inflows into float32 buffers and create
+                the inflow file in 64-bit offset, CDF5 or chunked netCDF-4 format
+              Version 1.1, 10/16/2026, compute the inflows of a stream of runoff chunks
+                read ahead on a pool of threads
+              Version 1.1, 10/16/2026, sum several runoff variables into one float32 buffer
+                and fold unit conversions into the contributing areas
+              Version 1.1, 10/16/2026, weight the runoff gathered at the entries of the matrix
+                in blocks of streams of bounded size
+-------------------------------------------------------------------------------'''
+import os
+import itertools
+import collections
+from multiprocessing.pool import ThreadPool
+import numpy as NUM
+
+# Version of the layout of the compiled weight table files
+COMPILED_VERSION = 1
+
+# netCDF formats of the RAPID inflow file: classic, 64-bit offset, CDF5 and netCDF-4
+INFLOW_FORMATS = ["NETCDF3_CLASSIC", "NETCDF3_64BIT", "NETCDF3_64BIT_DATA", "NETCDF4"]
+# Largest number of values of m3_riv in one chunk of a netCDF-4 inflow file (4 MB)
+MAX_CHUNK_SIZE = 1024 * 1024
+
+
+class SparseWeightTable(object):
+    """Weight table compiled into a CSR stream-by-cell matrix of contributing areas
+
+       stream_ids   -- stream IDs in the order of the weight table (one per matrix row)
+       indptr       -- CSR row pointer, the entries of stream s are indptr[s]:indptr[s+1]
+       indices      -- CSR column index of each entry into the distinct grid cells
+       data         -- CSR value of each entry, the contributing area in square meters
+       cell_y       -- row index (lat_index / south_north) of each distinct grid cell
+       cell_x       -- column index (lon_index / west_east) of each distinct grid cell
+    """
+    # Largest gap of unused cells that is still read within a run of cells of a row
+    max_run_gap = 8
+    # Cost of one additional read of the netCDF variable, in number of grid cells
+    read_overhead = 64
+    # Largest number of gathered runoff values (entries by time steps) weighted at once
+    max_block_values = 1 << 20
+
+    def __init__(self, stream_ids, indptr, indices, data, cell_y, cell_x):
+        self.stream_ids = stream_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.cell_y = cell_y
+        self.cell_x = cell_x
+
+    @classmethod
+    def from_columns(cls, stream_id, area_sqm, x_index, y_index, npoints):
+        """Compile the columns of a weight table into the sparse matrix
+
+           The rows of the weight table must be grouped by stream, each group
+           holding npoints rows of the same stream ID. Raises ValueError otherwise.
+        """
+        stream_id = NUM.asarray(stream_id).astype(NUM.int64)
+        area_sqm = NUM.asarray(area_sqm).astype(NUM.float64)
+        x_index = NUM.asarray(x_index).astype(NUM.int64)
+        y_index = NUM.asarray(y_index).astype(NUM.int64)
+        npoints = NUM.asarray(npoints).astype(NUM.int64)
+
+        len_wt = len(stream_id)
+        if len_wt == 0:
+            raise ValueError("The weight table is empty")
+
+        # A new group starts wherever the stream ID changes
+        starts = NUM.flatnonzero(NUM.concatenate([[True], stream_id[1:] != stream_id[:-1]]))
+        indptr = NUM.append(starts, len_wt)
+
+        # Each stream must form exactly one group of npoints rows
+        if len(starts) != len(NUM.unique(stream_id)) or \
+            (npoints[starts] != NUM.diff(indptr)).any():
+            raise ValueError("Incorrect sequence of rows in the weight table")
+
+        # Number the distinct grid cells in row-major order
+        min_x = x_index.min()
+        len_x = x_index.max() - min_x + 1
+        flat_index = y_index * len_x + (x_index - min_x)
+        flat_unique, indices = NUM.unique(flat_index, return_inverse=True)
+        cell_y = flat_unique // len_x
+        cell_x = flat_unique % len_x + min_x
+
+        return cls(stream_id[starts], indptr, indices.ravel(), area_sqm, cell_y, cell_x)
+
+    @property
+    def size_stream(self):
+        """Number of streams (rows of the matrix)"""
+        return len(self.stream_ids)
+
+    @property
+    def size_cell(self):
+        """Number of distinct grid cells (columns of the matrix)"""
+        return len(self.cell_y)
+
+    def cell_runs(self):
+        """Split the distinct grid cells into runs of nearby cells in the same row
+
+           Returns the index of the first cell of each run and the index past its last cell.
+        """
+        new_run = (NUM.diff(self.cell_y) != 0) | (NUM.diff(self.cell_x) > self.max_run_gap)
+        starts = NUM.flatnonzero(NUM.concatenate([[True], new_run]))
+        ends = NUM.append(starts[1:], self.size_cell)
+        return starts, ends
+
+    def read_cells(self, variable, time_index=slice(None)):
+        """Read the runoff of the distinct grid cells from a (time, y, x) netCDF variable
+
+           time_index is a slice or an increasing sequence of indices of the time steps to read.
+
+           The bounding box of the cells is read as a single slab unless the cells
+           fill so little of it (e.g. basins across the 0/360 longitude seam or spread
+           over a continent) that reading runs of cells row by row is cheaper.
+           Returns an array of shape (time, size_cell) in the order of the matrix columns.
+        """
+        starts, ends = self.cell_runs()
+        size_box = (self.cell_y.max() - self.cell_y.min() + 1) * \
+                   (self.cell_x.max() - self.cell_x.min() + 1)
+        size_runs = (self.cell_x[ends - 1] - self.cell_x[starts] + 1).sum()
+        if size_runs + len(starts) * self.read_overhead < size_box:
+            return self.read_cell_runs(variable, time_index, starts, ends)
+        return self.read_cell_slab(variable, time_index)
+
+    def read_cell_slab(self, variable, time_index=slice(None)):
+        """Read the runoff of the distinct grid cells from the slab of their bounding box"""
+        min_y = self.cell_y.min()
+        max_y = self.cell_y.max()
+        min_x = self.cell_x.min()
+        max_x = self.cell_x.max()
+        data_subset = variable[time_index, min_y:max_y+1, min_x:max_x+1]
+        len_x_subset = max_x - min_x + 1
+        data_subset = data_subset.reshape(data_subset.shape[0], -1)
+        return data_subset[:, (self.cell_y - min_y) * len_x_subset + (self.cell_x - min_x)]
+
+    def read_cell_runs(self, variable, time_index, starts, ends):
+        """Read the runoff of the distinct grid cells with one read per run of cells"""
+        data_cells = None
+        for start, end in zip(starts, ends):
+            min_x = self.cell_x[start]
+            max_x = self.cell_x[end - 1]
+            data_run = variable[time_index, self.cell_y[start], min_x:max_x+1]
+            if data_cells is None:
+                # The values read may be unpacked (scale_factor/add_offset) into another
+                # type than variable.dtype, the type stored in the file
+                data_cells = NUM.ma.empty((data_run.shape[0], self.size_cell), dtype=data_run.dtype)
+            data_cells[:, start:end] = data_run[:, self.cell_x[start:end] - min_x]
+        return data_cells
+
+    def read_cells_total(self, variables, time_index=slice(None)):
+        """Read and sum the runoff of several (time, y, x) netCDF variables at the distinct grid cells
+
+           The runoff of each variable is added in place into a single float32 buffer,
+           so that only the buffer and the cells of one variable are held at a time.
+           A cell is masked in the total wherever it is masked in any variable.
+        """
+        total = None
+        mask = NUM.ma.nomask
+        for variable in variables:
+            data_cells = self.read_cells(variable, time_index)
+            mask = NUM.ma.mask_or(mask, NUM.ma.getmask(data_cells))
+            if total is None:
+                total = NUM.empty(data_cells.shape, dtype=NUM.float32)
+                total[...] = NUM.ma.getdata(data_cells)
+            else:
+                total += NUM.ma.getdata(data_cells)
+            del data_cells
+        if mask is not NUM.ma.nomask:
+            total = NUM.ma.masked_array(total, mask=mask)
+        return total
+
+    def scaled(self, factor):
+        """Copy of the weight table with the contributing areas multiplied by factor
+
+           Folds a unit conversion of the runoff (e.g. from millimeters to meters)
+           into the matrix instead of converting every runoff value.
+        """
+        return SparseWeightTable(self.stream_ids, self.indptr, self.indices,
+                                 self.data * factor, self.cell_y, self.cell_x)
+
+    def apply(self, runoff):
+        """Multiply the incremental runoff of the grid cells by the area matrix
+
+           runoff has shape (time, size_cell); masked values contribute no inflow.
+           The streams are weighted in blocks of consecutive rows of the matrix, so
+           that the runoff gathered at the entries of a block holds no more than
+           max_block_values values (or the entries of a single stream) at a time.
+           Returns the inflow of every stream as float32 with shape (time, size_stream).
+        """
+        runoff = NUM.ma.filled(runoff, 0)
+        size_time = runoff.shape[0]
+        # Accumulate in double precision directly into a single precision buffer,
+        # the type of m3_riv in the RAPID inflow file
+        inflow = NUM.zeros((size_time, self.size_stream), dtype=NUM.float32)
+        size_block = max(1, self.max_block_values // max(size_time, 1))
+        start = 0
+        while start < self.size_stream:
+            end = NUM.searchsorted(self.indptr, self.indptr[start] + size_block, 'right') - 1
+            end = min(max(end, start + 1), self.size_stream)
+            first = self.indptr[start]
+            last = self.indptr[end]
+            NUM.add.reduceat(runoff[:, self.indices[first:last]] * self.data[first:last],
+                             self.indptr[start:end] - first, axis=1,
+                             dtype=NUM.float64, out=inflow[:, start:end])
+            start = end
+        return inflow
+
+    def time_chunk_size(self, memory_budget, size_time):
+        """Number of time steps computed at once to stay within memory_budget (in MB)
+
+           The whole time series is computed at once if memory_budget is None.
+        """
+        if not memory_budget:
+            return size_time
+        # Approximate bytes per time step: the cells read (including the bounding box
+        # if read as a slab), their increments and the inflows
+        size_box = (self.cell_y.max() - self.cell_y.min() + 1) * \
+                   (self.cell_x.max() - self.cell_x.min() + 1)
+        bytes_time = 5 * size_box + 17 * self.size_cell + 8 * self.size_stream
+        # The runoff gathered at the entries of a block of streams (float32) and
+        # weighted (float64) by apply, whatever the number of time steps
+        bytes_block = 12 * self.max_block_values
+        return int(max(1, min(size_time, (memory_budget * 1024 * 1024 - bytes_block) // bytes_time)))
+
+    def iter_inflows(self, read_runoff, time_indices, size_chunk):
+        """Compute the inflows of all streams chunk by chunk of time steps
+
+           read_runoff(indices) returns the cumulative runoff of the distinct grid cells
+           at the given time indices; the inflow of each step in time_indices is the
+           runoff accumulated since the previous step. The last cumulative runoff of a
+           chunk is carried over to de-accumulate the first step of the next chunk.
+           Yields the position of each chunk in time_indices and its inflows.
+        """
+        chunks = (read_runoff(time_indices[start:start+size_chunk])
+                  for start in range(0, len(time_indices), size_chunk))
+        return self.iter_chunk_inflows(chunks)
+
+    def iter_chunk_inflows(self, cumulative_chunks):
+        """Compute the inflows of all streams from consecutive chunks of cumulative runoff
+
+           Each chunk holds the cumulative runoff of the distinct grid cells at the
+           time steps following those of the previous chunk. Only one chunk is held
+           at a time; its last time step is carried over to de-accumulate the next.
+           Yields the position of each chunk in the time series and its inflows.
+        """
+        previous = None
+        start = 0
+        for cumulative in cumulative_chunks:
+            increments = deaccumulate(cumulative)
+            if previous is not None:
+                increments[0:1,] = NUM.ma.subtract(cumulative[0:1,], previous)
+            previous = cumulative[-1:,]
+            yield start, self.apply(increments)
+            start += len(cumulative)
+
+
+class SingleTimeVariable(object):
+    """View of a (y, x) netCDF variable as a (time, y, x) variable of a single time step
+
+       Lets SparseWeightTable.read_cells read runoff files that hold one output
+       time without a time dimension.
+    """
+    def __init__(self, variable):
+        self.variable = variable
+        self.shape = (1,) + tuple(variable.shape)
+        self.dtype = variable.dtype
+
+    def __getitem__(self, key):
+        data = self.variable[key[1:]]
+        return data[NUM.newaxis][key[0]]
+
+
+class LockedVariable(object):
+    """View of a netCDF variable whose reads hold lock
+
+       The netCDF library is not thread safe, so the threads that read a variable
+       hold a lock shared with all other calls to the library only while the values
+       are read, and the work on the values read runs alongside the other threads.
+    """
+    def __init__(self, variable, lock):
+        self.variable = variable
+        self.lock = lock
+        with lock:
+            self.shape = tuple(variable.shape)
+            self.dtype = variable.dtype
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.variable[key]
+
+
+def deaccumulate(data):
+    """Convert runoff that is cumulative through time into incremental runoff"""
+    increments = data.copy()
+    increments[1:,] -= data[:-1,]
+    return increments
+
+
+def iter_read_ahead(function, list_args, size_pool):
+    """Apply function to each item of list_args on a pool of threads, yielding the results in order
+
+       At most size_pool items are read ahead of the result being consumed, so that
+       the reads overlap the processing of the current result while no more than
+       size_pool + 1 results are held in memory. function must be thread safe.
+    """
+    if size_pool < 1:
+        for args in list_args:
+            yield function(args)
+        return
+
+    pool = ThreadPool(size_pool)
+    try:
+        iter_args = iter(list_args)
+        pending = collections.deque(pool.apply_async(function, (args,))
+                                    for args in itertools.islice(iter_args, size_pool))
+        while pending:
+            result = pending.popleft().get()
+            for args in itertools.islice(iter_args, 1):
+                pending.append(pool.apply_async(function, (args,)))
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def create_inflow_variable(data_out_nc, streamID, size_time, size_stream, complevel=None):
+    """Create the dimensions and the m3_riv variable of a new RAPID inflow file
+
+       In netCDF-4 files, each chunk of m3_riv holds one time step of (up to
+       MAX_CHUNK_SIZE) streams, as RAPID reads the inflows one time step at a time,
+       and the chunks are compressed with zlib at complevel (1-9) if given.
+    """
+    dim_Time = data_out_nc.createDimension('Time', size_time)
+    dim_RiverID = data_out_nc.createDimension(streamID, size_stream)
+    if data_out_nc.data_model.startswith("NETCDF4"):
+        return data_out_nc.createVariable('m3_riv', 'f4', ('Time', streamID),
+                                          chunksizes=(1, min(size_stream, MAX_CHUNK_SIZE)),
+                                          zlib=bool(complevel), complevel=complevel or 4,
+                                          shuffle=bool(complevel))
+    return data_out_nc.createVariable('m3_riv', 'f4', ('Time', streamID))
+
+
+def resample_time_indices(time, interval, tolerance=1e-6):
+    """Indices of the cumulative time steps that end each output time step of length interval
+
+       The output time steps start at the first time and follow the interval for as
+       long as the input time steps resolve it, i.e. up to the first output time that
+       is not an input time. Differencing the cumulative runoff at these indices both
+       de-accumulates and aggregates it to the interval.
+    """
+    time = NUM.asarray(time, dtype=NUM.float64)
+    size_out = int(NUM.floor((time[-1] - time[0]) / interval + tolerance)) + 1
+    time_out = time[0] + interval * NUM.arange(size_out)
+    indices = NUM.minimum(NUM.searchsorted(time, time_out - tolerance), len(time) - 1)
+    resolved = NUM.abs(time[indices] - time_out) <= tolerance
+    if not resolved.all():
+        indices = indices[:NUM.argmin(resolved)]
+    return indices
+
+
+def compiled_weight_table_path(in_weight_table):
+    """Path of the compiled weight table, stored beside the .csv weight table"""
+    return os.path.splitext(in_weight_table)[0] + "_compiled.npz"
+
+
+def load_compiled_weight_table(in_weight_table, key):
+    """Load the compiled weight table of the .csv weight table
+
+       Returns the name of the stream ID field and the SparseWeightTable, or
+       None if the compiled weight table is missing, unreadable, or out of date.
+    """
+    in_compiled = compiled_weight_table_path(in_weight_table)
+    if not os.path.exists(in_compiled):
+        return None
+    try:
+        data_npz = NUM.load(in_compiled)
+        try:
+            if int(data_npz["version"]) != COMPILED_VERSION or str(data_npz["key"]) != key:
+                return None
+            weight_matrix = SparseWeightTable(data_npz["stream_ids"], data_npz["indptr"],
+                                              data_npz["indices"], data_npz["data"],
+                                              data_npz["cell_y"], data_npz["cell_x"])
+            return str(data_npz["streamID"]), weight_matrix
+        finally:
+            data_npz.close()
+    except Exception:
+        return None
+
+
+def save_compiled_weight_table(in_weight_table, key, streamID, weight_matrix):
+    """Save the compiled weight table beside the .csv weight table"""
+    NUM.savez(compiled_weight_table_path(in_weight_table),
+              version=NUM.array(COMPILED_VERSION), key=NUM.array(key),
+              streamID=NUM.array(streamID),
+              stream_ids=weight_matrix.stream_ids, indptr=weight_matrix.indptr,
+              indices=weight_matrix.indices, data=weight_matrix.data,
+              cell_y=weight_matrix.cell_y, cell_x=weight_matrix.cell_x)
@@ -0,0 +1,232 @@
+'''-------------------------------------------------------------------------------
+ Source Name: RiverNetwork.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: In-memory graph of a river network shared by the tools that need the
+              upstreams or the order of the reaches. The reaches are numbered by
+              increasing HydroID, and the upstream and downstream reaches of each
+              reach are stored in CSR form, so the network is built with a few sorts
+              from the HydroID/NextDownID arrays or the RAPID connectivity file and
+              can be cached in a binary .npz file beside the connectivity file.
+ History:     Initial coding - 10/16/2026, version 1.0
+              Version 1.1, 10/16/2026, added the reaches upstream of a set of outlets
+-------------------------------------------------------------------------------'''
+import os
+import csv
+import numpy as NUM
+from CacheKey import file_key
+
+# Version of the layout of the river network cache files
+NETWORK_VERSION = 1
+
+
+def upstream_csr(ids, hydroid, next_down_id):
+    """Reaches whose NextDownID is each of the increasing ids, in CSR form
+
+       hydroid and next_down_id are the HydroID and NextDownID of each reach.
+       Returns the offsets and the positions in hydroid of the upstream reaches:
+       the upstreams of ids[k] are at offsets[k]:offsets[k + 1], in the order of
+       the reaches. One stable sort of the NextDownIDs finds all of them.
+    """
+    next_down_id = NUM.asarray(next_down_id)
+    order = NUM.argsort(next_down_id, kind='mergesort')
+    sorted_down = next_down_id[order]
+    start = NUM.searchsorted(sorted_down, ids, 'left')
+    count = NUM.searchsorted(sorted_down, ids, 'right') - start
+    offsets = NUM.concatenate([[0], NUM.cumsum(count)]).astype(NUM.int64)
+    position = NUM.arange(offsets[-1]) - NUM.repeat(offsets[:-1] - start, count)
+    return offsets, order[position]
+
+
+class RiverNetwork(object):
+    """Graph of the reaches of a river network
+
+       ids               -- increasing HydroIDs, the reach k has the HydroID ids[k]
+       next_down         -- reach downstream of each reach, -1 for an outlet, whose
+                            NextDownID is not in the network
+       upstream_offsets  -- CSR row pointer, the upstreams of reach k are
+                            upstream[upstream_offsets[k]:upstream_offsets[k+1]]
+       upstream          -- CSR upstream reaches, by increasing HydroID
+    """
+
+    def __init__(self, ids, next_down, upstream_offsets, upstream):
+        self.ids = ids
+        self.next_down = next_down
+        self.upstream_offsets = upstream_offsets
+        self.upstream = upstream
+        self._topological_order = None
+
+    @classmethod
+    def from_arrays(cls, hydroid, next_down_id):
+        """Build the network from the HydroID and NextDownID of each reach
+
+           A HydroID that appears more than once keeps the NextDownID of its
+           first reach, as in the connectivity file.
+        """
+        hydroid = NUM.asarray(hydroid).astype(NUM.int64)
+        next_down_id = NUM.asarray(next_down_id).astype(NUM.int64)
+        ids, first = NUM.unique(hydroid, return_index=True)
+        next_down_id = next_down_id[first]
+
+        # Reach of each NextDownID, -1 if it is not a HydroID of the network
+        next_down = NUM.minimum(NUM.searchsorted(ids, next_down_id), max(len(ids) - 1, 0))
+        if len(ids):
+            next_down = NUM.where(ids[next_down] == next_down_id, next_down, -1)
+        upstream_offsets, upstream = upstream_csr(ids, ids, next_down_id)
+        return cls(ids, next_down, upstream_offsets, upstream)
+
+    @classmethod
+    def from_connectivity_file(cls, in_rapid_connect_file):
+        """Build the network from the HydroID and NextDownID columns of the RAPID connectivity file"""
+        hydroid = []
+        next_down_id = []
+        with open(in_rapid_connect_file, 'rb') as csvfile:
+            for row in csv.reader(csvfile):
+                if row:
+                    hydroid.append(int(row[0]))
+                    next_down_id.append(int(row[1]))
+        return cls.from_arrays(NUM.array(hydroid, dtype=NUM.int64), NUM.array(next_down_id, dtype=NUM.int64))
+
+    @property
+    def size_reach(self):
+        """Number of reaches"""
+        return len(self.ids)
+
+    @property
+    def upstream_count(self):
+        """Number of upstream reaches of each reach"""
+        return NUM.diff(self.upstream_offsets)
+
+    @property
+    def downstream_offsets(self):
+        """CSR row pointer of the downstream reaches, none for an outlet and one otherwise"""
+        return NUM.concatenate([[0], NUM.cumsum(self.next_down >= 0)]).astype(NUM.int64)
+
+    @property
+    def downstream(self):
+        """CSR downstream reaches"""
+        return self.next_down[self.next_down >= 0]
+
+    @property
+    def headwaters(self):
+        """Reaches without upstream reaches"""
+        return NUM.flatnonzero(self.upstream_count == 0)
+
+    @property
+    def outlets(self):
+        """Reaches without a downstream reach in the network"""
+        return NUM.flatnonzero(self.next_down < 0)
+
+    def index(self, hydroid):
+        """Reaches of HydroIDs, raises KeyError if one is not in the network"""
+        hydroid = NUM.asarray(hydroid, dtype=NUM.int64)
+        reach = NUM.minimum(NUM.searchsorted(self.ids, hydroid), max(self.size_reach - 1, 0))
+        missing = (self.ids[reach] != hydroid) if self.size_reach else NUM.ones(hydroid.shape, dtype=bool)
+        if missing.any():
+            raise KeyError("HydroIDs not in the river network: {0}".format(
+                           ", ".join(str(each) for each in NUM.ravel(hydroid)[NUM.ravel(missing)][:10])))
+        return reach
+
+    def topological_order(self, selected=None):
+        """Reaches ordered from upstream to downstream, every reach before its downstream reach
+
+           The reaches are taken level by level from the headwaters, each level by
+           increasing HydroID, as each reach has at most one downstream reach.
+           selected, a boolean mask of reaches that includes every reach upstream
+           of its reaches (as returned by upstream_closure), restricts the order to
+           those reaches, so a cycle elsewhere in the network does not matter.
+           Raises ValueError if the (selected) network has a cycle.
+        """
+        if selected is None and self._topological_order is not None:
+            return self._topological_order
+        remaining = self.upstream_count.copy()
+        frontier = self.headwaters
+        size_order = self.size_reach
+        if selected is not None:
+            frontier = frontier[selected[frontier]]
+            size_order = int(NUM.count_nonzero(selected))
+        list_order = []
+        while len(frontier):
+            list_order.append(frontier)
+            # The reaches downstream of the frontier lose one upstream each
+            down = NUM.sort(self.next_down[frontier])
+            down = down[down >= 0]
+            if selected is not None:
+                down = down[selected[down]]
+            starts = NUM.flatnonzero(NUM.concatenate([[True], down[1:] != down[:-1]])) if len(down) else down
+            down_unique = down[starts]
+            remaining[down_unique] -= NUM.diff(NUM.append(starts, len(down)))
+            frontier = down_unique[remaining[down_unique] == 0]
+        order = NUM.concatenate(list_order) if list_order else NUM.zeros(0, dtype=NUM.int64)
+        if len(order) != size_order:
+            raise ValueError("The river network has a cycle through {0} reaches".format(
+                             size_order - len(order)))
+        if selected is None:
+            self._topological_order = order
+        return order
+
+    def upstream_closure(self, reaches):
+        """Whether each reach is one of reaches or upstream of one of them
+
+           The upstreams are gathered level by level from the CSR upstream
+           reaches, each reach once, in time linear in the size of the network.
+        """
+        selected = NUM.zeros(self.size_reach, dtype=bool)
+        frontier = NUM.unique(NUM.asarray(reaches, dtype=NUM.int64))
+        while len(frontier):
+            selected[frontier] = True
+            start = self.upstream_offsets[frontier]
+            count = self.upstream_offsets[frontier + 1] - start
+            position = NUM.arange(count.sum()) - NUM.repeat(NUM.cumsum(count) - count - start, count)
+            frontier = self.upstream[position]
+            # A cycle would lead back to selected reaches
+            frontier = frontier[~selected[frontier]]
+        return selected
+
+    def save(self, out_npz, key=""):
+        """Save the network in a binary .npz file with the key of its source"""
+        NUM.savez(out_npz, version=NUM.array(NETWORK_VERSION), key=NUM.array(key),
+                  ids=self.ids, next_down=self.next_down,
+                  upstream_offsets=self.upstream_offsets, upstream=self.upstream)
+
+    @classmethod
+    def load(cls, in_npz, key=None):
+        """Load a network saved by save, or None if it is missing, unreadable, or of another key"""
+        if not os.path.exists(in_npz):
+            return None
+        try:
+            data_npz = NUM.load(in_npz)
+            try:
+                if int(data_npz["version"]) != NETWORK_VERSION or \
+                    (key is not None and str(data_npz["key"]) != key):
+                    return None
+                return cls(data_npz["ids"], data_npz["next_down"], data_npz["upstream_offsets"],
+                           data_npz["upstream"])
+            finally:
+                data_npz.close()
+        except Exception:
+            return None
+
+
+def network_cache_path(in_rapid_connect_file):
+    """Path of the river network cached beside the RAPID connectivity file"""
+    return os.path.splitext(in_rapid_connect_file)[0] + "_network.npz"
+
+
+def read_river_network(in_rapid_connect_file):
+    """River network of the RAPID connectivity file, from its cache if it is up to date
+
+       The network is cached beside the connectivity file when it is built, if
+       the folder is writable.
+    """
+    key = file_key(in_rapid_connect_file)
+    network = RiverNetwork.load(network_cache_path(in_rapid_connect_file), key)
+    if network is None:
+        network = RiverNetwork.from_connectivity_file(in_rapid_connect_file)
+        try:
+            network.save(network_cache_path(in_rapid_connect_file), key)
+        except (IOError, OSError):
+            pass
+    return network
@@ -17,6 +17,8 @@
                 updated.
               Version 1.0, 05/24/2015, bug fixing: set npoints as 1 in the replacement_row,
                 and fixed the overwritting problem of the replacement_row (contributor: Alan Snow)
+              Version 1.1, 10/16/2026, index the rows of the weight table by COMID in one pass
+                and stream both files, instead of searching the weight table for each COMID
 -------------------------------------------------------------------------------'''
 import arcpy
 import csv
@@ -89,17 +91,56 @@ class UpdateWeightTable(object):
         body.insert(0, header)
         return body
 
-    def find_comid_weight_table(self, comid, weight_table):
+    def comid_of_row(self, row):
+        """COMID of a row as an integer, or None if it has none"""
+        try:
+            return int(row[0])
+        except (ValueError, IndexError):
+            return None
+
+    def index_weight_table(self, weight_file):
+        """
+        Reads the weight table once, and returns its header, its first
+        row after the header, and the runs of consecutive rows of each
+        COMID as lists of [file offset, number of rows], in file order.
+        Memory is proportional to the number of runs, which is the number
+        of distinct COMIDs in a weight table grouped by COMID.
+
         """
-        Gives COMID row of weight table and remove it
+        header = None
+        first_row = None
+        comid_runs = {}
+        comid_previous = None
+        while True:
+            offset = weight_file.tell()
+            line = weight_file.readline()
+            if not line:
+                break
+            row = next(csv.reader([line]), [])
+            if header is None:
+                header = row
+                comid = None
+            else:
+                if first_row is None:
+                    first_row = row
+                comid = self.comid_of_row(row)
+                if comid is not None:
+                    if comid == comid_previous:
+                        comid_runs[comid][-1][1] += 1
+                    else:
+                        comid_runs.setdefault(comid, []).append([offset, 1])
+            comid_previous = comid
+        return header, first_row, comid_runs
+
+    def read_comid_rows(self, weight_file, runs):
+        """
+        Reads the rows of the runs of a COMID from the weight table.
 
         """
-        for row in range(len(weight_table)):
-            if weight_table[row][0] == comid:
-                comid_row =  weight_table[row]
-                weight_table.remove(comid_row)
-                return comid_row
-        return None
+        for offset, size in runs:
+            weight_file.seek(offset)
+            for i in range(size):
+                yield next(csv.reader([weight_file.readline()]))
 
 
     def getParameterInfo(self):
@@ -154,44 +195,38 @@ class UpdateWeightTable(object):
         in_ConnectivityFile = parameters[1].valueAsText
         out_WeightTable = parameters[2].valueAsText
 
-        #get all flowline comids
-        connectivity = self.csv_to_list(in_ConnectivityFile)
-        all_flowline_comid = self.get_comid_list(connectivity)
-
-        #get all catchment comids
-        weight_table = self.csv_to_list(in_WeightTable)
-        self.convert_comid_to_int(weight_table)
-
-        #FEATUREID,area_sqm,lon_index,lat_index,npoints,weight,Lon,Lat
-        new_weight_table = weight_table[0:1][:]
-
-        replacement_row = weight_table[1][1:]
-        #set area_sqm to zero
-        replacement_row[0] = 0
-        #set npoints to one
-        replacement_row[3] = 1
-
-        for comid in all_flowline_comid:
-            #delete rows in catchment but not in flowline
-            new_row = self.find_comid_weight_table(comid, weight_table)
-            row_count = 0
-            while new_row:
-                new_weight_table.append(new_row)
-                new_row = self.find_comid_weight_table(comid, weight_table)
-                row_count += 1
-            if row_count <= 0:
-                #add rows for each flowline not in catchment
-                new_replacement_row = [comid]
-                new_replacement_row.extend(replacement_row)
-                #FEATUREID,area_sqm,lon_index,lat_index,npoints,weight,Lon,Lat
-                new_weight_table.append(new_replacement_row)
-
-
-        #print to file
-        with open(out_WeightTable, 'wb') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerows(new_weight_table)
-
-
+        with open(in_WeightTable, 'rb') as weight_file:
+            #index the rows of each catchment comid
+            header, first_row, comid_runs = self.index_weight_table(weight_file)
+
+            #FEATUREID,area_sqm,lon_index,lat_index,npoints,weight,Lon,Lat
+            replacement_row = first_row[1:]
+            #set area_sqm to zero
+            replacement_row[0] = 0
+            #set npoints to one
+            replacement_row[3] = 1
+
+            with open(in_ConnectivityFile, 'rb') as connectivity_file, \
+                 open(out_WeightTable, 'wb') as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(header)
+
+                #stream all flowline comids
+                for connectivity_row in csv.reader(connectivity_file):
+                    comid = self.comid_of_row(connectivity_row)
+                    if comid is None:
+                        continue
+                    #delete rows in catchment but not in flowline, each row is written once
+                    runs = comid_runs.pop(comid, None)
+                    if runs:
+                        for new_row in self.read_comid_rows(weight_file, runs):
+                            new_row[0] = comid
+                            writer.writerow(new_row)
+                    else:
+                        #add rows for each flowline not in catchment
+                        new_replacement_row = [comid]
+                        new_replacement_row.extend(replacement_row)
+                        #FEATUREID,area_sqm,lon_index,lat_index,npoints,weight,Lon,Lat
+                        writer.writerow(new_replacement_row)
 
         return
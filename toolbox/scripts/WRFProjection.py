@@ -0,0 +1,338 @@
+'''-------------------------------------------------------------------------------
+ Source Name: WRFProjection.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: Map projections of the WRF geogrid (MAP_PROJ = 1, 2, 3, 6) on the
+              WRF sphere, computed with NumPy from the global attributes of the
+              geogrid file. Maps longitude/latitude to projected coordinates and to
+              fractional west_east/south_north indices of the grid cells, and back.
+ History:     Initial coding - 10/16/2026, version 1.0
+              Version 1.1, 10/16/2026, added the identity of the grid for the grid cell cache
+              Version 1.2, 10/16/2026, clip the catchments against the grid cells with NumPy
+-------------------------------------------------------------------------------'''
+import math
+import hashlib
+import numpy as NUM
+from WeightTableEngine import ring_area, ring_coverage, weight_table_pieces
+
+# Radius (m) of the sphere of the WRF model
+WRF_EARTH_RADIUS = 6370000.0
+
+# Global attributes of the geogrid file that define the map projection and the grid
+PROJECTION_ATTRIBUTES = ["MAP_PROJ", "corner_lats", "corner_lons", "DX", "DY",
+                         "TRUELAT1", "TRUELAT2", "STAND_LON", "POLE_LAT",
+                         "POLE_LON", "CEN_LAT"]
+
+
+class WRFProjection(object):
+    """Map projection and grid of a WRF geogrid file
+
+       The projected coordinates are those of the projection in self.wkt (false
+       easting and northing of 0), in meters on the WRF sphere. The cell (i, j)
+       of the mass grid, i along west_east and j along south_north, is centered
+       at index (i, j); the center of cell (0, 0) is the first corner point.
+
+       attributes -- dict of the PROJECTION_ATTRIBUTES of the geogrid file
+    """
+    # Smallest area (m2) of a piece of catchment kept in the weight table
+    min_area = 1.0e-3
+
+    def __init__(self, attributes, size_xdim=None, size_ydim=None):
+        self.map_proj = int(attributes['MAP_PROJ'])
+        self.dx = float(attributes['DX'])
+        self.dy = float(attributes['DY'])
+        self.truelat1 = float(attributes['TRUELAT1'])
+        self.truelat2 = float(attributes['TRUELAT2'])
+        self.stand_lon = float(attributes['STAND_LON'])
+        self.cen_lat = float(attributes['CEN_LAT'])
+        self.pole_lat = float(attributes['POLE_LAT'])
+        self.pole_lon = float(attributes['POLE_LON'])
+        self.size_xdim = size_xdim
+        self.size_ydim = size_ydim
+        self.radius = WRF_EARTH_RADIUS
+
+        if self.map_proj == 1:
+            # Lambert Conformal Conic, secant at TRUELAT1 and TRUELAT2
+            phi1 = math.radians(self.truelat1)
+            phi2 = math.radians(self.truelat2)
+            if abs(self.truelat1 - self.truelat2) < 1.0e-7:
+                self.cone = math.sin(phi1)
+            else:
+                self.cone = (math.log(math.cos(phi1) / math.cos(phi2)) /
+                             math.log(math.tan(math.pi / 4 + phi2 / 2) /
+                                      math.tan(math.pi / 4 + phi1 / 2)))
+            self.cone_f = math.cos(phi1) * math.tan(math.pi / 4 + phi1 / 2)**self.cone / self.cone
+            self.rho0 = self.lcc_rho(self.cen_lat)
+        elif self.map_proj == 2:
+            # Polar Stereographic, true at TRUELAT1, about the pole of its hemisphere
+            self.hemisphere = 1.0 if self.truelat1 >= 0 else -1.0
+            self.scale_k = 1 + math.sin(math.radians(abs(self.truelat1)))
+        elif self.map_proj not in (3, 6):
+            raise ValueError("Unsupported map projection: MAP_PROJ = {0}".format(self.map_proj))
+
+        corner_lons = NUM.atleast_1d(attributes['corner_lons'])
+        corner_lats = NUM.atleast_1d(attributes['corner_lats'])
+        self.x0, self.y0 = self.to_xy(float(corner_lons[0]), float(corner_lats[0]))
+
+    @classmethod
+    def from_dataset(cls, data_nc):
+        """Projection of an open netCDF4 geogrid dataset"""
+        attributes = dict((each, data_nc.getncattr(each)) for each in PROJECTION_ATTRIBUTES)
+        return cls(attributes, len(data_nc.dimensions['west_east']),
+                   len(data_nc.dimensions['south_north']))
+
+    @property
+    def rotated_pole(self):
+        """Whether a cylindrical equidistant grid has a rotated pole, which is not applied"""
+        return self.map_proj == 6 and (abs(self.pole_lat - 90) > 1.0e-7 or abs(self.pole_lon) > 1.0e-7)
+
+    @property
+    def identity(self):
+        """Hexadecimal digest of the projection and the grid, which identify the grid cells"""
+        parameters = [self.dx, self.dy, self.truelat1, self.truelat2, self.stand_lon,
+                      self.cen_lat, self.pole_lat, self.pole_lon, self.x0, self.y0]
+        description = "WRFProjection {0} {1} {2} {3}".format(self.map_proj, self.size_xdim, self.size_ydim,
+                                                             " ".join(repr(float(each)) for each in parameters))
+        return hashlib.sha1(description.encode('ascii')).hexdigest()
+
+    def lcc_rho(self, lat):
+        """Radius of the parallels of lat in the Lambert Conformal Conic projection"""
+        return self.radius * self.cone_f / NUM.tan(NUM.pi / 4 + NUM.radians(lat) / 2)**self.cone
+
+    def delta_lon(self, lon):
+        """Longitude from STAND_LON in radians, in [-pi, pi)"""
+        return NUM.radians((NUM.asarray(lon, dtype=NUM.float64) - self.stand_lon + 180) % 360 - 180)
+
+    def to_xy(self, lon, lat):
+        """Projected coordinates in meters of longitudes/latitudes in degrees"""
+        lat = NUM.asarray(lat, dtype=NUM.float64)
+        dlon = self.delta_lon(lon)
+        if self.map_proj == 1:
+            rho = self.lcc_rho(lat)
+            theta = self.cone * dlon
+            return rho * NUM.sin(theta), self.rho0 - rho * NUM.cos(theta)
+        if self.map_proj == 2:
+            h = self.hemisphere
+            rho = self.radius * self.scale_k * NUM.tan(NUM.pi / 4 - h * NUM.radians(lat) / 2)
+            return rho * NUM.sin(dlon), -h * rho * NUM.cos(dlon)
+        scale = self.radius * math.cos(math.radians(self.truelat1))
+        if self.map_proj == 3:
+            return scale * dlon, scale * NUM.log(NUM.tan(NUM.pi / 4 + NUM.radians(lat) / 2))
+        return scale * dlon, self.radius * NUM.radians(lat)
+
+    def to_lonlat(self, x, y):
+        """Longitudes/latitudes in degrees of projected coordinates in meters"""
+        x = NUM.asarray(x, dtype=NUM.float64)
+        y = NUM.asarray(y, dtype=NUM.float64)
+        if self.map_proj == 1:
+            sign = 1.0 if self.cone >= 0 else -1.0
+            rho = sign * NUM.hypot(x, self.rho0 - y)
+            theta = NUM.arctan2(sign * x, sign * (self.rho0 - y))
+            lat = 2 * NUM.arctan((self.radius * self.cone_f / rho)**(1 / self.cone)) - NUM.pi / 2
+            dlon = theta / self.cone
+        elif self.map_proj == 2:
+            h = self.hemisphere
+            rho = NUM.hypot(x, y)
+            lat = h * (NUM.pi / 2 - 2 * NUM.arctan(rho / (self.radius * self.scale_k)))
+            dlon = NUM.arctan2(x, -h * y)
+        else:
+            scale = self.radius * math.cos(math.radians(self.truelat1))
+            dlon = x / scale
+            if self.map_proj == 3:
+                lat = 2 * NUM.arctan(NUM.exp(y / scale)) - NUM.pi / 2
+            else:
+                lat = y / self.radius
+        lon = (NUM.degrees(dlon) + self.stand_lon + 180) % 360 - 180
+        return lon, NUM.degrees(lat)
+
+    def to_index(self, lon, lat):
+        """Fractional west_east and south_north indices of longitudes/latitudes
+
+           The cell (i, j) spans the indices from i - 0.5 to i + 0.5 and from
+           j - 0.5 to j + 0.5.
+        """
+        return self.xy_to_index(*self.to_xy(lon, lat))
+
+    def xy_to_index(self, x, y):
+        """Fractional west_east and south_north indices of projected coordinates"""
+        return ((NUM.asarray(x, dtype=NUM.float64) - self.x0) / self.dx,
+                (NUM.asarray(y, dtype=NUM.float64) - self.y0) / self.dy)
+
+    def cell_positions(self, x, y):
+        """west_east and south_north indices of the cells at the projected coordinates, clipped to the grid"""
+        i, j = self.xy_to_index(x, y)
+        return (NUM.clip(NUM.floor(i + 0.5), 0, self.size_xdim - 1).astype(NUM.int64),
+                NUM.clip(NUM.floor(j + 0.5), 0, self.size_ydim - 1).astype(NUM.int64))
+
+    def area_scale(self, lon, lat):
+        """Projected area per unit of area on the sphere at longitudes/latitudes in degrees"""
+        lat = NUM.radians(NUM.asarray(lat, dtype=NUM.float64))
+        if self.map_proj == 1:
+            return (self.cone * self.lcc_rho(NUM.degrees(lat)) / (self.radius * NUM.cos(lat)))**2
+        if self.map_proj == 2:
+            return (self.scale_k / (1 + self.hemisphere * NUM.sin(lat)))**2
+        scale = math.cos(math.radians(self.truelat1)) / NUM.cos(lat)
+        if self.map_proj == 3:
+            return scale**2
+        return scale
+
+    def index_to_xy(self, i, j):
+        """Projected coordinates of fractional west_east and south_north indices"""
+        return (self.x0 + NUM.asarray(i, dtype=NUM.float64) * self.dx,
+                self.y0 + NUM.asarray(j, dtype=NUM.float64) * self.dy)
+
+    def subdomain(self, lon, lat, size_buffer=3):
+        """Index ranges of the cells within size_buffer cells of the points (lon, lat)
+
+           Returns the first and last west_east and south_north indices, clipped
+           to the grid if its size is known, or None if no point is given.
+        """
+        i, j = self.to_index(NUM.ravel(lon), NUM.ravel(lat))
+        if i.size == 0:
+            return None
+        i_min = int(NUM.floor(i.min() + 0.5)) - size_buffer
+        i_max = int(NUM.floor(i.max() + 0.5)) + size_buffer
+        j_min = int(NUM.floor(j.min() + 0.5)) - size_buffer
+        j_max = int(NUM.floor(j.max() + 0.5)) + size_buffer
+        if self.size_xdim is not None:
+            i_min, i_max = max(i_min, 0), min(i_max, self.size_xdim - 1)
+        if self.size_ydim is not None:
+            j_min, j_max = max(j_min, 0), min(j_max, self.size_ydim - 1)
+        return i_min, i_max, j_min, j_max
+
+    def contains(self, lon, lat):
+        """Whether all the points (lon, lat) are within the grid"""
+        i, j = self.to_index(lon, lat)
+        return bool((i >= -0.5).all() and (i <= self.size_xdim - 0.5).all() and
+                    (j >= -0.5).all() and (j <= self.size_ydim - 0.5).all())
+
+    def cell_polygons(self, i_min, i_max, j_min, j_max):
+        """Corners of the cells of a subdomain in projected coordinates
+
+           Returns the west_east and south_north indices of the cells, row by row
+           from the south, the projected coordinates of their centers, and their
+           corners as an array of shape (cells, 5, 2) of closed clockwise rings.
+        """
+        j, i = NUM.mgrid[j_min:j_max + 1, i_min:i_max + 1]
+        i = i.ravel()
+        j = j.ravel()
+        x, y = self.index_to_xy(i, j)
+        half_x = self.dx / 2
+        half_y = self.dy / 2
+        corners = NUM.empty((len(i), 5, 2))
+        corners[:, :, 0] = x[:, NUM.newaxis] + NUM.array([-half_x, -half_x, half_x, half_x, -half_x])
+        corners[:, :, 1] = y[:, NUM.newaxis] + NUM.array([-half_y, half_y, half_y, -half_y, -half_y])
+        return i, j, x, y, corners
+
+    def polygon_coverage(self, polygon):
+        """Area in square meters on the sphere of a polygon within each grid cell
+
+           polygon is a list of rings of projected (x, y) vertices, the exterior
+           ring first and the holes after it, in any orientation. The planar area
+           of the part of the polygon in each cell is exact; it is divided by the
+           area scale of the projection at the centroid of the part, which differs
+           from the geodesic area by about (cell size / earth radius)**2.
+           Returns the west_east index, the south_north index and the area of each
+           cell covered.
+        """
+        x_edges = self.x0 + (NUM.arange(self.size_xdim + 1) - 0.5) * self.dx
+        y_edges = self.y0 + (NUM.arange(self.size_ydim + 1) - 0.5) * self.dy
+        list_cell = []
+        list_area = []
+        list_moment_x = []
+        list_moment_y = []
+        for k, ring in enumerate(polygon):
+            ring = NUM.asarray(ring, dtype=NUM.float64)
+            if len(ring) < 3:
+                continue
+            # The exterior ring adds area and the holes remove it
+            sign = NUM.sign(ring_area(ring[:, 0], ring[:, 1])) * (1 if k == 0 else -1)
+            col, row, area, center_x, center_y = ring_coverage(ring[:, 0], ring[:, 1], x_edges,
+                                                               y_edges, centroids=True)
+            list_cell.append(row * self.size_xdim + col)
+            list_area.append(sign * area)
+            list_moment_x.append(sign * area * center_x)
+            list_moment_y.append(sign * area * center_y)
+        if not list_cell:
+            return (NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0))
+
+        cell_unique, inverse = NUM.unique(NUM.concatenate(list_cell), return_inverse=True)
+        inverse = inverse.ravel()
+        area = NUM.bincount(inverse, weights=NUM.concatenate(list_area))
+        keep = area > 0
+        center_x = NUM.bincount(inverse, weights=NUM.concatenate(list_moment_x))[keep] / area[keep]
+        center_y = NUM.bincount(inverse, weights=NUM.concatenate(list_moment_y))[keep] / area[keep]
+        area = area[keep] / self.area_scale(*self.to_lonlat(center_x, center_y))
+        cell_unique = cell_unique[keep][area > self.min_area]
+        return (cell_unique % self.size_xdim, cell_unique // self.size_xdim, area[area > self.min_area])
+
+    def intersect_catchments(self, catchments):
+        """Pieces of the catchments in each grid cell
+
+           catchments is an iterable of (stream ID, list of polygons) pairs in
+           projected coordinates, as returned by parse_wkb.
+           Returns a structured array with the stream ID, the area in square meters,
+           the west_east and south_north indices in lon_index and lat_index, and the
+           lon and lat of the center of the cell of each piece.
+        """
+        list_stream = [NUM.zeros(0, dtype=NUM.int64)]
+        list_pieces = [(NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0))]
+        for stream_id, polygons in catchments:
+            for polygon in polygons:
+                pieces = self.polygon_coverage(polygon)
+                list_stream.append(NUM.repeat(int(stream_id), len(pieces[0])))
+                list_pieces.append(pieces)
+
+        i = NUM.concatenate([each[0] for each in list_pieces])
+        j = NUM.concatenate([each[1] for each in list_pieces])
+        lon, lat = self.to_lonlat(*self.index_to_xy(i, j))
+        return weight_table_pieces(NUM.concatenate(list_stream),
+                                   NUM.concatenate([each[2] for each in list_pieces]), i, j, lon, lat)
+
+    @property
+    def wkt(self):
+        """Well-known text of the projected coordinate system on the WRF sphere"""
+        geogcs = ('GEOGCS["GCS_Sphere",'
+                  'DATUM["D_Sphere",SPHEROID["Sphere",6370000.0,0.0]],'
+                  'PRIMEM["Greenwich",0.0],'
+                  'UNIT["Degree",0.0174532925199433]],')
+        if self.map_proj == 1:
+            # Lambert Conformal Conic
+            return ('PROJCS["North_America_Lambert_Conformal_Conic",' + geogcs +
+                    'PROJECTION["Lambert_Conformal_Conic"],'
+                    'PARAMETER["false_easting",0.0],'
+                    'PARAMETER["false_northing",0.0],'
+                    'PARAMETER["central_meridian",' + str(self.stand_lon) + '],'
+                    'PARAMETER["standard_parallel_1",' + str(self.truelat1) + '],'
+                    'PARAMETER["standard_parallel_2",' + str(self.truelat2) + '],'
+                    'PARAMETER["latitude_of_origin",' + str(self.cen_lat) + '],'
+                    'UNIT["Meter",1.0]]')
+        if self.map_proj == 2:
+            # Polar Stereographic
+            pole = 'North' if self.hemisphere > 0 else 'South'
+            return ('PROJCS["Sphere_Stereographic_' + pole + '_Pole",' + geogcs +
+                    'PROJECTION["Stereographic_' + pole + '_Pole"],'
+                    'PARAMETER["False_Easting",0.0],'
+                    'PARAMETER["False_Northing",0.0],'
+                    'PARAMETER["Central_Meridian",' + str(self.stand_lon) + '],'
+                    'PARAMETER["Standard_Parallel_1",' + str(self.truelat1) + '],'
+                    'UNIT["Meter",1.0]]')
+        if self.map_proj == 3:
+            # Mercator Projection
+            return ('PROJCS["Sphere_Mercator",' + geogcs +
+                    'PROJECTION["Mercator"],'
+                    'PARAMETER["False_Easting",0.0],'
+                    'PARAMETER["False_Northing",0.0],'
+                    'PARAMETER["Central_Meridian",' + str(self.stand_lon) + '],'
+                    'PARAMETER["Standard_Parallel_1",' + str(self.truelat1) + '],'
+                    'UNIT["Meter",1.0],AUTHORITY["ESRI",53004]]')
+        # Cylindrical Equidistant
+        return ('PROJCS["Sphere_Equidistant_Cylindrical",' + geogcs +
+                'PROJECTION["Equidistant_Cylindrical"],'
+                'PARAMETER["False_Easting",0.0],'
+                'PARAMETER["False_Northing",0.0],'
+                'PARAMETER["Central_Meridian",' + str(self.stand_lon) + '],'
+                'PARAMETER["Standard_Parallel_1",' + str(self.truelat1) + '],'
+                'UNIT["Meter",1.0],AUTHORITY["ESRI",53002]]')
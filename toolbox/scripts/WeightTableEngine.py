@@ -0,0 +1,952 @@
+'''-------------------------------------------------------------------------------
+ Source Name: WeightTableEngine.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: Shared computation engine of the Create Weight Table tools. Catchment
+              polygons are clipped against the cells of a rectilinear computational
+              grid directly with NumPy, without creating Thiessen polygons or running
+              a GIS intersection. The catchments are read from plain GeoJSON or WKB,
+              so the engine also runs without a GIS backend:
+
+                  python WeightTableEngine.py runoff.nc rapid_connect.csv
+                                              catchments.geojson COMID weight_table.csv
+ History:     Initial coding - 10/16/2026, version 1.0
+              Version 1.1, 10/16/2026, look up the grid indices of points with a binary search
+                and write the weight table in one bulk write
+              Version 1.1, 10/16/2026, group the rows by stream ID with one stable sort
+              Version 1.2, 10/16/2026, added the identity, subdomains and cell polygons of
+                the grid for the grid cell cache
+              Version 1.3, 10/16/2026, intersect the catchments tile by tile on a pool of
+                processes, and added the centroids of the parts of the rings in the cells
+              Version 1.4, 10/16/2026, added the areas on the ellipsoid of ragged arrays of rings
+              Version 1.5, 10/16/2026, update a previous weight table by intersecting only the
+                catchment features whose geometry hashes changed
+              Version 1.6, 10/16/2026, aggregate the pieces of a finer grid into the cells of a
+                grid in which its cells nest
+-------------------------------------------------------------------------------'''
+import os
+import sys
+import csv
+import json
+import math
+import hashlib
+import struct
+import multiprocessing
+import numpy as NUM
+
+# Semi-major axis (m) and flattening of the WGS 84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+
+def equal_area_x(lon, a=WGS84_A):
+    """Easting in meters of the longitudes in the cylindrical equal-area projection"""
+    return a * NUM.radians(lon)
+
+
+def equal_area_y(lat, a=WGS84_A, f=WGS84_F):
+    """Northing in meters of the latitudes in the cylindrical equal-area projection
+
+       Area is preserved on the ellipsoid, so the planar area of a polygon with
+       these coordinates is its area on the ellipsoid.
+    """
+    e2 = f * (2 - f)
+    e = NUM.sqrt(e2)
+    sin_lat = NUM.sin(NUM.radians(lat))
+    q = (1 - e2) * (sin_lat / (1 - e2 * sin_lat**2) -
+                    NUM.log((1 - e * sin_lat) / (1 + e * sin_lat)) / (2 * e))
+    return a * q / 2
+
+
+def authalic_sphere(lat, a=WGS84_A, f=WGS84_F):
+    """Authalic latitudes in radians of the latitudes in degrees, and the authalic radius
+
+       The sphere of the authalic radius has the area of the ellipsoid, and the
+       authalic latitudes map the ellipsoid onto it preserving area.
+    """
+    if f == 0:
+        return NUM.radians(lat), a
+    y_pole = equal_area_y(90.0, a, f)
+    sin_beta = NUM.clip(equal_area_y(lat, a, f) / y_pole, -1, 1)
+    return NUM.arcsin(sin_beta), a * math.sqrt(y_pole / a)
+
+
+def ring_areas(lon, lat, ring_offsets, a=WGS84_A, f=WGS84_F):
+    """Signed areas in square meters on the ellipsoid of rings of longitude/latitude vertices
+
+       The rings are stored one after the other in the ragged arrays lon and lat,
+       ring k from ring_offsets[k] to ring_offsets[k + 1], closed or not. Each
+       edge is the great circle between its vertices on the authalic sphere, whose
+       signed area with the equator is added up by ring; areas are positive for
+       counterclockwise rings. With f = 0 the areas are on the sphere of radius a.
+       These edges differ slightly from the geodesics of the ellipsoid: each edge
+       of length L changes the area by at most about f * L**3 / a, i.e. under
+       1 m2 for edges up to 1 km, and the areas of grid cells up to 0.5 degrees
+       are within 1e-5 of their geodesic areas. On the sphere they are exact.
+    """
+    ring_offsets = NUM.asarray(ring_offsets, dtype=NUM.int64)
+    size_ring = len(ring_offsets) - 1
+    if size_ring <= 0 or ring_offsets[-1] == 0:
+        return NUM.zeros(max(size_ring, 0))
+    lon = NUM.radians(NUM.asarray(lon, dtype=NUM.float64))
+    beta, radius = authalic_sphere(NUM.asarray(lat, dtype=NUM.float64), a, f)
+
+    # The next vertex of each vertex, the first vertex of its ring for the last one
+    size_vertex = NUM.diff(ring_offsets)
+    next_vertex = NUM.arange(1, len(lon) + 1)
+    last = ring_offsets[1:][size_vertex > 0] - 1
+    next_vertex[last] = ring_offsets[:-1][size_vertex > 0]
+
+    # Spherical excess of the triangle of each edge with the pole, from the
+    # half angle formula of the trapezoid between the edge and the equator
+    dlon = (lon[next_vertex] - lon + NUM.pi) % (2 * NUM.pi) - NUM.pi
+    t0 = NUM.tan(beta / 2)
+    t1 = t0[next_vertex]
+    excess = 2 * NUM.arctan2(NUM.tan(dlon / 2) * (t0 + t1), 1 + t0 * t1)
+    ring = NUM.repeat(NUM.arange(size_ring), size_vertex)
+    return -NUM.bincount(ring, weights=excess, minlength=size_ring) * radius**2
+
+
+def ragged_rings(features):
+    """Vertices of the rings of the features as ragged arrays
+
+       features is a list of features, each a list of polygons of rings of
+       (x, y) vertices with the exterior ring first, as returned by parse_wkb.
+       Returns x, y, the offsets of the rings in them, the feature of each ring,
+       and whether each ring is an exterior ring.
+    """
+    rings = []
+    ring_feature = []
+    ring_exterior = []
+    for k, polygons in enumerate(features):
+        for polygon in polygons:
+            for i, ring in enumerate(polygon):
+                rings.append(NUM.asarray(ring, dtype=NUM.float64).reshape(-1, 2))
+                ring_feature.append(k)
+                ring_exterior.append(i == 0)
+    ring_offsets = NUM.cumsum([0] + [len(ring) for ring in rings])
+    vertices = NUM.concatenate(rings) if rings else NUM.zeros((0, 2))
+    return (vertices[:, 0], vertices[:, 1], ring_offsets,
+            NUM.array(ring_feature, dtype=NUM.int64), NUM.array(ring_exterior, dtype=bool))
+
+
+def feature_areas(features, a=WGS84_A, f=WGS84_F):
+    """Areas in square meters on the ellipsoid of features of longitude/latitude polygons
+
+       features is a list of features, each a list of polygons of rings as
+       returned by parse_wkb. The area of the holes, in any orientation, is
+       subtracted from the area of the exterior rings. All the rings are
+       computed at once by ring_areas.
+    """
+    if not features:
+        # bincount rejects a minlength of 0 before numpy 1.14
+        return NUM.zeros(0)
+    lon, lat, ring_offsets, ring_feature, ring_exterior = ragged_rings(features)
+    area = NUM.abs(ring_areas(lon, lat, ring_offsets, a, f))
+    return NUM.bincount(ring_feature, weights=NUM.where(ring_exterior, area, -area),
+                        minlength=len(features))
+
+
+def grid_line_crossings(v0, v1, edges):
+    """Positions along the segments v0->v1 (from 0 to 1) where they cross the grid lines at edges
+
+       Returns the index of the segment of each crossing and its position.
+    """
+    lo = NUM.minimum(v0, v1)
+    hi = NUM.maximum(v0, v1)
+    k0 = NUM.searchsorted(edges, lo, 'right')
+    count = NUM.maximum(NUM.searchsorted(edges, hi, 'left') - k0, 0)
+    segment = NUM.repeat(NUM.arange(len(v0)), count)
+    offsets = NUM.cumsum(count) - count
+    k = k0[segment] + NUM.arange(len(segment)) - offsets[segment]
+    return segment, (edges[k] - v0[segment]) / (v1 - v0)[segment]
+
+
+def ring_coverage(x, y, x_edges, y_edges, centroids=False):
+    """Signed area of a closed ring within each cell of a rectilinear grid
+
+       x_edges and y_edges are the increasing coordinates of the cell edges. The
+       edges of the ring are split at every grid line, so that each piece lies in
+       a single cell; by Green's theorem each piece adds the area between itself
+       and the bottom of its cell to that cell, and the full height of the cells
+       below it in the same column. Parts of the ring outside the grid are clipped.
+       Returns the column, the row and the area of the cells covered by the ring,
+       positive for counterclockwise rings, and with centroids the x and y of the
+       centroid of the part of the ring in each cell.
+    """
+    x = NUM.asarray(x, dtype=NUM.float64)
+    y = NUM.asarray(y, dtype=NUM.float64)
+    if len(x) > 1 and x[0] == x[-1] and y[0] == y[-1]:
+        x = x[:-1]
+        y = y[:-1]
+    size_col = len(x_edges) - 1
+    size_row = len(y_edges) - 1
+    empty = (NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0))
+    if centroids:
+        empty += (NUM.zeros(0), NUM.zeros(0))
+    if len(x) < 3:
+        return empty
+
+    # Split the edges of the ring at the grid lines
+    x0, y0 = x, y
+    x1, y1 = NUM.roll(x, -1), NUM.roll(y, -1)
+    edge_x, t_x = grid_line_crossings(x0, x1, x_edges)
+    edge_y, t_y = grid_line_crossings(y0, y1, y_edges)
+    size_edge = len(x)
+    edge = NUM.concatenate([NUM.arange(size_edge), NUM.arange(size_edge), edge_x, edge_y])
+    t = NUM.concatenate([NUM.zeros(size_edge), NUM.ones(size_edge), t_x, t_y])
+    order = NUM.lexsort((t, edge))
+    edge = edge[order]
+    t = t[order]
+    px = x0[edge] + t * (x1 - x0)[edge]
+    py = y0[edge] + t * (y1 - y0)[edge]
+
+    # Pieces between consecutive points of the same edge
+    same = edge[1:] == edge[:-1]
+    ax = px[:-1][same]
+    bx = px[1:][same]
+    ay = py[:-1][same]
+    by = py[1:][same]
+    col = NUM.searchsorted(x_edges, (ax + bx) / 2, 'right') - 1
+    row = NUM.searchsorted(y_edges, (ay + by) / 2, 'right') - 1
+    # Pieces left, right or below the grid add no area; pieces above it are
+    # clipped to its top and only add the full height of the cells below them
+    inside = (col >= 0) & (col < size_col) & (row >= 0) & (bx != ax)
+    if not inside.any():
+        return empty
+    col = col[inside]
+    row = NUM.minimum(row[inside], size_row)
+    in_row = row < size_row
+    dx = (bx - ax)[inside]
+    mid_y = NUM.minimum((ay + by)[inside] / 2, y_edges[-1])
+    y_bottom = y_edges[NUM.minimum(row, size_row - 1)]
+
+    # Accumulate the pieces in the columns and rows spanned by the ring
+    min_col, max_col = col.min(), col.max()
+    min_row, max_row = row.min(), row.max()
+    size_local_row = max_row - min_row + 1
+    local = (col - min_col) * size_local_row + (row - min_row)
+    size_local = (max_col - min_col + 1) * size_local_row
+
+    def accumulate(partial_weights, full_weights):
+        """Sums of the weights of the pieces in each cell, and of the pieces above it"""
+        partial = NUM.bincount(local, weights=partial_weights, minlength=size_local)
+        full = NUM.bincount(local, weights=full_weights, minlength=size_local)
+        partial = partial.reshape(-1, size_local_row)
+        full = full.reshape(-1, size_local_row)
+        above = full[:, ::-1].cumsum(axis=1)[:, ::-1] - full
+        return partial[:, :len(rows)], above[:, :len(rows)]
+
+    # Add the full height of each cell for the pieces above it in the same column
+    rows = NUM.arange(min_row, min(max_row, size_row - 1) + 1)
+    height = NUM.diff(y_edges)[rows]
+    partial, above = accumulate(-dx * (mid_y - y_bottom) * in_row, -dx)
+    area = partial + above * height
+
+    cols_local, rows_local = NUM.nonzero(area)
+    result = (cols_local + min_col, rows_local + min_row, area[cols_local, rows_local])
+    if not centroids:
+        return result
+
+    # First moments about the corner of the cells spanned by the ring, which keeps
+    # the products of coordinates small, from the same pieces and strips
+    x_ref = x_edges[min_col]
+    y_ref = y_edges[min_row]
+    ax = ax[inside] - x_ref
+    bx = bx[inside] - x_ref
+    fa = NUM.minimum(ay[inside], y_edges[-1]) - y_bottom
+    fb = NUM.minimum(by[inside], y_edges[-1]) - y_bottom
+    y_base = y_bottom - y_ref
+    # Integrals along each piece of x * (y - y_bottom) and of (y^2 - y_bottom^2) / 2
+    partial_x, above_x = accumulate(-dx * ((ax * fa + bx * fb) / 3 + (ax * fb + bx * fa) / 6) * in_row,
+                                    -dx * (ax + bx) / 2)
+    partial_y = accumulate(-dx * ((fa * fa + fa * fb + fb * fb) / 3 / 2 + y_base * (fa + fb) / 2) *
+                           in_row, -dx)[0]
+    cell_bottom = y_edges[rows] - y_ref
+    moment_x = partial_x + above_x * height
+    moment_y = partial_y + above * height * (cell_bottom + height / 2)
+    area_cells = result[2]
+    return result + (moment_x[cols_local, rows_local] / area_cells + x_ref,
+                     moment_y[cols_local, rows_local] / area_cells + y_ref)
+
+
+def nearest_indices(values, sorted_values, tolerance, period=None):
+    """Positions in the increasing sorted_values of the values nearest to each of values
+
+       With a period (e.g. 360 for longitudes), the values wrap around, so that a
+       value beyond the last sorted value may be nearest to the first one.
+       Raises ValueError if a value is farther than tolerance from its nearest value.
+    """
+    values = NUM.asarray(values, dtype=NUM.float64)
+    sorted_values = NUM.asarray(sorted_values, dtype=NUM.float64)
+    size = len(sorted_values)
+    if period is not None:
+        values = (values - sorted_values[0]) % period + sorted_values[0]
+    pos = NUM.searchsorted(sorted_values, values)
+    lower = NUM.maximum(pos - 1, 0)
+    upper = NUM.minimum(pos, size - 1)
+    value_upper = sorted_values[upper]
+    if period is not None:
+        # Beyond the last value, the next value is the first one a period later
+        upper = NUM.where(pos == size, 0, upper)
+        value_upper = NUM.where(pos == size, sorted_values[0] + period, value_upper)
+    distance_lower = NUM.abs(values - sorted_values[lower])
+    distance_upper = NUM.abs(value_upper - values)
+    nearest = NUM.where(distance_upper < distance_lower, upper, lower)
+    distance = NUM.minimum(distance_lower, distance_upper)
+    if (distance > tolerance).any():
+        raise ValueError("{0} points are farther than {1} from the grid points, e.g. {2}".format(
+                         (distance > tolerance).sum(), tolerance,
+                         values[NUM.argmax(distance)]))
+    return nearest
+
+
+def group_rows(stream_id, streamID_list):
+    """Group the rows of stream_id by the stream IDs of streamID_list with one stable sort
+
+       Returns the row indices sorted by stream ID, keeping the order of the rows
+       of each stream, and the start and end positions in it of the rows of each
+       stream ID of streamID_list (equal if the stream ID has no rows).
+    """
+    stream_id = NUM.asarray(stream_id)
+    order = NUM.argsort(stream_id, kind='mergesort')
+    sorted_id = stream_id[order]
+    ids = NUM.asarray(streamID_list, dtype=sorted_id.dtype)
+    return order, NUM.searchsorted(sorted_id, ids, 'left'), NUM.searchsorted(sorted_id, ids, 'right')
+
+
+def weight_table_pieces(stream_id, area_sqm, lon_index, lat_index, lon, lat):
+    """Structured array of the pieces of the catchments in the grid cells"""
+    pieces = NUM.zeros(len(stream_id),
+                       dtype=[('stream_id', NUM.int64), ('area_sqm', NUM.float64),
+                              ('lon_index', NUM.int64), ('lat_index', NUM.int64),
+                              ('lon', NUM.float64), ('lat', NUM.float64)])
+    pieces['stream_id'] = stream_id
+    pieces['area_sqm'] = area_sqm
+    pieces['lon_index'] = lon_index
+    pieces['lat_index'] = lat_index
+    pieces['lon'] = lon
+    pieces['lat'] = lat
+    return pieces
+
+
+def ring_area(x, y):
+    """Signed planar area of a ring, positive if counterclockwise"""
+    x = NUM.asarray(x, dtype=NUM.float64)
+    y = NUM.asarray(y, dtype=NUM.float64)
+    return (NUM.dot(x, NUM.roll(y, -1)) - NUM.dot(NUM.roll(x, -1), y)) / 2
+
+
+class LatLonGrid(object):
+    """Rectilinear latitude/longitude grid whose cells are centered at the grid points
+
+       The cell edges lie halfway between neighboring grid points, the same cells
+       as the Thiessen polygons of the grid points. A grid that spans the globe in
+       longitude wraps around the 180th meridian.
+
+       lon, lat -- 1-D longitudes and latitudes of the grid points in degrees
+    """
+    # Smallest area (m2) of a piece of catchment kept in the weight table
+    min_area = 1.0e-3
+    # Largest distance of a point from its grid point, as a fraction of the grid spacing
+    point_tolerance = 0.01
+
+    def __init__(self, lon, lat):
+        # Keep the precision of the runoff file, as in the lon and lat of the weight table
+        self.lon = (NUM.asarray(lon) + 180) % 360 - 180
+        self.lat = NUM.asarray(lat)
+        self.lon_order = NUM.argsort(self.lon, kind='mergesort')
+        self.lat_order = NUM.argsort(self.lat, kind='mergesort')
+
+        lon_edges = self.cell_edges(self.lon[self.lon_order].astype(NUM.float64))
+        lat_edges = NUM.clip(self.cell_edges(self.lat[self.lat_order].astype(NUM.float64)), -90, 90)
+        self.lon_edges = lon_edges
+        self.lat_edges = lat_edges
+        size_lon = len(self.lon)
+        self.size_xdim = size_lon
+        self.size_ydim = len(self.lat)
+        self.periodic = size_lon > 1 and abs(lon_edges[-1] - lon_edges[0] - 360) < 1.0e-3
+        if self.periodic:
+            # Copies of the cells one period to the west and to the east
+            lon_edges = NUM.concatenate([lon_edges[:-1] - 360, lon_edges[:-1],
+                                         lon_edges[:-1] + 360, lon_edges[-1:] + 360])
+        self.x_edges = equal_area_x(lon_edges)
+        self.y_edges = equal_area_y(lat_edges)
+
+    @property
+    def identity(self):
+        """Hexadecimal digest of the longitudes and latitudes, which identify the grid cells"""
+        digest = hashlib.sha1(b'LatLonGrid')
+        for each in (self.lon, self.lat):
+            digest.update(str(each.shape).encode('ascii'))
+            data = NUM.ascontiguousarray(each, dtype=NUM.float64)
+            # tobytes only exists from numpy 1.9 and tostring was removed in numpy 2.3
+            digest.update(data.tobytes() if hasattr(data, 'tobytes') else data.tostring())
+        return digest.hexdigest()
+
+    def subdomain(self, lon, lat, size_buffer=2):
+        """Ranges of the cells within size_buffer cells of the points (lon, lat)
+
+           The cells are numbered by increasing longitude and latitude, as in
+           cell_polygons. Returns the first and last of each, or None if no point
+           is given. Points across the 180th meridian of a global grid are not
+           wrapped, so a basin that straddles it gets all the longitudes.
+        """
+        if NUM.size(lon) == 0:
+            return None
+        i, j = self.cell_positions(lon, lat)
+        return (max(int(i.min()) - size_buffer, 0), min(int(i.max()) + size_buffer, self.size_xdim - 1),
+                max(int(j.min()) - size_buffer, 0), min(int(j.max()) + size_buffer, self.size_ydim - 1))
+
+    def cell_positions(self, lon, lat):
+        """Positions of the cells at the points (lon, lat) by increasing longitude and latitude"""
+        lon = (NUM.ravel(lon).astype(NUM.float64) + 180) % 360 - 180
+        lat = NUM.ravel(lat).astype(NUM.float64)
+        return (NUM.clip(NUM.searchsorted(self.lon_edges, lon, 'right') - 1, 0, self.size_xdim - 1),
+                NUM.clip(NUM.searchsorted(self.lat_edges, lat, 'right') - 1, 0, self.size_ydim - 1))
+
+    def cell_polygons(self, i_min, i_max, j_min, j_max):
+        """Corners of the cells of a subdomain in degrees
+
+           i and j number the cells by increasing longitude and latitude. Returns
+           the lon and lat indices of the cells, row by row from the south, the lon
+           and lat of their grid points, and their corners as an array of shape
+           (cells, 5, 2) of closed clockwise rings.
+        """
+        j, i = NUM.mgrid[j_min:j_max + 1, i_min:i_max + 1]
+        i = i.ravel()
+        j = j.ravel()
+        lon_index = self.lon_order[i]
+        lat_index = self.lat_order[j]
+        west, east = self.lon_edges[i], self.lon_edges[i + 1]
+        south, north = self.lat_edges[j], self.lat_edges[j + 1]
+        corners = NUM.empty((len(i), 5, 2))
+        corners[:, :, 0] = NUM.column_stack([west, west, east, east, west])
+        corners[:, :, 1] = NUM.column_stack([south, north, north, south, south])
+        return (lon_index, lat_index, self.lon[lon_index].astype(NUM.float64),
+                self.lat[lat_index].astype(NUM.float64), corners)
+
+    def point_indices(self, lon, lat):
+        """lon and lat indices of the grid points at the points (lon, lat)
+
+           Points are matched to the nearest grid point, across the 180th meridian
+           for a global grid. Raises ValueError if a point is farther from its grid
+           point than point_tolerance of the grid spacing, i.e. is not a grid point.
+        """
+        lon_sorted = self.lon[self.lon_order]
+        lat_sorted = self.lat[self.lat_order]
+        spacing = min(NUM.diff(lon_sorted.astype(NUM.float64)).min() if len(lon_sorted) > 1 else 1,
+                      NUM.diff(lat_sorted.astype(NUM.float64)).min() if len(lat_sorted) > 1 else 1)
+        tolerance = self.point_tolerance * spacing
+        lon_index = nearest_indices(lon, lon_sorted, tolerance, 360 if self.periodic else None)
+        lat_index = nearest_indices(lat, lat_sorted, tolerance)
+        return self.lon_order[lon_index], self.lat_order[lat_index]
+
+    @staticmethod
+    def cell_edges(centers):
+        """Edges of the cells centered at the increasing coordinates centers"""
+        if len(centers) == 1:
+            return NUM.array([centers[0] - 0.5, centers[0] + 0.5])
+        mid = (centers[1:] + centers[:-1]) / 2
+        return NUM.concatenate([[2 * centers[0] - mid[0]], mid, [2 * centers[-1] - mid[-1]]])
+
+    def polygon_coverage(self, polygon):
+        """Area in square meters of a polygon within each grid cell
+
+           polygon is a list of rings of (lon, lat) vertices, the exterior ring
+           first and the holes after it, in any orientation.
+           Returns the lon index, the lat index and the area of each cell covered.
+        """
+        list_col = []
+        list_row = []
+        list_area = []
+        for i, ring in enumerate(polygon):
+            ring = NUM.asarray(ring, dtype=NUM.float64)
+            if len(ring) < 3:
+                continue
+            x = equal_area_x(ring[:, 0])
+            y = equal_area_y(ring[:, 1])
+            # The exterior ring adds area and the holes remove it
+            sign = NUM.sign(ring_area(x, y)) * (1 if i == 0 else -1)
+            col, row, area = ring_coverage(x, y, self.x_edges, self.y_edges)
+            list_col.append(col)
+            list_row.append(row)
+            list_area.append(sign * area)
+        if not list_col:
+            return (NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0))
+
+        col = NUM.concatenate(list_col)
+        if self.periodic:
+            col %= len(self.lon)
+        row = NUM.concatenate(list_row)
+        cell = row * len(self.lon) + col
+        cell_unique, inverse = NUM.unique(cell, return_inverse=True)
+        area = NUM.bincount(inverse.ravel(), weights=NUM.concatenate(list_area))
+        keep = area > self.min_area
+        cell_unique = cell_unique[keep]
+        return (self.lon_order[cell_unique % len(self.lon)],
+                self.lat_order[cell_unique // len(self.lon)], area[keep])
+
+    def intersect_catchments(self, catchments):
+        """Pieces of the catchments in each grid cell
+
+           catchments is an iterable of (stream ID, list of polygons) pairs, as
+           returned by read_geojson_catchments or parse_wkb.
+           Returns a structured array with the stream ID, the area in square meters,
+           the lon and lat indices, and the lon and lat of the grid point of each piece.
+        """
+        list_stream = [NUM.zeros(0, dtype=NUM.int64)]
+        list_pieces = [(NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0, dtype=NUM.int64), NUM.zeros(0))]
+        for stream_id, polygons in catchments:
+            for polygon in polygons:
+                pieces = self.polygon_coverage(polygon)
+                list_stream.append(NUM.repeat(int(stream_id), len(pieces[0])))
+                list_pieces.append(pieces)
+
+        lon_index = NUM.concatenate([each[0] for each in list_pieces])
+        lat_index = NUM.concatenate([each[1] for each in list_pieces])
+        return weight_table_pieces(NUM.concatenate(list_stream),
+                                   NUM.concatenate([each[2] for each in list_pieces]),
+                                   lon_index, lat_index, self.lon[lon_index], self.lat[lat_index])
+
+    def nested_positions(self, fine):
+        """Positions of the cells of this grid that contain the cells of a finer grid
+
+           The cells of the LatLonGrid fine nest in the cells of this grid if each
+           edge of these cells is also an edge of the cells of fine, to within
+           point_tolerance of the spacing of fine. Returns the position, by
+           increasing longitude and latitude, of the cell containing each lon and
+           each lat index of fine, -1 beyond this grid, or None if the cells of
+           fine do not nest in the cells of this grid.
+        """
+        list_positions = []
+        for edges, fine_edges, fine_centers, period, fine_period in [
+                (self.lon_edges, fine.lon_edges, fine.lon, 360 if self.periodic else None,
+                 360 if fine.periodic else None),
+                (self.lat_edges, fine.lat_edges, fine.lat, None, None)]:
+            if period is not None and fine_period is None:
+                return None
+            spacing = NUM.diff(fine_edges).min()
+            try:
+                nearest_indices(edges, fine_edges if fine_period is None else fine_edges[:-1],
+                                self.point_tolerance * spacing, fine_period)
+            except ValueError:
+                return None
+            centers = NUM.asarray(fine_centers, dtype=NUM.float64)
+            if period is not None:
+                centers = (centers - edges[0]) % period + edges[0]
+            positions = NUM.searchsorted(edges, centers, 'right') - 1
+            list_positions.append(NUM.where((positions >= 0) & (positions < len(edges) - 1),
+                                            positions, -1))
+        return tuple(list_positions)
+
+    def aggregate_pieces(self, pieces, lon_positions, lat_positions):
+        """Pieces of the catchments in the cells of this grid, summed from their pieces in
+           the cells of a finer grid nested in them
+
+           pieces are the pieces in the cells of the finer grid, e.g. read from its
+           weight table, and lon_positions and lat_positions are the positions of
+           the cells of this grid containing its cells, as returned by
+           nested_positions. The streams keep the order of their first pieces, and
+           the pieces of each stream are ordered by cell, row by row from the south,
+           as intersect_catchments orders the pieces of a polygon.
+        """
+        col = lon_positions[pieces['lon_index']]
+        row = lat_positions[pieces['lat_index']]
+        keep = (col >= 0) & (row >= 0)
+        stream_id = pieces['stream_id'][keep]
+        cell = row[keep] * self.size_xdim + col[keep]
+
+        # Rank of the streams in the order of their first pieces
+        streams, first, stream_index = NUM.unique(stream_id, return_index=True, return_inverse=True)
+        rank = NUM.empty(len(streams), dtype=NUM.int64)
+        rank[NUM.argsort(first, kind='mergesort')] = NUM.arange(len(streams))
+        size_cell = self.size_xdim * self.size_ydim
+        key_unique, inverse = NUM.unique(rank[stream_index.ravel()] * size_cell + cell,
+                                         return_inverse=True)
+        area = NUM.bincount(inverse.ravel(), weights=pieces['area_sqm'][keep])
+
+        stream_by_rank = streams[NUM.argsort(first, kind='mergesort')]
+        cell_unique = key_unique % size_cell
+        lon_index = self.lon_order[cell_unique % self.size_xdim]
+        lat_index = self.lat_order[cell_unique // self.size_xdim]
+        return weight_table_pieces(stream_by_rank[key_unique // size_cell], area, lon_index,
+                                   lat_index, self.lon[lon_index], self.lat[lat_index])
+
+
+# Grid of the catchment tiles intersected in a worker process
+_tile_grid = {}
+
+
+def initialize_tile_worker(grid):
+    """Keep the grid in the worker process for all its tiles"""
+    _tile_grid['grid'] = grid
+
+
+def intersect_tile(tile):
+    """Pieces of the catchments of a tile in a worker process"""
+    return intersect_tile_catchments(_tile_grid['grid'], tile)
+
+
+def intersect_tile_catchments(grid, tile):
+    """Pieces of the catchments of a tile of (sequence number, catchment) pairs
+
+       Returns the pieces, and the sequence number of the catchment of each piece.
+    """
+    list_pieces = [grid.intersect_catchments([catchment]) for sequence, catchment in tile]
+    return (NUM.concatenate(list_pieces),
+            NUM.repeat([sequence for sequence, catchment in tile], [len(each) for each in list_pieces]))
+
+
+def catchment_tiles(grid, catchments, tile_size=64, size_task=500):
+    """Grid-bucket index of the catchments by tiles of tile_size by tile_size grid cells
+
+       Each catchment goes to the tile of the cell at the center of its bounding
+       box. Returns the tasks of at most size_task (sequence number, catchment)
+       pairs of the same tile, in the order of the tiles.
+    """
+    buckets = {}
+    for sequence, catchment in enumerate(catchments):
+        rings = [ring for polygon in catchment[1] for ring in polygon if len(ring) > 0]
+        if rings:
+            vertices = NUM.concatenate(rings)
+            center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+            i, j = grid.cell_positions(center[0:1], center[1:2])
+            key = (int(j[0]) // tile_size, int(i[0]) // tile_size)
+        else:
+            key = (0, 0)
+        buckets.setdefault(key, []).append((sequence, catchment))
+    return [buckets[key][start:start + size_task] for key in sorted(buckets)
+            for start in range(0, len(buckets[key]), size_task)]
+
+
+def intersect_catchments_tiled(grid, catchments, size_pool=None, tile_size=64, return_sequence=False):
+    """Pieces of the catchments in each grid cell, intersected tile by tile on a pool of processes
+
+       grid is a LatLonGrid or a WRFProjection, and catchments an iterable of
+       (stream ID, list of polygons) pairs in its coordinates. Only the cells
+       near each catchment are candidates, so the tiles are independent; their
+       pieces are merged back in the order of the catchments, which gives the
+       same result as grid.intersect_catchments(catchments) for any size_pool.
+       With return_sequence, also returns the position in catchments of the
+       catchment of each piece.
+    """
+    tiles = catchment_tiles(grid, catchments, tile_size)
+    if size_pool is None:
+        size_pool = multiprocessing.cpu_count()
+    size_pool = min(size_pool, len(tiles))
+    if size_pool > 1:
+        pool = multiprocessing.Pool(size_pool, initialize_tile_worker, (grid,))
+        try:
+            results = pool.map(intersect_tile, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [intersect_tile_catchments(grid, tile) for tile in tiles]
+
+    if not results:
+        results = [(grid.intersect_catchments([]), NUM.zeros(0, dtype=NUM.int64))]
+    pieces = NUM.concatenate([each[0] for each in results])
+    sequence = NUM.concatenate([each[1] for each in results]).astype(NUM.int64)
+    order = NUM.argsort(sequence, kind='mergesort')
+    if return_sequence:
+        return pieces[order], sequence[order]
+    return pieces[order]
+
+
+def catchment_hash(grid_identity, wkb):
+    """Hexadecimal digest of the geometry of a catchment feature on a grid
+
+       The digest covers the identity of the grid and the well-known binary of
+       the feature in the coordinates of the grid, so it changes with either.
+    """
+    digest = hashlib.sha1(grid_identity.encode('ascii'))
+    digest.update(bytes(wkb))
+    return digest.hexdigest()
+
+
+def open_csv(path, mode='r'):
+    """Open a .csv file for the csv module in Python 2 (binary mode) or 3 (text mode)"""
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+    return open(path, mode, newline='')
+
+
+def catchment_hashes_path(weight_table):
+    """Path of the geometry hashes of the catchment features of a weight table"""
+    return os.path.splitext(weight_table)[0] + "_hashes.csv"
+
+
+def write_catchment_hashes(weight_table, stream_ids, hashes, npieces):
+    """Write the stream ID, geometry hash and number of pieces of each catchment feature
+       next to the weight table, in the order of the features
+    """
+    rows = [["stream_id", "geometry_hash", "npieces"]]
+    rows.extend([int(stream_id), hash_each, int(size)]
+                for stream_id, hash_each, size in zip(stream_ids, hashes, npieces))
+    with open_csv(catchment_hashes_path(weight_table), 'w') as csvfile:
+        csv.writer(csvfile, dialect = 'excel').writerows(rows)
+
+
+def read_catchment_hashes(weight_table):
+    """Stream ID, geometry hash and number of pieces of the catchment features of a weight table,
+       or None if the weight table has no hashes
+    """
+    in_hashes = catchment_hashes_path(weight_table)
+    if not os.path.exists(in_hashes):
+        return None
+    with open_csv(in_hashes) as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)
+        return [(int(row[0]), row[1], int(row[2])) for row in reader]
+
+
+def read_weight_table_pieces(in_weight_table):
+    """Pieces of a weight table, without its dummy rows
+
+       The stream ID, area and the two grid indices are the first four columns
+       of the weight tables of all grids; lon and lat are read from the columns
+       of those names in any case.
+    """
+    with open_csv(in_weight_table) as csvfile:
+        reader = csv.reader(csvfile)
+        header = [each.lower() for each in next(reader)]
+        rows = [row for row in reader if float(row[1]) != 0]
+    lon_col = header.index('lon')
+    lat_col = header.index('lat')
+    return weight_table_pieces([int(row[0]) for row in rows], [float(row[1]) for row in rows],
+                               [int(row[2]) for row in rows], [int(row[3]) for row in rows],
+                               [float(row[lon_col]) for row in rows],
+                               [float(row[lat_col]) for row in rows])
+
+
+def intersect_catchment_features(grid, features, previous_weight_table=None, size_pool=None):
+    """Pieces of the catchment features in each grid cell, recomputing only the changed streams
+
+       features is a list of (stream ID, well-known binary) pairs in the
+       coordinates of the grid. Without a previous weight table, or if it has
+       no geometry hashes, all the features are intersected. Otherwise the
+       streams whose features have the same hashes, in the same order, as in
+       the previous weight table keep their pieces from it, and the features of
+       the other streams are intersected; the pieces are spliced in the order
+       of the features, as a full intersection would give them.
+       Returns the pieces, the geometry hash and the number of pieces of each
+       feature, and the number of features intersected.
+    """
+    grid_identity = grid.identity
+    hashes = [catchment_hash(grid_identity, wkb) for stream_id, wkb in features]
+    previous = read_catchment_hashes(previous_weight_table) if previous_weight_table else None
+
+    unchanged = set()
+    if previous is not None:
+        previous_pieces = read_weight_table_pieces(previous_weight_table)
+        previous_hashes = {}
+        previous_npieces = {}
+        for stream_id, hash_each, size in previous:
+            previous_hashes.setdefault(stream_id, []).append(hash_each)
+            previous_npieces.setdefault(stream_id, []).append(size)
+        current_hashes = {}
+        for (stream_id, wkb), hash_each in zip(features, hashes):
+            current_hashes.setdefault(int(stream_id), []).append(hash_each)
+
+        # Rows of the previous pieces of each stream, in the order of its features
+        streams = sorted(previous_hashes)
+        order, starts, ends = group_rows(previous_pieces['stream_id'], streams)
+        previous_rows = dict((stream_id, order[start:end])
+                             for stream_id, start, end in zip(streams, starts, ends))
+        unchanged = set(stream_id for stream_id, hashes_each in current_hashes.items()
+                        if previous_hashes.get(stream_id) == hashes_each and
+                        sum(previous_npieces[stream_id]) == len(previous_rows[stream_id]))
+
+    # Intersect the features of the new and changed streams
+    changed = [k for k, (stream_id, wkb) in enumerate(features) if int(stream_id) not in unchanged]
+    new_pieces, sequence = intersect_catchments_tiled(grid, [(features[k][0], parse_wkb(features[k][1]))
+                                                             for k in changed],
+                                                      size_pool, return_sequence=True)
+    if changed:
+        new_npieces = NUM.bincount(sequence, minlength=len(changed))
+    else:
+        # bincount rejects a minlength of 0 before numpy 1.14
+        new_npieces = NUM.zeros(0, dtype=NUM.int64)
+    if not unchanged:
+        npieces = NUM.zeros(len(features), dtype=NUM.int64)
+        npieces[changed] = new_npieces
+        return new_pieces, hashes, npieces, len(changed)
+
+    # Splice the previous and the new pieces in the order of the features
+    new_offsets = NUM.cumsum(new_npieces) - new_npieces
+    position_changed = dict((k, i) for i, k in enumerate(changed))
+    next_feature = dict((stream_id, 0) for stream_id in unchanged)
+    list_rows = []
+    npieces = []
+    for k, (stream_id, wkb) in enumerate(features):
+        if k in position_changed:
+            i = position_changed[k]
+            rows = NUM.arange(new_offsets[i], new_offsets[i] + new_npieces[i]) + len(previous_pieces)
+        else:
+            stream_id = int(stream_id)
+            rank = next_feature[stream_id]
+            start = sum(previous_npieces[stream_id][:rank])
+            rows = previous_rows[stream_id][start:start + previous_npieces[stream_id][rank]]
+            next_feature[stream_id] = rank + 1
+        list_rows.append(rows)
+        npieces.append(len(rows))
+    rows = NUM.concatenate(list_rows).astype(NUM.int64) if list_rows else NUM.zeros(0, dtype=NUM.int64)
+    pieces = NUM.concatenate([previous_pieces, new_pieces.astype(previous_pieces.dtype)])[rows]
+    return pieces, hashes, NUM.array(npieces, dtype=NUM.int64), len(changed)
+
+
+def geojson_polygons(geometry):
+    """Polygons of a GeoJSON Polygon or MultiPolygon geometry as lists of rings"""
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    if geometry['type'] == 'GeometryCollection':
+        return [polygon for each in geometry['geometries'] for polygon in geojson_polygons(each)]
+    return []
+
+
+def read_geojson_catchments(in_geojson, stream_id_field):
+    """Read the catchments of a GeoJSON FeatureCollection in longitude/latitude
+
+       Returns a list of (stream ID, list of polygons) pairs. Features without
+       the stream ID property or without a polygon geometry are skipped.
+    """
+    with open(in_geojson) as geojson_file:
+        collection = json.load(geojson_file)
+    catchments = []
+    for feature in collection['features']:
+        stream_id = (feature.get('properties') or {}).get(stream_id_field)
+        polygons = geojson_polygons(feature.get('geometry'))
+        if stream_id is not None and polygons:
+            catchments.append((int(stream_id), polygons))
+    return catchments
+
+
+def parse_wkb(wkb):
+    """Polygons of a Polygon or MultiPolygon in well-known binary as lists of (x, y) rings
+
+       Accepts ISO and extended (EWKB) geometry types with Z and M values,
+       which are dropped.
+    """
+    wkb = bytearray(wkb)
+
+    def parse_geometry(offset):
+        byte_order = '<' if wkb[offset] == 1 else '>'
+        (geometry_type,) = struct.unpack_from(byte_order + 'I', wkb, offset + 1)
+        offset += 5
+        size_dim = 2
+        if geometry_type & 0x20000000:
+            offset += 4  # EWKB SRID
+        if geometry_type & 0x80000000:
+            size_dim += 1
+        if geometry_type & 0x40000000:
+            size_dim += 1
+        geometry_type &= 0x0FFFFFFF
+        size_dim += {1: 1, 2: 1, 3: 2}.get(geometry_type // 1000, 0)
+        geometry_type %= 1000
+
+        if geometry_type == 3:
+            (size_ring,) = struct.unpack_from(byte_order + 'I', wkb, offset)
+            offset += 4
+            rings = []
+            for i in range(size_ring):
+                (size_point,) = struct.unpack_from(byte_order + 'I', wkb, offset)
+                offset += 4
+                coords = NUM.frombuffer(wkb, dtype=byte_order + 'f8',
+                                        count=size_point * size_dim, offset=offset)
+                rings.append(coords.reshape(size_point, size_dim)[:, :2].astype(NUM.float64))
+                offset += 8 * size_point * size_dim
+            return [rings], offset
+        if geometry_type in (6, 7):
+            (size_part,) = struct.unpack_from(byte_order + 'I', wkb, offset)
+            offset += 4
+            polygons = []
+            for i in range(size_part):
+                part, offset = parse_geometry(offset)
+                polygons.extend(part)
+            return polygons, offset
+        raise ValueError("Unsupported WKB geometry type: {0}".format(geometry_type))
+
+    return parse_geometry(0)[0]
+
+
+def write_weight_table(out_WeightTable, streamID, streamID_list, pieces):
+    """Write the weight table of the pieces in the order of the stream IDs in streamID_list
+
+       Streams without pieces get one dummy row with a zero area at the grid
+       point of the first piece, as required by RAPID.
+    """
+    row_index, npoints, dummy = weight_table_rows(pieces['stream_id'], streamID_list)
+
+    # Python values of the columns, written as the csv module writes Python floats
+    rows = [[streamID, 'area_sqm', 'lon_index', 'lat_index', 'npoints', 'lon', 'lat']]
+    rows.extend(list(row) for row in zip(NUM.repeat(streamID_list, NUM.maximum(npoints, 1)).tolist(),
+                                         pieces['area_sqm'][row_index].tolist(),
+                                         pieces['lon_index'][row_index].tolist(),
+                                         pieces['lat_index'][row_index].tolist(),
+                                         NUM.repeat(NUM.maximum(npoints, 1), NUM.maximum(npoints, 1)).tolist(),
+                                         pieces['lon'][row_index].tolist(),
+                                         pieces['lat'][row_index].tolist()))
+    # The dummy rows have a zero area at the grid point of the first piece
+    for i in NUM.flatnonzero(dummy):
+        rows[i + 1][1] = 0
+
+    with open_csv(out_WeightTable, 'w') as csvfile:
+        csv.writer(csvfile, dialect = 'excel').writerows(rows)
+
+
+def weight_table_rows(stream_id, streamID_list):
+    """Rows of the weight table in the order of the stream IDs in streamID_list
+
+       Each stream ID gets its rows of stream_id in their original order, or one
+       dummy row (row 0) if it has none.
+       Returns the row of stream_id of each row of the weight table, the number
+       of rows of each stream ID, and whether each row is a dummy row.
+    """
+    order, start, end = group_rows(stream_id, streamID_list)
+    npoints = end - start
+    size_out = NUM.maximum(npoints, 1)
+    offsets = NUM.cumsum(size_out) - size_out
+    position = NUM.arange(size_out.sum()) - NUM.repeat(offsets - start, size_out)
+    dummy = NUM.repeat(npoints == 0, size_out)
+    row_index = NUM.where(dummy, 0, order[NUM.minimum(position, len(order) - 1)])
+    return row_index, npoints, dummy
+
+
+def read_connectivity_ids(in_rapid_connect_file):
+    """Stream IDs in the first column of the RAPID connectivity file"""
+    with open_csv(in_rapid_connect_file) as csv_con:
+        return [int(row[0]) for row in csv.reader(csv_con)]
+
+
+def main(argv):
+    """Create an ECMWF weight table from GeoJSON catchments without a GIS backend"""
+    import netCDF4 as NET
+    if len(argv) != 6:
+        print("Usage: python WeightTableEngine.py in_runoff.nc in_rapid_connect.csv "
+              "in_catchments.geojson stream_ID out_weight_table.csv")
+        return 2
+    in_nc, in_rapid_connect_file, in_geojson, streamID, out_WeightTable = argv[1:]
+
+    data_nc = NET.Dataset(in_nc)
+    variables_list = data_nc.variables.keys()
+    lon = data_nc.variables['longitude' if 'longitude' in variables_list else 'lon'][:]
+    lat = data_nc.variables['latitude' if 'latitude' in variables_list else 'lat'][:]
+    data_nc.close()
+
+    grid = LatLonGrid(lon, lat)
+    pieces = intersect_catchments_tiled(grid, read_geojson_catchments(in_geojson, streamID))
+    write_weight_table(out_WeightTable, streamID, read_connectivity_ids(in_rapid_connect_file),
+                       pieces)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,27 @@
+'''-------------------------------------------------------------------------------
+ Source Name: WorkerProcesses.py
+ Version:     ArcGIS 10.2
+ License:     Apache 2.0
+ Author:      Environmental Systems Research Institute Inc.
+ Updated by:  Environmental Systems Research Institute Inc.
+ Description: Setup of the pools of worker processes started by the tools.
+ History:     Initial coding - 10/16/2026, version 1.0
+-------------------------------------------------------------------------------'''
+import os
+import sys
+import multiprocessing
+
+
+def set_worker_executable():
+    """Start the worker processes with pythonw.exe when the tool runs within a
+       geoprocessing application (e.g. ArcMap.exe) on Windows
+
+       multiprocessing starts the workers with sys.executable, which is then the
+       application itself and cannot run them. Elsewhere (python, ArcGIS Server
+       for Linux) the workers are started as usual.
+    """
+    if os.name != 'nt' or os.path.basename(sys.executable).lower().startswith("python"):
+        return
+    pythonw = os.path.join(sys.exec_prefix, "pythonw.exe")
+    if os.path.exists(pythonw):
+        multiprocessing.set_executable(pythonw)